@@ -0,0 +1,496 @@
+import collections
+import functools
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import shutil
+import tarfile
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+from cfde_submit import CONFIG, exc
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Archive codecs, and the file extension of the archives they produce
+CODECS = {
+    "deflate": "zip",
+    "store": "zip",
+    "zstd": "tar.zst",
+}
+# Zip members are deflated on separate threads in blocks of this many bytes, each
+# primed with the deflate window's worth of data before it
+DEFLATE_BLOCK_SIZE = 1024 * 1024
+DEFLATE_WINDOW = 32 * 1024
+
+
+class BagStream:
+    """A zip archive of a BDBag directory that is produced while it is read, so it can
+    be sent as an HTTP request body without ever being written to disk.
+
+    The archive has the same layout as one written by ``bdbag_api.archive_bag``, and
+    every payload file is read exactly once per iteration.
+    """
+
+    def __init__(self, bag_path, delete_dir=False, chunk_size=None, codec=None, level=None,
+                 delete_path=None):
+        """
+        Arguments:
+            bag_path (str): The BDBag directory to archive.
+            delete_dir (bool): Should bag_path be deleted by cleanup()?
+                    Default False.
+            chunk_size (int): Yield archive data in pieces of about this many bytes.
+                    Default None, to use CONFIG["STREAM_CHUNK_SIZE"].
+            codec (str): "deflate" or "store". Default None, to use CONFIG["ARCHIVE_CODEC"].
+            level (int): The deflate compression level, from 0 to 9.
+                    Default None, to use CONFIG["ARCHIVE_LEVEL"].
+            delete_path (str): A directory containing bag_path for cleanup() to delete
+                    instead. Default None.
+        """
+        self.bag_path = bag_path.rstrip(os.path.sep)
+        self.name = "{}.zip".format(os.path.basename(self.bag_path))
+        self.delete_dir = delete_dir
+        self.delete_path = delete_path or self.bag_path
+        self.chunk_size = chunk_size or CONFIG["STREAM_CHUNK_SIZE"]
+        self.codec, self.level = resolve_codec(codec, level)
+        if CODECS[self.codec] != "zip":
+            raise exc.InvalidInput("Only zip archives can be streamed, not '{}'"
+                                   .format(self.codec))
+
+    def __iter__(self):
+        return iter_zip(self.bag_path, self.chunk_size, self.codec, self.level)
+
+    def cleanup(self):
+        """Remove the BDBag directory, if it was requested when the stream was created."""
+        if self.delete_dir and os.path.isdir(self.delete_path):
+            logger.debug("Removing old directory '{}'".format(self.delete_path))
+            shutil.rmtree(self.delete_path)
+
+
+class _StreamBuffer:
+    """Write-only, non-seekable file object that collects whatever ZipFile writes
+    until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.size += len(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+def bag_entries(bag_path):
+    """List the archive member names of a BDBag directory, sorted, relative to its
+    parent directory. Directory names end with a path separator."""
+    parent = os.path.dirname(bag_path)
+    entries = []
+    for root, dirs, files in os.walk(bag_path):
+        for d in dirs:
+            entries.append(os.path.relpath(os.path.join(root, d), parent) + os.path.sep)
+        for f in files:
+            entries.append(os.path.relpath(os.path.join(root, f), parent))
+    entries.sort()
+    return entries
+
+
+def bag_prefix(names):
+    """The directory of an archive's members, like "bag/", that holds its bagit.txt,
+    or "" if the BDBag is at the top of the archive or there is no bagit.txt."""
+    tops = sorted((name for name in names if posixpath.basename(name) == "bagit.txt"),
+                  key=lambda name: name.count("/"))
+    return tops[0][:-len("bagit.txt")] if tops else ""
+
+
+def is_precompressed(filename):
+    """Is this file of a type that is already compressed, so deflating it again would
+    cost CPU time without saving space? Judged by CONFIG["PRECOMPRESSED_EXTENSIONS"]."""
+    return filename.lower().endswith(tuple(CONFIG["PRECOMPRESSED_EXTENSIONS"]))
+
+
+def resolve_codec(codec=None, level=None):
+    """Fill in the configured defaults for an archive codec and level, and check them.
+
+    Returns:
+        tuple: (codec, level)
+    """
+    codec = codec or CONFIG["ARCHIVE_CODEC"]
+    level = CONFIG["ARCHIVE_LEVEL"] if level is None else level
+    if codec not in CODECS:
+        raise exc.InvalidInput("Unknown archive codec '{}'. Choose one of: {}"
+                               .format(codec, ", ".join(CODECS)))
+    max_level = 22 if codec == "zstd" else 9
+    if level is not None and not 0 <= level <= max_level:
+        raise exc.InvalidInput("The '{}' compression level must be between 0 and {}"
+                               .format(codec, max_level))
+    return codec, level
+
+
+def archive_path(bag_path, codec):
+    """The path of the archive written for a BDBag directory, next to it."""
+    return "{}.{}".format(bag_path.rstrip(os.path.sep), CODECS[codec])
+
+
+def write_archive(bag_path, codec=None, level=None, directory=None):
+    """Archive a BDBag directory next to itself, like ``bdbag_api.archive_bag``.
+
+    Arguments:
+        bag_path (str): The BDBag directory to archive.
+        codec (str): One of CODECS. "deflate" compresses zip members, except files that
+                are already compressed, which are stored. "store" never compresses,
+                and "zstd" compresses a tar archive. Both compress on every CPU core,
+                or CONFIG["ARCHIVE_THREADS"].
+                Default None, to use CONFIG["ARCHIVE_CODEC"].
+        level (int): The compression level, 0-9 for deflate or 1-22 for zstd.
+                Default None, to use CONFIG["ARCHIVE_LEVEL"], or the codec's default.
+        directory (str): Write the archive in this directory instead.
+                Default None.
+
+    The archive is hashed as it is written, and its SHA-256 digest is saved next to it
+    in ``<archive>.sha256``, in the format of ``sha256sum``, so it does not need to be
+    read again to be checksummed before it is uploaded.
+
+    Returns:
+        str: The path to the archive.
+    """
+    codec, level = resolve_codec(codec, level)
+    bag_path = os.path.abspath(bag_path).rstrip(os.path.sep)
+    path = archive_path(bag_path, codec)
+    if directory:
+        path = os.path.join(directory, os.path.basename(path))
+    with open(path, 'wb') as f:
+        out = _DigestWriter(f)
+        if codec == "zstd":
+            write_tar_zstd(bag_path, out, level)
+        else:
+            for chunk in iter_zip(bag_path, CONFIG["STREAM_CHUNK_SIZE"], codec, level):
+                out.write(chunk)
+    with open(path + ".sha256", 'w') as f:
+        f.write("{}  {}\n".format(out.digest.hexdigest(), os.path.basename(path)))
+    return path
+
+
+class ArchiveCache:
+    """Archives of BDBags that were already built, so the same data is never bagged and
+    archived twice.
+
+    Each archive is kept in its own directory, named by a key that digests everything
+    the archive depends on. Reading an archive marks it as used, and the least recently
+    used archives are evicted when the cache grows beyond ``max_bytes``.
+    """
+
+    def __init__(self, path=None, max_bytes=None):
+        """
+        Arguments:
+            path (str): The cache directory. Default None, for "archives" in
+                    CONFIG["CACHE_DIR"].
+            max_bytes (int): The most bytes of archives to keep.
+                    Default None, to use CONFIG["ARCHIVE_CACHE_MAX_BYTES"].
+        """
+        self.path = path or os.path.join(CONFIG["CACHE_DIR"], "archives")
+        self.max_bytes = max_bytes or CONFIG["ARCHIVE_CACHE_MAX_BYTES"]
+
+    @classmethod
+    def open_default(cls, enabled=None):
+        """Open the default cache, or return None if it is disabled.
+
+        Arguments:
+            enabled (bool): Use the cache? Default None, to use CONFIG["ARCHIVE_CACHE"].
+        """
+        return cls() if (CONFIG["ARCHIVE_CACHE"] if enabled is None else enabled) else None
+
+    @staticmethod
+    def key(*parts):
+        """Digest the JSON of parts into a key."""
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get(self, key, bag_name, codec):
+        """The cached archive of a BDBag directory named bag_name, or None."""
+        entry = os.path.join(self.path, key)
+        path = archive_path(os.path.join(entry, bag_name), codec)
+        # The checksum is written last, so it marks a complete archive
+        if not os.path.exists(path + ".sha256"):
+            return None
+        os.utime(entry)
+        return path
+
+    def new_entry(self, key):
+        """Make an empty directory to build the archive for key in, and return its path."""
+        entry = os.path.join(self.path, key)
+        shutil.rmtree(entry, ignore_errors=True)
+        os.makedirs(entry)
+        return entry
+
+    def evict(self, keep=None):
+        """Remove the least recently used archives, other than keep, until the cache is
+        no larger than max_bytes.
+
+        Returns:
+            int: The number of archives removed.
+        """
+        entries = []
+        for key in os.listdir(self.path) if os.path.isdir(self.path) else []:
+            entry = os.path.join(self.path, key)
+            size = sum(os.path.getsize(os.path.join(root, f))
+                       for root, _, files in os.walk(entry) for f in files)
+            entries.append((os.stat(entry).st_mtime, size, key))
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logger.debug("Evicting cached archive {} ({} bytes)".format(key, size))
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def purge(self):
+        """Remove every archive.
+
+        Returns:
+            int: The number of archives removed.
+        """
+        keys = os.listdir(self.path) if os.path.isdir(self.path) else []
+        for key in keys:
+            shutil.rmtree(os.path.join(self.path, key), ignore_errors=True)
+        return len(keys)
+
+
+class _DigestWriter:
+    """Write-only file wrapper that hashes everything written through it."""
+
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
+
+    def write(self, data):
+        self.digest.update(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+def write_tar_zstd(bag_path, out, level=None):
+    """Write a BDBag directory as a zstd-compressed tar archive to the file object out."""
+    if zstandard is None:
+        raise exc.InvalidInput("The 'zstd' archive codec requires the 'zstandard' package. "
+                               "Install it with 'pip install cfde-submit[zstd]'.")
+    parent = os.path.dirname(bag_path)
+    # threads=-1 compresses on every core
+    compressor = zstandard.ZstdCompressor(level=level or 3,
+                                          threads=CONFIG["ARCHIVE_THREADS"] or -1)
+    # Links are stored as the files they point to, as extract_tar_zstd() rejects links
+    with compressor.stream_writer(out, closefd=False) as compressed, \
+            tarfile.open(fileobj=compressed, mode='w|', format=tarfile.PAX_FORMAT,
+                         dereference=True) as tar:
+        for entry in bag_entries(bag_path):
+            tar.add(os.path.join(parent, entry), arcname=entry.rstrip(os.path.sep),
+                    recursive=False)
+
+
+def extract_tar_zstd(path, directory=None):
+    """Extract a zstd-compressed tar archive into directory.
+
+    Arguments:
+        path (str): The archive.
+        directory (str): Where to extract it.
+                Default None, to extract into a new temporary directory.
+
+    Returns:
+        str: The path of the BDBag directory in directory.
+
+    Raises:
+        cfde_submit.exc.InvalidInput: A member would be written outside directory, or
+            is a link or special file rather than a file or directory.
+    """
+    if zstandard is None:
+        raise exc.InvalidInput("Reading '{}' requires the 'zstandard' package".format(path))
+    output = directory or tempfile.mkdtemp(prefix="cfde_submit_")
+    with open(path, 'rb') as f, zstandard.ZstdDecompressor().stream_reader(f) as data, \
+            tarfile.open(fileobj=data, mode='r|') as tar:
+        for member in tar:
+            if os.path.isabs(member.name) or ".." in member.name.split("/"):
+                raise exc.InvalidInput("Archive '{}' has an unsafe member '{}'"
+                                       .format(path, member.name))
+            # Links could point anywhere, and BDBags only hold files
+            if not (member.isfile() or member.isdir()):
+                raise exc.InvalidInput("Archive '{}' has a link or special file '{}'"
+                                       .format(path, member.name))
+            tar.extract(member, output)
+    contents = os.listdir(output)
+    return os.path.join(output, contents[0]) if len(contents) == 1 else output
+
+
+def iter_zip(bag_path, chunk_size, codec="deflate", level=None):
+    """Generate a zip archive of a BDBag directory, chunk by chunk.
+
+    Arguments:
+        bag_path (str): The BDBag directory to archive.
+        chunk_size (int): Yield archive data once about this many bytes are ready.
+        codec (str): "deflate" or "store". Default "deflate".
+        level (int): The deflate compression level. Default None, for zlib's default.
+    """
+    buffer = _StreamBuffer()
+    with ZipFile(buffer, 'w', ZIP_DEFLATED, allowZip64=True) as zip_file:
+        for _ in _write_zip_members(zip_file, bag_path, codec, level):
+            if buffer.size >= chunk_size:
+                yield buffer.drain()
+    # Closing the archive writes the central directory
+    yield buffer.drain()
+
+
+def _write_zip_members(zip_file, bag_path, codec, level):
+    """Write every file and directory of a BDBag to zip_file, in the layout
+    ``bdbag_api.archive_bag`` uses. Yields after each block of data written.
+
+    Files are deflated in blocks on a pool of threads, like pigz does, while the blocks
+    are written in order. Each block's compressor is primed with the end of the block
+    before it, and flushed to a byte boundary, so the blocks of a file join into one
+    ordinary deflate stream. If this version of Python does not let the deflated blocks
+    be passed to ZipFile, it deflates each file itself, one after another.
+    """
+    threads = CONFIG["ARCHIVE_THREADS"] or os.cpu_count() or 1
+    parallel = _can_precompress()
+    if not parallel and codec != "store":
+        logger.debug("Deflating zip members on one thread, as ZipFile cannot be given "
+                     "deflated data")
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        info, out = None, None
+        # Read ahead far enough to keep every thread busy
+        for block_info, data, compressed in _read_ahead(
+                _zip_blocks(bag_path, codec, level, pool if parallel else None), threads * 2):
+            if block_info is not info:
+                if out:
+                    out.close()
+                info, out = block_info, None
+                if info.is_dir():
+                    zip_file.writestr(info, b'')
+                    continue
+                out = zip_file.open(info, 'w')
+                if compressed:
+                    out._compressor = _Precompressed()
+            if compressed:
+                out._compressor.block = compressed.result()
+            # ZipFile computes the CRC and sizes from the data as usual
+            out.write(data)
+            yield
+        if out:
+            out.close()
+        yield
+
+
+def _zip_blocks(bag_path, codec, level, pool):
+    """Generate (info, data, compressed) for each block of each member of the archive, in
+    order. compressed is a future of the deflated data, or None when data is stored as-is
+    or, without a pool, left for ZipFile to deflate. Directories are a single block, with
+    no data."""
+    parent = os.path.dirname(bag_path)
+    for entry in bag_entries(bag_path):
+        filepath = os.path.join(parent, entry)
+        st = os.stat(filepath)
+        info = ZipInfo(filename=entry.replace(os.path.sep, "/"),
+                       date_time=time.localtime(st.st_mtime)[0:6])
+        info.create_system = 3  # unix
+        if entry.endswith(os.path.sep):
+            info.external_attr = 0o40755 << 16 | 0x010
+            info.compress_type = ZIP_STORED
+            yield info, None, None
+            continue
+        info.external_attr = 0o100644 << 16
+        deflate = not (codec == "store" or is_precompressed(entry))
+        info.compress_type = ZIP_DEFLATED if deflate else ZIP_STORED
+        # The level ZipFile deflates the member at itself, without a pool. The attribute
+        # is new in Python 3.13, before which the zlib default is used.
+        if deflate and not pool and level is not None and hasattr(info, "compress_level"):
+            info.compress_level = level
+        # Known up front so ZipFile can choose ZIP64 headers without seeking back
+        info.file_size = st.st_size
+        with io.open(filepath, 'rb') as f:
+            data, previous = f.read(DEFLATE_BLOCK_SIZE), b""
+            while True:
+                # An empty file is one empty block, which still ends the deflate stream
+                following = f.read(DEFLATE_BLOCK_SIZE) if data else b""
+                last = not following
+                compressed = None
+                if deflate and pool:
+                    compressed = pool.submit(_deflate_block, data, previous[-DEFLATE_WINDOW:],
+                                             level, last)
+                yield info, data, compressed
+                if last:
+                    break
+                data, previous = following, data
+
+
+def _deflate_block(data, dictionary, level, last):
+    """Deflate one block of a file as part of a raw deflate stream."""
+    options = {"zdict": dictionary} if dictionary else {}
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+                                  zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                  zlib.Z_DEFAULT_STRATEGY, **options)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last
+                                                        else zlib.Z_SYNC_FLUSH)
+
+
+def _read_ahead(iterable, count):
+    """Iterate while keeping count items taken from iterable ahead of the consumer."""
+    pending = collections.deque()
+    for item in iterable:
+        pending.append(item)
+        if len(pending) > count:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+@functools.lru_cache(maxsize=None)
+def _can_precompress():
+    """Can _Precompressed stand in for the compressor of a zip member being written?
+    ZipFile keeps it in a private attribute, which a later Python may not have."""
+    with ZipFile(io.BytesIO(), 'w', ZIP_DEFLATED) as probe:
+        with probe.open("probe", 'w') as out:
+            return hasattr(out, "_compressor")
+
+
+class _Precompressed:
+    """Stands in for the compressor of a zip member being written, and returns the
+    block that was deflated for the data instead of compressing it again."""
+
+    def __init__(self):
+        self.block = b""
+
+    def compress(self, data):
+        block, self.block = self.block, b""
+        return block
+
+    def flush(self):
+        return b""
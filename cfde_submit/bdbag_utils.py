@@ -1,28 +1,33 @@
+import contextlib
 import os
 import logging
 import shutil
+import tarfile
+import tempfile
 
 from bdbag import bdbag_api
 import git
 
-from cfde_submit import CONFIG, exc
+from cfde_submit import CONFIG, archive, checksums, exc, ignore, remote, staging, verify
 
 logger = logging.getLogger(__name__)
 
 
 def get_bag(data_path, output_dir=None, delete_dir=False,
-            handle_git_repos=True, bdbag_kwargs=None):
+            handle_git_repos=True, bdbag_kwargs=None, stream=False, codec=None, level=None,
+            exclude=None, remote_files=None, verify_mode=None, cache_archive=None):
     """
     Arguments:
         data_path (str): The path to the data to ingest into DERIVA. The path can be:
                 1) A directory to be formatted into a BDBag
-                2) A Git repository to be copied into a BDBag
+                2) A Git repository, whose files committed at HEAD are bagged
                 3) A premade BDBag directory
                 4) A premade BDBag in an archive file
         output_dir (str): The path to create an output directory in. The resulting
                 BDBag archive will be named after this directory.
                 If not set, the directory will be turned into a BDBag in-place.
-                For Git repositories, this is automatically set, but can be overridden.
+                For Git repositories, this is always set, to a directory named with the
+                commit hash.
                 If data_path is a file, this has no effect.
                 This dir MUST NOT be in the `data_path` directory or any subdirectories.
                 Default None.
@@ -35,6 +40,47 @@ def get_bag(data_path, output_dir=None, delete_dir=False,
                 instead of Git repositories.
                 Default True.
         bdbag_kwargs (dict): Extra args to pass to bdbag
+        stream (bool): Should the archive be generated on the fly instead of written to disk?
+                Has no effect if data_path is already an archive file.
+                Default False.
+        codec (str): How to archive the BDBag, one of cfde_submit.archive.CODECS:
+                "deflate" (zip), "store" (zip without compression) or "zstd" (tar.zst).
+                Has no effect if data_path is already an archive file.
+                Default None, to use CONFIG["ARCHIVE_CODEC"].
+        level (int): The compression level for codec.
+                Default None, to use CONFIG["ARCHIVE_LEVEL"].
+        exclude (list): Patterns of files and directories to leave out of a new BDBag,
+                in addition to CONFIG["EXCLUDE_PATTERNS"] and those in a ``.cfdeignore``
+                file at the top of data_path. See cfde_submit.ignore.IgnoreRules.
+                Excluded files are never hashed, staged, archived or uploaded.
+                Has no effect if data_path is already a BDBag.
+                Default None.
+        remote_files (str): The path to a remote file manifest, listing payload files
+                that are already hosted elsewhere (see remote.load_manifest()).
+                They are listed in the BDBag's ``fetch.txt`` instead of being archived
+                and uploaded, and any copies of them in data_path are left out.
+                Has no effect if data_path is already a BDBag.
+                Default None.
+        verify_mode (str): How to check a premade BDBag against its manifests before it
+                is archived or returned, one of cfde_submit.verify.MODES: "none", "fast"
+                (file lists and sizes) or "full" (checksums, hashed on every core).
+                Raises exc.CorruptBag naming the bad files.
+                Has no effect on BDBags made by this function.
+                Default None, to use CONFIG["BAG_VERIFY"].
+        cache_archive (bool): Keep the archive in an archive.ArchiveCache, keyed by the
+                commit of a Git repository, or the paths, sizes and checksums of the
+                payload files of a directory, and the archive options? When nothing has
+                changed, the cached archive is returned without bagging or archiving
+                again. The payload is the same before and after a directory is bagged
+                in place, so either finds the other's archive. Cached archives are
+                written in CONFIG["CACHE_DIR"] instead of next to the data.
+                Has no effect when streaming.
+                Default None, to use CONFIG["ARCHIVE_CACHE"].
+
+    Returns:
+        str: The path to the BDBag archive, or
+        archive.BagStream: when stream is True and data_path is a directory. The BDBag
+                directory is removed by BagStream.cleanup() instead of by this function.
     """
     bdbag_kwargs = bdbag_kwargs or {}
     data_path = os.path.abspath(data_path)
@@ -43,44 +89,127 @@ def get_bag(data_path, output_dir=None, delete_dir=False,
 
     if not os.path.isdir(data_path):
         _, ext = os.path.splitext(data_path)
-        if ext.lstrip('.') not in ['zip', 'tar', 'tgz']:
+        if ext.lstrip('.') not in ['zip', 'tar', 'tgz', 'zst']:
             raise exc.InvalidInput(
                 ("The dataset '{}' is invalid. Input MUST be a bdbag (archive or directory) "
                  "or a non-bdbag directory. Any other files cannot be submitted."
                  "").format(data_path))
+        # Catch a corrupt premade BDBag before it is uploaded
+        verify.check_bag(data_path, verify_mode)
 
-    if handle_git_repos:
-        logger.debug("Checking for a Git repository")
-        # If Git repo, set output_dir appropriately
+    remote_entries = []
+    if remote_files and os.path.isdir(data_path) and not bdbag_api.is_bag(data_path):
+        remote_entries = remote.load_manifest(remote_files)
+        checksum_cache = checksums.ChecksumCache.open_default()
         try:
-            repo = git.Repo(data_path, search_parent_directories=True)
-        # Not Git repo
-        except git.InvalidGitRepositoryError:
-            logger.debug("Not a Git repo")
-        # Path not found, turn into standard FileNotFoundError
-        except git.NoSuchPathError:
-            raise FileNotFoundError("Path '{}' does not exist".format(data_path))
-        # Is Git repo
+            remote.complete_manifest(remote_entries, data_path, cache=checksum_cache)
+        finally:
+            if checksum_cache:
+                checksum_cache.close()
+        # Local copies of remote files stay out of the payload
+        exclude = list(exclude or []) + remote.exclude_patterns(remote_entries)
+
+    # Archives are cached if asked to, unless they are streamed, which writes no archive
+    archive_cache = None
+    if os.path.isdir(data_path) and not stream:
+        archive_cache = archive.ArchiveCache.open_default(cache_archive)
+    cache_key, cache_entry = None, None
+    exported = False
+    # Where the archive is written, if not next to the BDBag directory
+    archive_dir = None
+    # A temporary directory to remove with the BDBag directory
+    staging_root = None
+
+    repo = _find_repo(data_path) if handle_git_repos else None
+    if repo:
+        # Needs to not have slash at end - is known Git repo already, slash
+        # interferes with os.path.basename/dirname
+        if data_path.endswith("/"):
+            data_path = data_path[:-1]
+        tree_path = os.path.relpath(data_path, repo.working_tree_dir)
+        commit = str(repo.head.commit) if repo.head.is_valid() else None
+        if not _is_committed(repo, tree_path):
+            # Copy the working tree instead, as before Git trees were exported
+            logger.warning("'{}' is not committed to the Git repository at '{}', so the files "
+                           "in it are bagged as they are".format(data_path, repo.working_tree_dir))
+            if not bdbag_api.is_bag(data_path):
+                output_dir = os.path.join(os.path.dirname(data_path), "{}_{}".format(
+                    os.path.basename(data_path), commit or "uncommitted"))
+                delete_dir = True
+                exclude = list(exclude or []) + [".git/"]
         else:
-            logger.debug("Git repo found, collecting metadata")
-            # Needs to not have slash at end - is known Git repo already, slash
-            # interferes with os.path.basename/dirname
-            if data_path.endswith("/"):
-                data_path = data_path[:-1]
-            # Set output_dir to new dir named with HEAD commit hash
-            new_dir_name = "{}_{}".format(os.path.basename(data_path), str(repo.head.commit))
+            logger.debug("Git repo found, bagging the files committed at HEAD")
+            _warn_uncommitted(repo, tree_path, data_path, commit, exclude)
+            # Export into a new dir named with HEAD commit hash, in the archive cache if
+            # it is used, so the same commit is never bagged twice
+            new_dir_name = "{}_{}".format(os.path.basename(data_path), commit)
             output_dir = os.path.join(os.path.dirname(data_path), new_dir_name)
-            # Delete temp dir after archival
+            if archive_cache:
+                codec, level = archive.resolve_codec(codec, level)
+                cache_key = archive_cache.key("git", commit, tree_path, codec, level,
+                                              bdbag_kwargs, exclude, remote_entries)
+                cached_archive = archive_cache.get(cache_key, new_dir_name, codec)
+                if cached_archive:
+                    logger.info("Reusing the BDBag of commit {} at '{}'"
+                                .format(commit, cached_archive))
+                    return cached_archive
+                cache_entry = archive_cache.new_entry(cache_key)
+                output_dir = os.path.join(cache_entry, new_dir_name)
+            try:
+                _export_git_tree(repo, tree_path, output_dir, exclude)
+            except FileExistsError:
+                raise FileExistsError(f"Error: The directory {output_dir} already exists from a "
+                                      f"previous cfde-submit run. Please remove this directory and "
+                                      f"try again.")
+            # Process exported dir instead of working tree, and delete it after archival
+            data_path = output_dir
             delete_dir = True
+            exported = True
+
+    # Files to leave out of a new BDBag. An exported Git tree was already filtered.
+    rules = None
+    if os.path.isdir(data_path) and bdbag_api.is_bag(data_path):
+        verify.check_bag(data_path, verify_mode)
+    elif os.path.isdir(data_path) and not exported:
+        rules = ignore.IgnoreRules.load(data_path, exclude)
+
+    # Reuse the archive of a directory when none of its files have changed
+    if archive_cache and not cache_key:
+        codec, level = archive.resolve_codec(codec, level)
+        bag_name = os.path.basename(os.path.abspath(output_dir or data_path))
+        checksum_cache = checksums.ChecksumCache.open_default()
+        try:
+            payload = _payload_key(data_path, rules, remote_entries, checksum_cache,
+                                   _bag_algorithms(bdbag_kwargs))
+        finally:
+            if checksum_cache:
+                checksum_cache.close()
+        cache_key = archive_cache.key("payload", payload, bag_name, codec, level, bdbag_kwargs)
+        cached_archive = archive_cache.get(cache_key, bag_name, codec)
+        # The tag files of a BDBag changed since it was archived are not in the key
+        if cached_archive and _tags_changed_since(data_path, cached_archive):
+            cached_archive = None
+        if cached_archive:
+            logger.info("'{}' is unchanged, reusing its BDBag at '{}'"
+                        .format(data_path, cached_archive))
+            return cached_archive
 
     # If dir and not already BDBag, make BDBag
     if os.path.isdir(data_path) and not bdbag_api.is_bag(data_path):
         logger.debug("Creating BDBag out of directory '{}'".format(data_path))
-        # If output_dir specified, copy data to output dir first
-        if output_dir:
-            logger.debug("Copying data to '{}' before creating BDBag".format(output_dir))
+        # Bagging in place would sweep excluded files into the BDBag, so stage the rest
+        # in a temporary dir next to data_path, and archive it where it would have been
+        if not output_dir and rules and rules.any_excluded(data_path):
+            staging_root = tempfile.mkdtemp(prefix=".cfde-submit-",
+                                            dir=os.path.dirname(data_path))
+            output_dir = os.path.join(staging_root, os.path.basename(data_path))
+            archive_dir = os.path.dirname(data_path)
+            delete_dir = True
+        # If output_dir specified, stage data in output dir first
+        if output_dir and output_dir != data_path:
+            logger.debug("Staging data at '{}' before creating BDBag".format(output_dir))
             output_dir = os.path.abspath(output_dir)
-            # If shutil.copytree is called when the destination dir is inside the source dir
+            # If the tree is staged when the destination dir is inside the source dir
             # by more than one layer, it will recurse infinitely.
             # (e.g. /source => /source/dir/dest)
             # Exactly one layer is technically okay (e.g. /source => /source/dest),
@@ -91,7 +220,7 @@ def get_bag(data_path, output_dir=None, delete_dir=False,
                 raise ValueError("The output_dir ('{}') must not be in data_path ('{}')"
                                  .format(output_dir, data_path))
             try:
-                shutil.copytree(data_path, output_dir)
+                staging.stage_tree(data_path, output_dir, exclude=rules)
             except FileExistsError:
                 raise FileExistsError(f"Error: The directory {output_dir} already exists from a "
                                       f"previous cfde-submit run. Please remove this directory and "
@@ -99,24 +228,190 @@ def get_bag(data_path, output_dir=None, delete_dir=False,
             # Process new dir instead of old path
             data_path = output_dir
         # If output_dir not specified, never delete data dir
-        else:
+        elif not output_dir:
             delete_dir = False
-        # Make bag
-        bdbag_api.make_bag(data_path, **bdbag_kwargs)
+        # Make bag, hashing payload files on every core
+        with checksums.parallel_manifests(), tempfile.TemporaryDirectory() as tmp_dir:
+            if remote_entries:
+                manifest_path = os.path.join(tmp_dir, "remote-file-manifest.json")
+                remote.write_manifest(remote_entries, manifest_path)
+                bdbag_kwargs = dict(bdbag_kwargs, remote_file_manifest=manifest_path)
+                logger.debug("Listing {} remote files in fetch.txt".format(len(remote_entries)))
+            bdbag_api.make_bag(data_path, **bdbag_kwargs)
         if not bdbag_api.is_bag(data_path):
             raise ValueError("Failed to create BDBag from {}".format(data_path))
         logger.debug("BDBag created at '{}'".format(data_path))
 
+    # If dir (must be BDBag at this point), archive while uploading when streaming
+    if os.path.isdir(data_path) and stream:
+        logger.debug("BDBag at '{}' will be archived while it is uploaded".format(data_path))
+        return archive.BagStream(data_path, delete_dir=delete_dir, codec=codec, level=level,
+                                 delete_path=staging_root)
+
     # If dir (must be BDBag at this point), archive
     if os.path.isdir(data_path):
-        logger.debug("Archiving BDBag at '{}' using '{}'"
-                     .format(data_path, CONFIG["ARCHIVE_FORMAT"]))
-        new_data_path = bdbag_api.archive_bag(data_path, CONFIG["ARCHIVE_FORMAT"])
+        codec, level = archive.resolve_codec(codec, level)
+        logger.debug("Archiving BDBag at '{}' using '{}'".format(data_path, codec))
+        if cache_key and not cache_entry:
+            cache_entry = archive_cache.new_entry(cache_key)
+        new_data_path = archive.write_archive(data_path, codec, level,
+                                              directory=cache_entry or archive_dir)
         logger.debug("BDBag archived to file '{}'".format(new_data_path))
+        if archive_cache:
+            archive_cache.evict(keep=cache_key)
         # If requested (e.g. Git repo copied dir), delete data dir
         if delete_dir:
             logger.debug("Removing old directory '{}'".format(data_path))
-            shutil.rmtree(data_path)
+            shutil.rmtree(staging_root or data_path)
         # Overwrite data_path - don't care about dir for uploading
         data_path = new_data_path
     return data_path
+
+
+@contextlib.contextmanager
+def submitted_tree(data_path, handle_git_repos=True, exclude=None):
+    """The directory whose files get_bag() bags for data_path, to validate what will be
+    submitted without bagging it.
+
+    For a directory committed to a Git repository, that is the files committed at HEAD,
+    exported to a temporary directory that is removed on exit. Otherwise, it is
+    data_path itself.
+
+    Arguments:
+        data_path (str): The directory to submit.
+        handle_git_repos (bool): As in get_bag(). Default True.
+        exclude (list): As in get_bag(). Default None.
+
+    Yields:
+        str: The path of the directory.
+    """
+    data_path = os.path.abspath(data_path)
+    repo = _find_repo(data_path) if handle_git_repos and os.path.isdir(data_path) else None
+    tree_path = repo and os.path.relpath(data_path, repo.working_tree_dir)
+    if not repo or not _is_committed(repo, tree_path):
+        yield data_path
+        return
+    with tempfile.TemporaryDirectory(prefix=".cfde-submit-",
+                                     dir=os.path.dirname(data_path)) as tmp_dir:
+        tree = os.path.join(tmp_dir, os.path.basename(data_path))
+        _export_git_tree(repo, tree_path, tree, exclude)
+        yield tree
+
+
+def _find_repo(data_path):
+    """The Git repository data_path is in, or None."""
+    logger.debug("Checking for a Git repository")
+    try:
+        return git.Repo(data_path, search_parent_directories=True)
+    except git.InvalidGitRepositoryError:
+        logger.debug("Not a Git repo")
+        return None
+    # Path not found, turn into standard FileNotFoundError
+    except git.NoSuchPathError:
+        raise FileNotFoundError("Path '{}' does not exist".format(data_path))
+
+
+def _is_committed(repo, tree_path):
+    """Is tree_path, relative to the working tree, a directory committed at HEAD?"""
+    if not repo.head.is_valid():
+        return False
+    if tree_path == os.curdir:
+        return True
+    try:
+        return repo.head.commit.tree[tree_path.replace(os.sep, "/")].type == "tree"
+    except KeyError:
+        return False
+
+
+def _warn_uncommitted(repo, tree_path, data_path, commit, exclude=None):
+    """Warn about the files in data_path that are not bagged from HEAD: uncommitted
+    changes, and files that are untracked or ignored by Git, unless they are excluded
+    anyway."""
+    if repo.is_dirty(path=tree_path):
+        logger.warning("'{}' has uncommitted changes, which will not be submitted. "
+                       "Only the files committed at HEAD ({}) are bagged."
+                       .format(data_path, commit))
+    # Lists ignored files too, as no exclude options are given
+    others = repo.git.ls_files("--others", "-z", "--", tree_path).split("\0")
+    rules = ignore.IgnoreRules.load(data_path, exclude)
+    left_out = [path for path in others if path and not rules.excludes(
+        os.path.relpath(os.path.join(repo.working_tree_dir, path), data_path))]
+    if left_out:
+        logger.warning("{} files in '{}' are untracked or ignored by Git, and will not be "
+                       "submitted: {}{}. Commit them, or list them in {} to leave them out."
+                       .format(len(left_out), data_path, ", ".join(left_out[:5]),
+                               ", ..." if len(left_out) > 5 else "", ignore.IGNORE_FILE))
+
+
+def _payload_key(data_path, rules, remote_entries, cache=None, algorithms=None):
+    """What the BDBag of a directory holds, as the digest of its payload files (those in
+    ``data/`` if it is already a BDBag) and the URL, path and length of each remote file,
+    so a directory and the BDBag made from it in place have the same key.
+
+    The payload of a directory that is not a BDBag yet is also hashed with algorithms,
+    into cache, so the BDBag made from it does not read the files again."""
+    if bdbag_api.is_bag(data_path):
+        tree = checksums.tree_digest(os.path.join(data_path, "data"), cache=cache)
+        try:
+            with open(os.path.join(data_path, "fetch.txt"), encoding="utf-8") as f:
+                fetched = remote.read_fetch(f.read())
+        except FileNotFoundError:
+            fetched = {}
+        fetched = sorted([url, filename, length]
+                         for filename, (url, length) in fetched.items())
+    else:
+        tree = checksums.tree_digest(data_path, cache=cache, exclude=rules,
+                                     algorithms=algorithms)
+        fetched = sorted([entry["url"], "data/" + entry["filename"], entry.get("length")]
+                         for entry in remote_entries)
+    return [tree, fetched]
+
+
+def _bag_algorithms(bdbag_kwargs):
+    """The checksum algorithms ``bdbag_api.make_bag`` uses for its manifests, given
+    bdbag_kwargs."""
+    if bdbag_kwargs.get("algs"):
+        return list(bdbag_kwargs["algs"])
+    bag_config = bdbag_api.read_config(bdbag_kwargs.get("config_file"))[bdbag_api.BAG_CONFIG_TAG]
+    return list(bag_config.get(bdbag_api.BAG_ALGORITHMS_TAG, ["md5", "sha256"]))
+
+
+def _tags_changed_since(bag_path, archive_path):
+    """Was any tag file of a BDBag directory, such as ``bag-info.txt``, modified after
+    archive_path was written?"""
+    if not bdbag_api.is_bag(bag_path):
+        return False
+    written = os.path.getmtime(archive_path)
+    return any(os.path.getmtime(os.path.join(bag_path, name)) > written
+               for name in os.listdir(bag_path)
+               if os.path.isfile(os.path.join(bag_path, name)))
+
+
+def _export_git_tree(repo, tree_path, destination, exclude=None):
+    """Write the files committed at HEAD under tree_path (relative to the working tree)
+    into destination, streamed from ``git archive``. Neither ``.git`` nor untracked or
+    modified files in the working tree are included, nor files excluded by exclude or
+    by the ``.cfdeignore`` file committed at the top of tree_path."""
+    tree_path = "" if tree_path == os.curdir else tree_path.replace(os.sep, "/") + "/"
+    treeish = "HEAD:" + tree_path if tree_path else "HEAD"
+    os.makedirs(destination)
+    try:
+        try:
+            committed = repo.git.show("HEAD:" + tree_path + ignore.IGNORE_FILE).splitlines()
+        except git.GitCommandError:
+            committed = []
+        rules = ignore.IgnoreRules(CONFIG["EXCLUDE_PATTERNS"] + committed + list(exclude or []))
+        process = repo.git.archive(treeish, format="tar", as_process=True)
+        try:
+            with tarfile.open(fileobj=process.stdout, mode="r|") as tar:
+                for member in tar:
+                    if not rules.excludes(member.name, member.isdir()):
+                        tar.extract(member, destination)
+        finally:
+            # Raises the error from git, if the tar stream was cut short by one
+            process.wait()
+    except git.GitCommandError as e:
+        shutil.rmtree(destination, ignore_errors=True)
+        raise exc.InvalidInput("Unable to export '{}' from Git: {}"
+                               .format(treeish, e.stderr.strip() or e))
+    logger.debug("Exported '{}' to '{}'".format(treeish, destination))
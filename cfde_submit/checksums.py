@@ -0,0 +1,338 @@
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bdbag import bdbagit
+
+from cfde_submit import CONFIG
+from cfde_submit.sqlite_cache import SQLiteCache
+
+logger = logging.getLogger(__name__)
+
+# Bytes read at a time while hashing a file
+HASH_BLOCK_SIZE = 1024 * 1024
+# Small files are hashed in batches of about this many bytes, to limit the number of
+# round trips to worker processes
+BATCH_BYTES = 64 * 1024 * 1024
+BATCH_FILES = 256
+# Files modified this recently may change again within the same mtime tick, so their
+# digests are not cached
+RACY_SECONDS = 2
+
+# BDBag's own implementations, restored after parallel_manifests()
+_bdbag_make_manifests = bdbagit.make_manifests
+_bdbag_generate_manifest_lines = bdbagit.generate_manifest_lines
+# The threads in parallel_manifests() blocks, and the digests of each
+_manifests = threading.local()
+_manifests_lock = threading.Lock()
+_manifests_users = 0
+
+
+def file_hashes(path, algorithms):
+    """Hash a file with every algorithm in a single read.
+
+    Returns:
+        tuple: The size of the file, and a dict of hex digests by algorithm.
+    """
+    with open(path, 'rb', buffering=0) as f:
+        return stream_hashes(f, algorithms)
+
+
+def stream_hashes(stream, algorithms):
+    """Like file_hashes(), for a binary file object open for reading."""
+    hashers = [hashlib.new(alg) for alg in algorithms]
+    size = 0
+    buffer = bytearray(HASH_BLOCK_SIZE)
+    view = memoryview(buffer)
+    while True:
+        count = stream.readinto(buffer)
+        if not count:
+            break
+        size += count
+        for hasher in hashers:
+            hasher.update(view[:count])
+    return size, {alg: hasher.hexdigest() for alg, hasher in zip(algorithms, hashers)}
+
+
+def _hash_batch(paths, algorithms):
+    return [(path, file_hashes(path, algorithms)) for path in paths]
+
+
+def hash_files(paths, algorithms, processes=None, cache=None):
+    """Hash many files on a pool of processes.
+
+    Files are handed out largest first, so a few large files do not leave the other
+    processes idle at the end. Small files are sent in batches.
+
+    Arguments:
+        paths (list): The files to hash.
+        algorithms (list): The hashlib names of the algorithms to compute, like "sha256".
+        processes (int): The number of processes to hash with.
+                Default None, to use CONFIG["HASH_PROCESSES"], or one per CPU.
+        cache (ChecksumCache): Reuse the digests of files that have not changed since
+                they were cached, and cache the rest. Default None.
+
+    Returns:
+        dict: (size, {algorithm: hex digest}) for each path.
+    """
+    stats = {path: os.stat(path) for path in paths}
+    results = cache.lookup(stats, algorithms) if cache else {}
+    if results:
+        logger.debug("Reusing cached digests for {} of {} files".format(len(results), len(paths)))
+    hashed = hash_in_batches({path: stats[path].st_size for path in paths
+                              if path not in results}, algorithms, processes)
+    if cache:
+        cache.store(hashed, stats)
+    results.update(hashed)
+    return results
+
+
+def tree_digest(path, cache=None, exclude=None, algorithms=None):
+    """Digest the relative path, size and SHA-256 checksum of every file in a directory,
+    so any change to the tree changes the digest.
+
+    Arguments:
+        path (str): The directory to digest. Symbolic links are followed.
+        cache (ChecksumCache): Passed to hash_files(). Default None.
+        exclude (ignore.IgnoreRules): Files and directories to leave out. Default None.
+        algorithms (list): More algorithms to hash the files with in the same read, so
+                they are in the cache when they are needed, such as for the manifests
+                of a BDBag made from the directory next. Default None.
+
+    Returns:
+        str: The hex digest.
+    """
+    walk = exclude.walk(path) if exclude else os.walk(path, followlinks=True)
+    files = sorted(os.path.join(root, f) for root, _, names in walk for f in names)
+    hashes = hash_files(files, sorted(set(["sha256"] + list(algorithms or []))), cache=cache)
+    digest = hashlib.sha256()
+    for f in files:
+        size, digests = hashes[f]
+        relpath = os.path.relpath(f, path).replace(os.path.sep, "/")
+        digest.update("{}\0{}\0{}\n".format(relpath, size, digests["sha256"]).encode())
+    return digest.hexdigest()
+
+
+def hash_in_batches(sizes, algorithms, processes, hash_batch=None):
+    """Hash the files in sizes, a dict of their sizes by path, largest first, in batches
+    passed to hash_batch(paths, algorithms) on a pool of processes.
+    hash_batch defaults to hashing files on disk."""
+    hash_batch = hash_batch or _hash_batch
+    processes = processes or CONFIG["HASH_PROCESSES"] or os.cpu_count() or 1
+    sized = sorted(((size, path) for path, size in sizes.items()), reverse=True)
+    batches, batch, batch_bytes = [], [], 0
+    for size, path in sized:
+        batch.append(path)
+        batch_bytes += size
+        if batch_bytes >= BATCH_BYTES or len(batch) >= BATCH_FILES:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+    if batch:
+        batches.append(batch)
+
+    logger.debug("Hashing {} files with {} in {} batches on {} processes"
+                 .format(len(sized), ", ".join(algorithms), len(batches), processes))
+    if processes == 1 or len(batches) < 2:
+        return dict(entry for batch in batches for entry in hash_batch(batch, algorithms))
+    results = {}
+    with ProcessPoolExecutor(max_workers=min(processes, len(batches))) as pool:
+        for entries in pool.map(hash_batch, batches, [algorithms] * len(batches)):
+            results.update(entries)
+    return results
+
+
+def _make_manifests(data_dir, processes, algorithms=bdbagit.DEFAULT_CHECKSUMS, **kwargs):
+    """Replaces ``bdbagit.make_manifests`` while any thread is in parallel_manifests().
+    In such a thread, hashes the payload with hash_files(), then lets bdbag write the
+    manifests from the results, so their format and the Payload-Oxum are unchanged.
+    Other threads get bdbag's own implementation."""
+    if not getattr(_manifests, "active", False):
+        return _bdbag_make_manifests(data_dir, processes, algorithms=algorithms, **kwargs)
+    cache = ChecksumCache.open_default()
+    try:
+        _manifests.hashes = hash_files(list(bdbagit._walk(data_dir)), algorithms, cache=cache)
+    finally:
+        if cache:
+            cache.close()
+    try:
+        return _bdbag_make_manifests(data_dir, 1, algorithms=algorithms, **kwargs)
+    finally:
+        _manifests.hashes = None
+
+
+def _generate_manifest_lines(filename, algorithms=bdbagit.DEFAULT_CHECKSUMS):
+    """Replaces ``bdbagit.generate_manifest_lines`` alongside _make_manifests(), with the
+    digests it computed for this thread."""
+    hashes = getattr(_manifests, "hashes", None)
+    if not hashes or filename not in hashes:
+        return _bdbag_generate_manifest_lines(filename, algorithms=algorithms)
+    size, digests = hashes[filename]
+    decoded = bdbagit._decode_filename(filename)
+    return [(alg, digests[alg], decoded, size) for alg in algorithms]
+
+
+@contextlib.contextmanager
+def parallel_manifests():
+    """Make BDBag hash payload files with hash_files() in this thread while this is
+    active, instead of on a single core, for ``bdbag_api.make_bag`` and any other
+    manifest update.
+
+    bdbagit is patched while at least one thread is in a parallel_manifests() block,
+    and restored when the last one leaves it. Other threads are not affected."""
+    global _manifests_users
+    with _manifests_lock:
+        if not _manifests_users:
+            bdbagit.make_manifests = _make_manifests
+            bdbagit.generate_manifest_lines = _generate_manifest_lines
+        _manifests_users += 1
+    active = getattr(_manifests, "active", False)
+    _manifests.active = True
+    try:
+        yield
+    finally:
+        _manifests.active = active
+        with _manifests_lock:
+            _manifests_users -= 1
+            if not _manifests_users:
+                bdbagit.make_manifests = _bdbag_make_manifests
+                bdbagit.generate_manifest_lines = _bdbag_generate_manifest_lines
+
+
+class ChecksumCache(SQLiteCache):
+    """A persistent record of file digests, so files that have not changed since they
+    were last hashed are never hashed again.
+
+    Entries are keyed by absolute path, and only reused while the file's size,
+    modification time (in nanoseconds), device and inode are unchanged. A file that was
+    moved or hardlinked elsewhere, as BDBag does with payload files, is found by its
+    device and inode.
+    The least recently used entries are evicted beyond ``max_entries``.
+    """
+
+    TABLE = "checksums"
+    KEY = "path"
+    COLUMNS = ["path TEXT PRIMARY KEY", "size INTEGER", "mtime_ns INTEGER", "device INTEGER",
+               "inode INTEGER", "digests TEXT"]
+    INDEXES = ["inode"]
+    FILENAME = "checksums.sqlite3"
+    ENABLED = "CHECKSUM_CACHE"
+    MAX_ENTRIES = "CHECKSUM_CACHE_MAX_ENTRIES"
+    UNAVAILABLE = "Checksum cache unavailable, hashing every file"
+
+    def lookup(self, stats, algorithms):
+        """Find the cached digests of unchanged files.
+
+        Arguments:
+            stats (dict): The os.stat() result for each path to look up.
+            algorithms (list): The algorithms every returned entry must have.
+
+        Returns:
+            dict: (size, {algorithm: hex digest}) for each path with a valid entry.
+        """
+        found, used, renamed = {}, [], []
+        now = time.time()
+        for path, st in stats.items():
+            row = self.db.execute(
+                "SELECT path, size, mtime_ns, device, inode, digests FROM checksums "
+                "WHERE path = ?", (os.path.abspath(path),)).fetchone()
+            if not row or tuple(row[1:5]) != (st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino):
+                # The same file under another name
+                row = self.db.execute(
+                    "SELECT path, size, mtime_ns, device, inode, digests FROM checksums "
+                    "WHERE inode = ? AND device = ? AND size = ? AND mtime_ns = ?",
+                    (st.st_ino, st.st_dev, st.st_size, st.st_mtime_ns)).fetchone()
+            if not row:
+                continue
+            digests = json.loads(row[5])
+            if all(alg in digests for alg in algorithms):
+                found[path] = (st.st_size, {alg: digests[alg] for alg in algorithms})
+                used.append(row[0])
+                if row[0] != os.path.abspath(path):
+                    renamed.append((os.path.abspath(path),) + tuple(row[1:]) + (now,))
+        with self.db:
+            self.db.executemany("UPDATE checksums SET last_used = ? WHERE path = ?",
+                                [(now, path) for path in used])
+            # Remember the new name too, in case the old one goes away
+            self.db.executemany("INSERT OR REPLACE INTO checksums "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", renamed)
+        return found
+
+    def store(self, results, stats):
+        """Cache digests from hash_files(), and evict the least recently used entries
+        beyond max_entries."""
+        now = time.time()
+        rows = []
+        for path, (size, digests) in results.items():
+            st = stats[path]
+            # Skip files that were changing while they were hashed, or may still be
+            if st.st_mtime_ns / 1e9 > now - RACY_SECONDS or size != st.st_size:
+                continue
+            rows.append((os.path.abspath(path), st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino,
+                         json.dumps(digests), now))
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO checksums "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._evict()
+
+    def verify(self, processes=None):
+        """Hash every cached file again, and remove entries that are stale (the file is
+        gone or has changed) or wrong (the file changed without changing its size,
+        modification time, device or inode).
+
+        Returns:
+            dict: The number of entries "checked", "stale" and "valid", and the paths
+                of the entries that were "wrong".
+        """
+        stale, current = self._scan()
+        by_algorithms = {}
+        for path, (st, digests) in current.items():
+            by_algorithms.setdefault(tuple(sorted(digests)), {})[path] = st
+        wrong = []
+        for algorithms, stats in by_algorithms.items():
+            hashed = hash_in_batches({path: st.st_size for path, st in stats.items()},
+                                     list(algorithms), processes)
+            wrong.extend(path for path, (size, digests) in hashed.items()
+                         if digests != current[path][1])
+        self._delete(stale + wrong)
+        return {"checked": len(stale) + len(current), "stale": len(stale),
+                "wrong": sorted(wrong), "valid": len(current) - len(wrong)}
+
+    def purge(self, stale_only=False):
+        """Remove every entry, or only those for files that are gone or have changed.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        if stale_only:
+            stale, _ = self._scan()
+            self._delete(stale)
+            return len(stale)
+        return super().purge()
+
+    def _scan(self):
+        """Split the entries into stale paths, and the current stat and cached digests
+        of every other path."""
+        stale, current = [], {}
+        for path, size, mtime_ns, device, inode, digests in self.db.execute(
+                "SELECT path, size, mtime_ns, device, inode, digests FROM checksums").fetchall():
+            try:
+                st = os.stat(path)
+            except OSError:
+                stale.append(path)
+                continue
+            if ((st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino)
+                    != (size, mtime_ns, device, inode)):
+                stale.append(path)
+            else:
+                current[path] = (st, json.loads(digests))
+        return stale, current
+
+    def _delete(self, paths):
+        with self.db:
+            self.db.executemany("DELETE FROM checksums WHERE path = ?",
+                                [(path,) for path in paths])
@@ -4,11 +4,9 @@ import globus_sdk
 import json
 import logging.config
 import os
-import requests
-import time
-import urllib.request
 from .version import __version__ as version
-from cfde_submit import CONFIG, exc, globus_http, validation, bdbag_utils
+from cfde_submit import (CONFIG, archive, exc, globus_http, retry, scan, session, validation,
+                         bdbag_utils)
 from packaging.version import parse as parse_version
 
 logger = logging.getLogger(__name__)
@@ -19,7 +17,6 @@ class CfdeClient:
     client_id = "417301b1-5101-456a-8a27-423e71a2ae26"
     config_filename = os.path.expanduser("~/.cfde-submit.cfg")
     app_name = "CfdeClient"
-    archive_format = "tgz"
 
     def __init__(self, tokens=None):
         """Create a CfdeClient.
@@ -44,6 +41,8 @@ class CfdeClient:
         self.__tokens = {}
         self.__flow_client = None
         self.__transfer_client = None
+        self.__session = None
+        self.retry_policy = retry.RetryPolicy(**CONFIG["RETRY"])
         self.transfer_scope = CONFIG["TRANSFER_SCOPE"]
         self.local_config = fair_research_login.ConfigParserTokenStorage(
             filename=self.config_filename
@@ -99,6 +98,16 @@ class CfdeClient:
                                           f"must be one of {valid_si}")
         self.__service_instance = new_service_instance
 
+    @property
+    def session(self):
+        """The keep-alive HTTP session shared by the remote config, DCC lookup and HTTPS
+        uploads. Sized and timed out by CONFIG["HTTP_POOL_SIZE"] and CONFIG["HTTP_TIMEOUT"]."""
+        if not self.__session:
+            self.__session = session.PooledSession(pool_size=CONFIG["HTTP_POOL_SIZE"],
+                                                   timeout=CONFIG["HTTP_TIMEOUT"],
+                                                   retry_policy=self.retry_policy)
+        return self.__session
+
     def login(self, **login_kwargs):
         """Login to the cfde-submit client. This will ensure the user has the correct
         tokens configured but it DOES NOT guarantee they are in the correct group to
@@ -126,6 +135,12 @@ class CfdeClient:
         except (exc.NotLoggedIn, exc.SubmissionsUnavailable):
             return False
 
+    @property
+    def archive_format(self):
+        """The file extension of archives written with CONFIG["ARCHIVE_CODEC"]. Raises
+        exc.InvalidInput if it is not a known codec."""
+        return archive.CODECS[archive.resolve_codec()[0]]
+
     @property
     def scopes(self):
         return CONFIG["ALL_SCOPES"] + [self.gcs_https_scope, self.flow_scope,
@@ -159,8 +174,8 @@ class CfdeClient:
             return self.__remote_config
         dconf_res = None
         try:
-            dconf_res = requests.get(CONFIG["DYNAMIC_CONFIG_LINKS"][self.service_instance],
-                                     headers={"X-Requested-With": "XMLHttpRequest"})
+            dconf_res = self.session.get(CONFIG["DYNAMIC_CONFIG_LINKS"][self.service_instance],
+                                         headers={"X-Requested-With": "XMLHttpRequest"})
             if dconf_res.status_code >= 300:
                 raise ValueError("Unable to download required configuration: Error {}: {}"
                                  .format(dconf_res.status_code, dconf_res.content))
@@ -234,22 +249,15 @@ class CfdeClient:
                 result[k] = v
         return result
 
-    def get_flow_retry_500s(self, flow_id, retries=3, delay=10):
-        first_exception = None
-        for attempt in range(retries):
-            try:
-                return self.flow_client.get_flow(flow_id)
-            except (globus_sdk.GlobusAPIError, globus_sdk.exc.GlobusAPIError) as e:
-                if not first_exception:
-                    first_exception = e
-                # Retry server errors that may be intermittent
-                if 500 <= e.http_status <= 599:
-                    time.sleep(delay)
-                    continue
-                else:
-                    raise e
-        logger.error(f"Unable to retrieve automate flow after {retries} attempts")
-        raise first_exception
+    def get_flow_retry_500s(self, flow_id, retries=None, delay=None):
+        """Fetch a Flow definition, retrying intermittent server errors under the
+        client's RetryPolicy. retries and delay override its max_attempts and
+        base_delay."""
+        policy = self.retry_policy
+        if retries is not None or delay is not None:
+            policy = policy.copy(max_attempts=policy.max_attempts if retries is None else retries,
+                                 base_delay=policy.base_delay if delay is None else delay)
+        return policy.call("flows", self.flow_client.get_flow, flow_id)
 
     def check(self, raise_exception=True):
         if self.ready:
@@ -303,14 +311,16 @@ class CfdeClient:
 
     def start_deriva_flow(self, data_path, dcc_id, catalog_id=None, schema=None, server=None,
                           output_dir=None, delete_dir=False, handle_git_repos=True,
-                          dry_run=False, test_sub=False, globus=False, disable_validation=False,
-                          **kwargs):
+                          dry_run=False, test_sub=False, globus=None, disable_validation=False,
+                          upload_chunk_size=None, upload_workers=None, stream=False,
+                          archive_codec=None, archive_level=None, exclude=None, remote_files=None,
+                          verify_mode=None, validation_mode=None, cache_archive=None, **kwargs):
         """Start the Globus Automate Flow to ingest CFDE data into DERIVA.
 
         Arguments:
             data_path (str): The path to the data to ingest into DERIVA. The path can be:
                     1) A directory to be formatted into a BDBag
-                    2) A Git repository to be copied into a BDBag
+                    2) A Git repository, whose files committed at HEAD are bagged
                     3) A premade BDBag directory
                     4) A premade BDBag in an archive file
             dcc_id (str): The CFDE-recognized DCC ID for this submission.
@@ -335,23 +345,66 @@ class CfdeClient:
                     When this is False, Git repositories are handled as simple directories
                     instead of Git repositories.
                     Default True.
-            dry_run (bool): Should the data be validated and bagged without starting the Flow?
-                    When True, does not ingest into DERIVA or start the Globus Automate Flow,
-                    and the return value will not have valid DERIVA Flow information.
+            dry_run (bool): Should the data only be scanned, without starting the Flow?
+                    When True, the data is validated without bagging it (for a Git
+                    repository, the files committed at HEAD, exported to a temporary
+                    directory), but nothing is kept, ingested into DERIVA or
+                    transferred, and the return value has the "plan" from
+                    cfde_submit.scan.plan_submission() instead of Flow information.
                     Default False.
             test_sub (bool): Should the submission be run in "test mode" where
                     the submission will be inegsted into DERIVA and immediately deleted?
                     When True, the data will not remain in DERIVA to be viewed and the
                     Flow will terminate before any curation step.
-            globus (bool): Should the data be transferred using Globus Transfer? Default False.
+            globus (bool): Should the data be transferred using Globus Transfer?
+                    Default None, to use Globus for data of at least
+                    CONFIG["GLOBUS_TRANSFER_THRESHOLD"] bytes when Globus Connect Personal
+                    is installed. See cfde_submit.scan.plan_submission().
             disable_validation (bool): When true, does not run frictionless. Useful when working
                     with larger data
+            upload_chunk_size (int): Upload over HTTPS in byte ranges of this size, so an
+                    interrupted upload can be resumed by running the submission again.
+                    0 to always upload in a single request. Default None, to upload
+                    archives larger than CONFIG["PARALLEL_UPLOAD_THRESHOLD"] in ranges of
+                    CONFIG["UPLOAD_PART_SIZE"] and smaller archives in a single request.
+            upload_workers (int): The number of ranges to upload concurrently.
+                    Default None, to use CONFIG["UPLOAD_WORKERS"].
+            stream (bool): Should the BDBag archive be generated while it is uploaded, instead
+                    of being written to disk first? Cannot be used with globus.
+                    Default False.
+            archive_codec (str): How to archive a BDBag directory: "deflate", "store" or
+                    "zstd". See cfde_submit.archive.write_archive().
+                    Default None, to use CONFIG["ARCHIVE_CODEC"].
+            archive_level (int): The compression level for archive_codec.
+                    Default None, to use CONFIG["ARCHIVE_LEVEL"].
+            exclude (list): Glob patterns of files and directories to leave out of a new
+                    BDBag, in addition to those in a ``.cfdeignore`` file at the top of
+                    data_path. See cfde_submit.ignore.IgnoreRules. Default None.
+            remote_files (str): The path to a manifest of payload files that are already
+                    hosted elsewhere, to list in the BDBag's ``fetch.txt`` instead of
+                    uploading. See cfde_submit.remote.load_manifest(). Default None.
+            verify_mode (str): How to check a premade BDBag against its manifests before
+                    it is uploaded: "none", "fast" or "full". See cfde_submit.verify.
+                    Default None, to use CONFIG["BAG_VERIFY"].
+            validation_mode (str): How to validate the tables: "full", "streaming" for
+                    tables too large to validate in memory, or "sampled" to quickly check
+                    a sample of each table. See cfde_submit.validation.ts_validate().
+                    Default None, to use CONFIG["VALIDATION_MODE"].
+            cache_archive (bool): Keep the BDBag archive in the local cache, to be reused
+                    if the same data is submitted again? It is then written in
+                    CONFIG["CACHE_DIR"] instead of next to the data.
+                    Default None, to use CONFIG["ARCHIVE_CACHE"].
 
         Other keyword arguments are passed directly to the ``make_bag()`` function of the
         BDBag API (see https://github.com/fair-research/bdbag for details).
         """
         self.check()
         logger.debug("Startup: Validating input")
+        if stream and globus:
+            raise ValueError("A streamed BDBag cannot be transferred with Globus. Retry without "
+                             "specifying both.")
+        # Raises exc.InvalidInput for an unknown codec or level, before anything is scanned
+        archive.resolve_codec(archive_codec, archive_level)
 
         catalogs = self.remote_config['CATALOGS']
         if catalog_id in catalogs.keys():
@@ -368,126 +421,205 @@ class CfdeClient:
             raise exc.InvalidInput("Error: The dcc you've specified is not valid. Please double "
                                    "check the spelling and try again.")
 
-        # Coerces the BDBag path to a .zip archive
+        # Scan the data before anything is written, to check there is room to bag it and
+        # choose how to transfer it
+        plan = scan.plan_submission(data_path, output_dir=output_dir,
+                                    handle_git_repos=handle_git_repos, stream=stream,
+                                    globus=globus, codec=archive_codec, exclude=exclude,
+                                    remote_files=remote_files, cache_archive=cache_archive)
+        logger.info(scan.format_plan(plan))
+
+        # The data is validated without bagging it in a dry run, which writes nothing, and
+        # when sampling, which reads tables at random, as a deflated archive does not allow.
+        # The files committed to a Git repository are validated, as only they are bagged.
+        validated = False
+        if not disable_validation and (
+                dry_run or (os.path.isdir(data_path)
+                            and (validation_mode or CONFIG["VALIDATION_MODE"]) == "sampled")):
+            with bdbag_utils.submitted_tree(data_path, handle_git_repos, exclude) as tree:
+                validation.validate_user_submission(tree, schema, mode=validation_mode)
+            validated = True
+        # If doing dry run, stop here before writing anything
+        if dry_run:
+            return {
+                "success": True,
+                "message": "Dry run {} successfully. Nothing was written or transferred."
+                           .format("validated" if validated else "completed"),
+                "plan": plan,
+            }
+        if not plan["space_ok"]:
+            raise exc.InsufficientSpace(
+                "Not enough free disk space to bag '{}': {}".format(data_path, "; ".join(
+                    "{} needed in '{}', {} free".format(scan.format_bytes(s["needed"]), s["path"],
+                                                        scan.format_bytes(s["free"]))
+                    for s in plan["space"] if s["needed"] > s["free"])))
+        globus = plan["transport"] == "globus"
+
+        # Coerces the BDBag path to an archive, or a stream of one
         data_path = bdbag_utils.get_bag(
             data_path, output_dir=output_dir, delete_dir=delete_dir,
-            handle_git_repos=handle_git_repos, bdbag_kwargs=kwargs
+            handle_git_repos=handle_git_repos, bdbag_kwargs=kwargs, stream=stream,
+            codec=archive_codec, level=archive_level, exclude=exclude,
+            remote_files=remote_files, verify_mode=verify_mode, cache_archive=cache_archive
         )
-        # Raises exc.ValidationException if something doesn't match up with the schema
-        if not disable_validation:
-            validation.validate_user_submission(data_path, schema)
+        bag_stream = data_path if isinstance(data_path, archive.BagStream) else None
+        # A staged BDBag directory is removed however the submission ends, so it cannot
+        # get in the way of the next one
+        try:
+            if bag_stream:
+                data_path, archive_name = bag_stream.bag_path, bag_stream.name
+            else:
+                archive_name = os.path.basename(data_path)
+            # Raises exc.ValidationException if something doesn't match up with the schema
+            if not disable_validation and not validated:
+                validation.validate_user_submission(data_path, schema, mode=validation_mode)
+
+            # Name the archive by its content, so identical bags map to the same destination.
+            # A streamed archive does not exist until it is uploaded, so it keeps its name.
+            checksum = None
+            if not bag_stream:
+                checksum = globus_http.file_digest(data_path)
+                archive_name = globus_http.content_addressed_name(archive_name, checksum)
+
+            flow_info = self.remote_config["FLOWS"][self.service_instance]
+            dest_path = "{}{}".format(flow_info["cfde_ep_path"], archive_name)
+            data_url = "{}{}".format(flow_info["cfde_ep_url"], dest_path)
 
-        flow_info = self.remote_config["FLOWS"][self.service_instance]
-        dest_path = "{}{}".format(flow_info["cfde_ep_path"], os.path.basename(data_path))
-
-        logger.debug("Creating input for Flow")
-        flow_input = {
-            "cfde_ep_id": flow_info["cfde_ep_id"],
-            "cfde_ep_token": self.tokens[self.gcs_https_scope]["access_token"],
-            "dcc_id": dcc_id,
-            "funcx_endpoint": flow_info["funcx_endpoint"],
-            "funcx_function_id": flow_info["funcx_function_id"],
-            "test_sub": test_sub,
-            "deriva_server": server or self.get_deriva_server(),
-        }
-
-        if catalog_id:
-            flow_input["catalog_id"] = str(catalog_id)
-        if server:
-            flow_input["server"] = server
-        # If doing dry run, stop here before transferring data
-        if dry_run:
-            logger.debug("Flow input parameters (minus transfer fields):\n{}"
-                         .format(json.dumps(flow_input, indent=4, sort_keys=True)))
-            return {
-                "success": True,
-                "message": "Dry run validated successfully. No data was transferred."
+            logger.debug("Creating input for Flow")
+            flow_input = {
+                "cfde_ep_id": flow_info["cfde_ep_id"],
+                "cfde_ep_token": self.tokens[self.gcs_https_scope]["access_token"],
+                "dcc_id": dcc_id,
+                "funcx_endpoint": flow_info["funcx_endpoint"],
+                "funcx_function_id": flow_info["funcx_function_id"],
+                "test_sub": test_sub,
+                "deriva_server": server or self.get_deriva_server(),
             }
 
-        # Transfer data via globus
-        if globus:
-            local_endpoint = globus_sdk.LocalGlobusConnectPersonal().endpoint_id
-            logger.debug(f'Local endpoint: {local_endpoint}')
-            if not local_endpoint:
-                raise exc.EndpointUnavailable("Globus Connect Personal installation not found. To "
-                                              "install, please visit "
-                                              "https://www.globus.org/globus-connect-personal")
+            if catalog_id:
+                flow_input["catalog_id"] = str(catalog_id)
+            if server:
+                flow_input["server"] = server
+
+            # Skip the transfer when an earlier submission already uploaded this archive
+            if checksum and globus_http.is_uploaded(data_url, self.https_authorizer,
+                                                    os.path.getsize(data_path), checksum,
+                                                    session=self.session):
+                logger.info("'{}' is already on the server, skipping upload".format(data_url))
+                flow_input.update({
+                    "source_endpoint_id": False,
+                    "data_url": data_url,
+                    "data_sha256": checksum,
+                })
+
+            # Transfer data via globus
+            elif globus:
+                local_endpoint = globus_sdk.LocalGlobusConnectPersonal().endpoint_id
+                logger.debug(f'Local endpoint: {local_endpoint}')
+                if not local_endpoint:
+                    raise exc.EndpointUnavailable("Globus Connect Personal installation not "
+                                                  "found. To install, please visit "
+                                                  "https://www.globus.org/globus-connect-personal")
+                try:
+                    self.retry_policy.call("transfer", self.transfer_client.operation_ls,
+                                           local_endpoint, path=os.path.dirname(data_path))
+                    logger.debug("Successfully connected to Globus Connect Personal endpoint "
+                                 f"'{local_endpoint}'")
+                except globus_sdk.exc.TransferAPIError as e:
+
+                    # Unable to connect
+                    if e.http_status == 502:
+                        raise exc.EndpointUnavailable(f"Unable to connect to local endpoint "
+                                                      f"'{local_endpoint}'. Please verify that "
+                                                      "Globus Connect Personal is running.")
+                    # Forbidden
+                    elif e.http_status == 403:
+                        raise exc.EndpointUnavailable(f"Unable to access '{data_path}' on local "
+                                                      f"endpoint '{local_endpoint}'. Please set "
+                                                      "the access preferences in Globus Connect "
+                                                      "Personal to permit access.")
+
+                    else:
+                        raise exc.EndpointUnavailable(e.message)
+
+                # Populate Transfer fields in Flow
+                flow_input.update({
+                    "cfde_ep_path": dest_path,
+                    "cfde_ep_url": flow_info["cfde_ep_url"],
+                    "is_directory": False,
+                    "source_endpoint_id": local_endpoint,
+                    "source_path": data_path,
+                    "data_sha256": checksum,
+                })
+
+            # Otherwise, HTTP PUT the BDBag on the server
+            else:
+                logger.debug("Uploading with HTTPS PUT")
+                if bag_stream:
+                    upload_res = globus_http.upload_stream(bag_stream, data_url,
+                                                           self.https_authorizer,
+                                                           session=self.session)
+                else:
+                    upload_res = globus_http.upload(data_path, data_url, self.https_authorizer,
+                                                    chunk_size=upload_chunk_size,
+                                                    workers=upload_workers, checksum=checksum,
+                                                    session=self.session)
+                logger.debug("HTTP session: {}".format(self.session.stats))
+                if not upload_res["success"]:
+                    return upload_res
+                flow_input.update({
+                    "source_endpoint_id": False,
+                    "data_url": data_url,
+                    # Hashed from the bytes as they were sent
+                    "data_sha256": upload_res.get("sha256", checksum),
+                })
+                if upload_res.get("md5"):
+                    flow_input["data_md5"] = upload_res["md5"]
+
+            logger.debug("Flow input populated:\n{}".format(json.dumps(flow_input, indent=4,
+                                                                       sort_keys=True)))
+            # Get Flow scope
+            flow_id = flow_info["flow_id"]
+            # Start Flow
+            logger.debug("Starting Flow - Submitting data")
             try:
-                self.transfer_client.operation_ls(local_endpoint, path=os.path.dirname(data_path))
-                logger.debug("Successfully connected to Globus Connect Personal endpoint "
-                             f"'{local_endpoint}'")
-            except globus_sdk.exc.TransferAPIError as e:
-
-                # Unable to connect
-                if e.http_status == 502:
-                    raise exc.EndpointUnavailable(f"Unable to connect to local endpoint "
-                                                  f"'{local_endpoint}'. Please verify that Globus "
-                                                  "Connect Personal is running.")
-                # Forbidden
-                elif e.http_status == 403:
-                    raise exc.EndpointUnavailable(f"Unable to access '{data_path}' on local "
-                                                  f"endpoint '{local_endpoint}'. Please set the "
-                                                  "access preferences in Globus Connect Personal "
-                                                  "to permit access.")
-
+                # Only retry failures where the Flow cannot have started, to avoid running twice
+                run_policy = self.retry_policy.copy(retry_statuses=retry.UNPROCESSED_STATUSES,
+                                                    retry_read_timeouts=False)
+                flow_res = run_policy.call("flows", self.flow_client.run_flow,
+                                           flow_id, self.flow_scope, flow_input)
+            except globus_sdk.GlobusAPIError as e:
+                if e.http_status == 404:
+                    return {
+                        "success": False,
+                        "error": ("Could not access ingest Flow. Are you in the CFDE DERIVA "
+                                  "Demo Globus Group? Check your membership or apply for access "
+                                  "here: https://app.globus.org/groups/a437abe3-c9a4-11e9-b441-"
+                                  "0efb3ba9a670/about")
+                    }
                 else:
-                    raise exc.EndpointUnavailable(e.message)
-
-            # Populate Transfer fields in Flow
-            flow_input.update({
-                "cfde_ep_path": dest_path,
-                "cfde_ep_url": flow_info["cfde_ep_url"],
-                "is_directory": False,
-                "source_endpoint_id": local_endpoint,
-                "source_path": data_path,
-            })
-
-        # Otherwise, HTTP PUT the BDBag on the server
-        else:
-            logger.debug("Uploading with HTTPS PUT")
-            data_url = "{}{}".format(flow_info["cfde_ep_url"], dest_path)
-            globus_http.upload(data_path, data_url, self.https_authorizer)
-            flow_input.update({
-                "source_endpoint_id": False,
-                "data_url": data_url,
-            })
-
-        logger.debug("Flow input populated:\n{}".format(json.dumps(flow_input, indent=4,
-                                                                   sort_keys=True)))
-        # Get Flow scope
-        flow_id = flow_info["flow_id"]
-        # Start Flow
-        logger.debug("Starting Flow - Submitting data")
-        try:
-            flow_res = self.flow_client.run_flow(flow_id, self.flow_scope, flow_input)
-        except globus_sdk.GlobusAPIError as e:
-            if e.http_status == 404:
-                return {
-                    "success": False,
-                    "error": ("Could not access ingest Flow. Are you in the CFDE DERIVA "
-                              "Demo Globus Group? Check your membership or apply for access "
-                              "here: https://app.globus.org/groups/a437abe3-c9a4-11e9-b441-"
-                              "0efb3ba9a670/about")
-                }
-            else:
-                raise
-        self.last_flow_run = {
-            "flow_id": flow_id,
-            "flow_instance_id": flow_res["action_id"]
-        }
-        logger.debug("Flow started successfully.")
-
-        return {
-            "success": True,
-            "message": ("Started DERIVA ingest flow\nYour dataset has been "
-                        "submitted\nYou can check the progress with: cfde-submit status\n"),
-            "flow_id": flow_id,
-            "flow_instance_id": flow_res["action_id"],
-            "cfde_dest_path": dest_path,
-            "http_link": "{}{}".format(flow_info["cfde_ep_url"], dest_path),
-            "globus_web_link": ("https://app.globus.org/file-manager?origin_id={}&origin_path={}"
-                                .format(flow_info["cfde_ep_id"], os.path.dirname(dest_path)))
-        }
+                    raise
+            self.last_flow_run = {
+                "flow_id": flow_id,
+                "flow_instance_id": flow_res["action_id"]
+            }
+            logger.debug("Flow started successfully.")
+
+            return {
+                "success": True,
+                "message": ("Started DERIVA ingest flow\nYour dataset has been "
+                            "submitted\nYou can check the progress with: cfde-submit status\n"),
+                "flow_id": flow_id,
+                "flow_instance_id": flow_res["action_id"],
+                "cfde_dest_path": dest_path,
+                "http_link": "{}{}".format(flow_info["cfde_ep_url"], dest_path),
+                "globus_web_link": ("https://app.globus.org/file-manager?origin_id={}&"
+                                    "origin_path={}".format(flow_info["cfde_ep_id"],
+                                                            os.path.dirname(dest_path)))
+            }
+        finally:
+            if bag_stream:
+                bag_stream.cleanup()
 
     def check_status(self, flow_id=None, flow_instance_id=None, raw=False):
         """Check the status of a Flow. By default, check the status of the last
@@ -509,9 +641,10 @@ class CfdeClient:
             raise ValueError("Flow not started and IDs not specified.")
 
         # Get Flow scope and status
-        flow_def = self.flow_client.get_flow(flow_id)
-        flow_status = self.flow_client.flow_action_status(flow_id, flow_def["globus_auth_scope"],
-                                                          flow_instance_id).data
+        flow_def = self.get_flow_retry_500s(flow_id)
+        flow_status = self.retry_policy.call("flows", self.flow_client.flow_action_status,
+                                             flow_id, flow_def["globus_auth_scope"],
+                                             flow_instance_id).data
         flow_info = self.remote_config["FLOWS"][self.service_instance]
 
         clean_status = ("\nStatus of {} (Flow ID {})\nThis instance ID: {}\n\n"
@@ -589,9 +722,9 @@ class CfdeClient:
         """
         server = self.get_deriva_server()
         url = f"https://{server}/ermrest/catalog/registry/entity/CFDE:dcc"
-        with urllib.request.urlopen(url) as page:
-            data = json.loads(page.read().decode())
-            dccs = [x['id'] for x in data]
+        dcc_res = self.session.get(url)
+        dcc_res.raise_for_status()
+        dccs = [x['id'] for x in dcc_res.json()]
         return dcc in dccs
 
     def get_deriva_server(self):
@@ -54,8 +54,91 @@ CONFIG = {
     "HTTPS_SCOPE": "https://auth.globus.org/scopes/0e57d793-f1ac-4eeb-a30f-643b082d68ec/https",
     "AUTOMATE_SCOPES": list(globus_automate_client.flows_client.ALL_FLOW_SCOPES),
     "TRANSFER_SCOPE": "urn:globus:auth:scope:transfer.api.globus.org:all",
-    # Format for BDBag archives
-    "ARCHIVE_FORMAT": "zip"
+    # Codec for BDBag archives (see cfde_submit.archive.CODECS), and its compression level.
+    # A level of None uses the codec's default.
+    "ARCHIVE_CODEC": "deflate",
+    "ARCHIVE_LEVEL": None,
+    # Threads that compress archives. None uses one per CPU.
+    "ARCHIVE_THREADS": None,
+    # Files that are already compressed, which are stored in zip archives without deflating
+    "PRECOMPRESSED_EXTENSIONS": [
+        ".gz", ".tgz", ".bz2", ".xz", ".zst", ".zip", ".7z", ".bam", ".cram", ".bcf",
+        ".parquet", ".h5", ".hdf5", ".jpg", ".jpeg", ".png", ".gif", ".mp4", ".mkv",
+    ],
+    # Data of at least this many bytes is transferred with Globus instead of HTTPS, when
+    # Globus Connect Personal is installed and neither was chosen
+    "GLOBUS_TRANSFER_THRESHOLD": 50 * 1024 ** 3,
+    # Rough bytes per second per core for hashing and each archive codec, to estimate how
+    # long a submission takes. See cfde_submit.scan
+    "ESTIMATED_RATES": {
+        "hash": 400 * 1024 * 1024,
+        "deflate": 40 * 1024 * 1024,
+        "store": 1024 * 1024 * 1024,
+        "zstd": 200 * 1024 * 1024,
+    },
+    # The number of largest files listed by the scan before a submission
+    "SCAN_LARGEST_FILES": 5,
+    # HTTPS uploads of archives larger than this are split into parts sent in parallel
+    "PARALLEL_UPLOAD_THRESHOLD": 256 * 1024 * 1024,
+    "UPLOAD_PART_SIZE": 32 * 1024 * 1024,
+    "UPLOAD_WORKERS": 8,
+    # Files and directories never put in a new BDBag, as patterns for
+    # cfde_submit.ignore.IgnoreRules. More can be listed in a .cfdeignore file.
+    "EXCLUDE_PATTERNS": [
+        ".cfdeignore", ".DS_Store", "Thumbs.db", "desktop.ini", "*.swp", "*.swo", "*~",
+        ".#*", "__pycache__/", ".ipynb_checkpoints/",
+    ],
+    # How data is staged in an output directory before it is bagged: "auto" (reflinks,
+    # else hardlinks, else copies), "reflink", "hardlink" or "copy". See cfde_submit.staging
+    "STAGING_MODE": "auto",
+    # Processes that hash BDBag payload files. None uses one per CPU.
+    "HASH_PROCESSES": None,
+    # Processes that validate the tables of a package concurrently. None uses one per CPU.
+    "VALIDATION_PROCESSES": None,
+    # How tables are validated: "full", by frictionless in memory, "streaming", in
+    # batches of VALIDATION_BATCH_ROWS rows with keys kept on disk, or "sampled", only the
+    # first VALIDATION_SAMPLE_HEAD rows and VALIDATION_SAMPLE_ROWS rows read at random.
+    # See cfde_submit.validation
+    "VALIDATION_MODE": "full",
+    "VALIDATION_BATCH_ROWS": 10000,
+    "VALIDATION_SAMPLE_HEAD": 1000,
+    "VALIDATION_SAMPLE_ROWS": 1000,
+    # How premade BDBags are checked against their manifests before they are uploaded:
+    # "none", "fast" (file lists and sizes) or "full" (checksums). See cfde_submit.verify
+    "BAG_VERIFY": "fast",
+    # Local caches that speed up repeated submissions of the same data
+    "CACHE_DIR": os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+                              "cfde-submit"),
+    # Reuse the digests of payload files that have not changed since the last submission
+    "CHECKSUM_CACHE": True,
+    "CHECKSUM_CACHE_MAX_ENTRIES": 1000000,
+    # Reuse the archive of a BDBag built from the same data with the same options. Off by
+    # default, as archives are then kept in CACHE_DIR rather than next to the data.
+    "ARCHIVE_CACHE": False,
+    "ARCHIVE_CACHE_MAX_BYTES": 20 * 1024 ** 3,
+    # Reuse the result of validating a table that has not changed, nor has its schema
+    "VALIDATION_CACHE": True,
+    "VALIDATION_CACHE_MAX_ENTRIES": 100000,
+    # Digests computed from the bytes of an archive as it is uploaded. "md5" may be added.
+    "UPLOAD_DIGESTS": ["sha256"],
+    # Size of the pieces a streamed BDBag archive is sent in
+    "STREAM_CHUNK_SIZE": 8 * 1024 * 1024,
+    # Conservative upload rate (bytes/second) used to estimate how long an upload will take,
+    # and how much longer than that the HTTPS token must stay valid
+    "UPLOAD_ESTIMATED_RATE": 5 * 1024 * 1024,
+    "TOKEN_EXPIRY_MARGIN": 300,
+    # Shared HTTP session: connections kept open per host, and (connect, read) timeouts
+    "HTTP_POOL_SIZE": 16,
+    "HTTP_TIMEOUT": (10, 300),
+    # Retry policy for every remote call. See cfde_submit.retry.RetryPolicy
+    "RETRY": {
+        "max_attempts": 5,
+        "base_delay": 1.0,
+        "max_delay": 30.0,
+        "deadline": 300.0,
+        "failure_threshold": 5,
+        "reset_timeout": 60.0,
+    },
 }
 # Add all necessary scopes together for Auth call
 CONFIG["ALL_SCOPES"] = CONFIG["AUTOMATE_SCOPES"] + [CONFIG["HTTPS_SCOPE"]]
@@ -11,11 +11,21 @@ class CfdeClientException(Exception):
     pass
 
 
+class CorruptBag(CfdeClientException):
+    """A premade BDBag does not match its manifests"""
+    pass
+
+
 class EndpointUnavailable(CfdeClientException):
     """Unable to view globus connect personal endpoint"""
     pass
 
 
+class InsufficientSpace(CfdeClientException):
+    """There is not enough free disk space to bag and archive the data"""
+    pass
+
+
 class InvalidInput(CfdeClientException):
     """A dataset given to the client was not valid"""
 
@@ -40,6 +50,21 @@ class RemoteConfigException(CfdeClientException):
     pass
 
 
+class ServiceUnavailable(CfdeClientException):
+    """A remote service failed repeatedly, and is not being contacted for now"""
+    pass
+
+
+class UploadIncomplete(CfdeClientException):
+    """The server did not assemble an uploaded file from the ranges it was sent"""
+    pass
+
+
+class RangesNotSupported(UploadIncomplete):
+    """The server stored a file uploaded in ranges as if it ignored Content-Range"""
+    pass
+
+
 class SubmissionsUnavailable(CfdeClientException):
     pass
 
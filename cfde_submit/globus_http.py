@@ -1,35 +1,188 @@
+import base64
+import hashlib
+import json
 import logging
+import os
 import requests
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cfde_submit import CONFIG, exc
 
 
 logger = logging.getLogger(__name__)
 
+# Bytes read from each end of an archive to fingerprint it for the upload journal
+JOURNAL_FINGERPRINT_BYTES = 1024 * 1024
+# Archive extensions kept intact when a content hash is added to a file name
+ARCHIVE_EXTENSIONS = [".tar.gz", ".tar.zst", ".tgz", ".tar", ".zip"]
+
+
+def file_digest(data_path):
+    """Return the hex SHA-256 digest of a file.
+
+    Archives written by cfde_submit.archive.write_archive() are hashed as they are
+    written, into a ``.sha256`` file next to them. That digest is used instead of
+    reading the archive again, unless the archive was modified after it. The upload
+    verifies the digest either way.
+    """
+    checksum_path = data_path + ".sha256"
+    try:
+        if os.path.getmtime(checksum_path) >= os.path.getmtime(data_path):
+            with open(checksum_path) as f:
+                checksum, name = f.read().split()[:2]
+            if name == os.path.basename(data_path):
+                return checksum
+    except (OSError, ValueError):
+        pass
+    digest = hashlib.sha256()
+    with open(data_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def content_addressed_name(filename, checksum):
+    """Add the start of a content checksum to a file name, before its archive extension,
+    so identical archives always map to the same destination."""
+    for ext in ARCHIVE_EXTENSIONS:
+        if filename.endswith(ext):
+            return "{}_{}{}".format(filename[:-len(ext)], checksum[:16], ext)
+    root, ext = os.path.splitext(filename)
+    return "{}_{}{}".format(root, checksum[:16], ext)
+
+
+def is_uploaded(destination_url, authorizer, size, checksum, session=None):
+    """Check whether destination_url already holds an archive with this size and checksum.
 
-def upload(data_path, destination_url, authorizer):
+    The size is compared with a HEAD request, and the checksum with the ``.sha256``
+    sidecar file written next to the archive by upload().
+
+    Arguments:
+        destination_url (str): The remote URL of the archive.
+        authorizer (globus_sdk.AccessTokenAuthorizer): A valid Globus SDK authorizer
+            with an access_token scoped for the Globus HTTPS server.
+        size (int): The size of the local archive in bytes.
+        checksum (str): The hex SHA-256 digest of the local archive.
+        session (requests.Session): The session to send requests with, such as
+            CfdeClient.session. Default None, to open a new connection per request.
+    """
+    http = session or requests
+    headers = {}
+    authorizer.set_authorization_header(headers)
+    head_res = http.head(destination_url, headers=headers)
+    if head_res.status_code != 200 or head_res.headers.get("Content-Length") != str(size):
+        return False
+    sidecar_res = http.get(destination_url + ".sha256", headers=headers)
+    if sidecar_res.status_code != 200:
+        return False
+    return sidecar_res.text.split()[:1] == [checksum]
+
+
+def upload(data_path, destination_url, authorizer, chunk_size=None, workers=None,
+           checksum=None, session=None):
     """
     Arguments:
         data_path (str): The path to the data to ingest into DERIVA. The path can be:
                 1) A directory to be formatted into a BDBag
-                2) A Git repository to be copied into a BDBag
+                2) A Git repository, whose files committed at HEAD are bagged
                 3) A premade BDBag directory
                 4) A premade BDBag in an archive file
         destination_url (str): The remote URL to use for uploading the data_path file
         authorizer (globus_sdk.AccessTokenAuthorizer): A valid Globus SDK authorizer
             with an access_token scoped for the Globus HTTPS server. NOTE:
             This differs between http servers, make sure you passed in the correct one!
+        chunk_size (int): When set, upload the file in byte ranges of this size and
+            record each range the server confirms in a journal next to data_path.
+            Re-running an interrupted upload then only sends the missing ranges.
+            If the server turns out to ignore the ranges, the file is sent again in a
+            single PUT. 0 always sends the file in a single PUT.
+            Default None, to send files larger than CONFIG["PARALLEL_UPLOAD_THRESHOLD"]
+            in ranges of CONFIG["UPLOAD_PART_SIZE"], and smaller files in a single PUT.
+        workers (int): The number of ranges to send concurrently when uploading in
+            ranges. Default None, to use CONFIG["UPLOAD_WORKERS"].
+        checksum (str): The expected hex SHA-256 digest of data_path. The upload fails if
+            the bytes sent do not match it. The digest of the bytes sent is written to
+            a ``.sha256`` sidecar next to the uploaded file, so a later submission of the
+            same archive can be detected with is_uploaded(). Default None.
+        session (requests.Session): The session to send requests with, such as
+            CfdeClient.session. Default None, to open a new connection per request.
+
+    Returns:
+        dict: The upload results.
+            success (bool): Did the server accept the whole file?
+            error (str): Why the upload failed, if it did.
+            bytes (int): The number of bytes sent by this call.
+            seconds (float): The wall-clock time spent uploading.
+            throughput (float): The aggregate upload rate in bytes per second.
+            sha256, md5 (str): Hex digests of the uploaded file, computed from the
+                bytes as they were sent, for each algorithm in CONFIG["UPLOAD_DIGESTS"].
+                Missing for a resumed upload, where only part of the file was sent.
     """
+    size = os.path.getsize(data_path)
+    preflight_error = preflight(destination_url, authorizer, size, session=session)
+    if preflight_error:
+        return preflight_error
+    if chunk_size is None and size > CONFIG["PARALLEL_UPLOAD_THRESHOLD"]:
+        chunk_size = CONFIG["UPLOAD_PART_SIZE"]
+    if chunk_size:
+        try:
+            upload_res = upload_resumable(data_path, destination_url, authorizer, chunk_size,
+                                          workers=workers or CONFIG["UPLOAD_WORKERS"],
+                                          checksum=checksum, session=session)
+        except exc.RangesNotSupported as e:
+            logger.warning("{} Uploading it again in a single request.".format(e))
+            upload_res = upload_single(data_path, destination_url, authorizer,
+                                       session=session)
+    else:
+        upload_res = upload_single(data_path, destination_url, authorizer, session=session)
+    if not upload_res["success"]:
+        return upload_res
+    sent_checksum = upload_res.get("sha256")
+    if checksum and sent_checksum and sent_checksum != checksum:
+        return {
+            "success": False,
+            "error": ("'{}' changed while it was uploaded: expected SHA-256 {} but sent {}. "
+                      "Please submit it again.".format(data_path, checksum, sent_checksum)),
+        }
+    if checksum or sent_checksum:
+        _upload_checksum(destination_url, authorizer, checksum or sent_checksum, session)
+    return upload_res
+
+
+def upload_single(data_path, destination_url, authorizer, session=None):
+    """Upload a file in a single PUT.
+
+    Arguments:
+        data_path (str): The archive file to upload.
+        destination_url (str): The remote URL to use for uploading the data_path file
+        authorizer (globus_sdk.AccessTokenAuthorizer): A valid Globus SDK authorizer
+            with an access_token scoped for the Globus HTTPS server.
+        session (requests.Session): The session to send requests with, such as
+            CfdeClient.session. Default None, to open a new connection per request.
+
+    Returns:
+        dict: The upload results, as described in upload().
+    """
+    http = session or requests
     headers = {}
     authorizer.set_authorization_header(headers)
+    started = time.monotonic()
+    hasher = StreamHasher()
 
     with open(data_path, 'rb') as bag_file:
-        put_res = requests.put(destination_url, data=bag_file, headers=headers)
+        put_res = http.put(destination_url, data=_HashingReader(bag_file, hasher),
+                           headers=headers)
 
     # Regenerate headers on 401
     if put_res.status_code == 401:
         authorizer.handle_missing_authorization()
         authorizer.set_authorization_header(headers)
         with open(data_path, 'rb') as bag_file:
-            put_res = requests.put(destination_url, data=bag_file, headers=headers)
+            hasher.reset()
+            put_res = http.put(destination_url, data=_HashingReader(bag_file, hasher),
+                               headers=headers)
     # Error message on failed PUT or any unexpected response
     if put_res.status_code >= 300:
         return {
@@ -41,5 +194,474 @@ def upload(data_path, destination_url, authorizer):
         logger.warning("Warning: HTTP upload returned status code {}, "
                        "which was unexpected.".format(put_res.status_code))
 
+    mismatch = hasher.mismatch(put_res)
+    if mismatch:
+        return {"success": False, "error": mismatch}
+
     logger.info("Upload successful to '{}': {} {}".format(destination_url, put_res.status_code,
                                                           put_res.content))
+    return _upload_stats(os.path.getsize(data_path), started, hasher)
+
+
+def preflight(destination_url, authorizer, size=None, session=None):
+    """Confirm the authorizer's token is accepted for destination_url before any upload
+    body is sent, so a rejected token never costs a full re-upload.
+
+    If the token will expire before an upload of ``size`` bytes is expected to finish
+    (at CONFIG["UPLOAD_ESTIMATED_RATE"], plus CONFIG["TOKEN_EXPIRY_MARGIN"]), it is
+    renewed first. Only authorizers that can renew tokens, such as a
+    RefreshTokenAuthorizer, are affected by this.
+
+    Arguments:
+        destination_url (str): The remote URL the data will be uploaded to.
+        authorizer (globus_sdk.AccessTokenAuthorizer): The authorizer for the upload.
+        size (int): The number of bytes that will be uploaded, if known. Default None.
+        session (requests.Session): The session to send requests with, such as
+            CfdeClient.session. Default None, to open a new connection per request.
+
+    Returns:
+        dict: An upload result describing the failure if the token was rejected,
+            otherwise None.
+    """
+    expires_at = getattr(authorizer, "expires_at", None)
+    if isinstance(expires_at, (int, float)):
+        needed = CONFIG["TOKEN_EXPIRY_MARGIN"] + (size or 0) / CONFIG["UPLOAD_ESTIMATED_RATE"]
+        if expires_at < time.time() + needed:
+            logger.debug("HTTPS token expires in {:.0f}s, before the estimated end of the "
+                         "upload. Renewing it first.".format(expires_at - time.time()))
+            authorizer.handle_missing_authorization()
+
+    http = session or requests
+    headers = {}
+    authorizer.set_authorization_header(headers)
+    head_res = http.head(destination_url, headers=headers)
+    if head_res.status_code == 401:
+        logger.debug("HTTPS token rejected by '{}', renewing it".format(destination_url))
+        authorizer.handle_missing_authorization()
+        authorizer.set_authorization_header(headers)
+        head_res = http.head(destination_url, headers=headers)
+    # Any other response, including 404 for a new object, means the token was accepted
+    if head_res.status_code in (401, 403):
+        return {
+            "success": False,
+            "error": ("Not authorized to upload BDBag to server (error {}). Please log out "
+                      "and log in again.".format(head_res.status_code))
+        }
+    return None
+
+
+def upload_resumable(data_path, destination_url, authorizer, chunk_size, workers=1,
+                     checksum=None, session=None):
+    """Upload a file as a series of ``Content-Range`` PUTs sent concurrently on a
+    bounded thread pool, journaling each range the server confirms so an interrupted
+    upload can pick up where it left off.
+
+    Ranges are read from disk in order by the calling thread and handed to the pool,
+    so at most ``workers`` ranges are held in memory at once. The calling thread also
+    hashes them as they are read, when the whole file is sent.
+
+    Once every range is confirmed, the object is checked with a HEAD request: its
+    ``Content-Length`` must be the size of the file, and any digest the server reports
+    must match the bytes sent (or ``checksum``, for a resumed upload). A server that
+    ignores ``Content-Range`` stores only the last range it received, and fails this
+    with exc.RangesNotSupported.
+
+    Arguments:
+        data_path (str): The archive file to upload.
+        destination_url (str): The remote URL to use for uploading the data_path file
+        authorizer (globus_sdk.AccessTokenAuthorizer): A valid Globus SDK authorizer
+            with an access_token scoped for the Globus HTTPS server.
+        chunk_size (int): The number of bytes to send in each range PUT.
+        workers (int): The number of range PUTs to run concurrently. Default 1.
+        checksum (str): The expected hex SHA-256 digest of data_path, compared with any
+            digest the server reports when the file was not hashed as it was sent.
+            Default None.
+        session (requests.Session): The session to send requests with, such as
+            CfdeClient.session. Default None, to open a new connection per request.
+
+    Returns:
+        dict: The upload results, as described in upload().
+
+    Raises:
+        cfde_submit.exc.UploadIncomplete: The server did not assemble the ranges into
+            the whole file.
+        cfde_submit.exc.RangesNotSupported: The server stored a file of the wrong size,
+            as it does when it ignores ``Content-Range``.
+    """
+    journal = UploadJournal(data_path, destination_url)
+    total = journal.size
+    headers = {}
+    authorizer.set_authorization_header(headers)
+    auth_lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers)
+    failures = []
+    sent = []
+    started = time.monotonic()
+
+    def put_part(chunk, start, end):
+        try:
+            put_res = _put_range(destination_url, chunk, start, total, headers, session)
+            # Regenerate headers on 401 - only this range needs to be resent
+            if put_res.status_code == 401:
+                with auth_lock:
+                    authorizer.handle_missing_authorization()
+                    authorizer.set_authorization_header(headers)
+                put_res = _put_range(destination_url, chunk, start, total, headers, session)
+            if put_res.status_code >= 300:
+                failures.append("Could not upload bytes {}-{} of BDBag to server (error {}):\n{}"
+                                .format(start, end - 1, put_res.status_code, put_res.content))
+                return
+            journal.confirm(start, end)
+            sent.append(end - start)
+        except Exception as e:
+            failures.append(e)
+        finally:
+            slots.release()
+
+    missing = journal.missing_ranges(chunk_size)
+    hasher = StreamHasher()
+    if len(missing) < len(range(0, total, chunk_size)):
+        logger.info("Resuming upload of '{}': {} of {} bytes already confirmed"
+                    .format(data_path, journal.confirmed_bytes(), total))
+        # Only part of the file is read, so it cannot be hashed
+        hasher = None
+    logger.debug("Uploading {} ranges of {} bytes with {} workers"
+                 .format(len(missing), chunk_size, workers))
+
+    with open(data_path, 'rb') as bag_file, ThreadPoolExecutor(max_workers=workers) as pool:
+        for start, end in missing:
+            slots.acquire()
+            if failures:
+                slots.release()
+                break
+            bag_file.seek(start)
+            chunk = bag_file.read(end - start)
+            if hasher:
+                hasher.update(chunk)
+            pool.submit(put_part, chunk, start, end)
+
+    for failure in failures:
+        if isinstance(failure, Exception):
+            raise failure
+    if failures:
+        return {
+            "success": False,
+            "error": "{}\nRe-run the submission to resume the upload.".format(failures[0]),
+        }
+
+    # The confirmed ranges cannot be trusted if the assembled object is wrong, so the
+    # journal is removed either way and the next attempt sends the whole file
+    journal.remove()
+    expected = hasher.hexdigests() if hasher else {}
+    if checksum and "sha256" not in expected:
+        expected["sha256"] = checksum
+    _verify_assembled(destination_url, authorizer, headers, total, expected, session)
+    stats = _upload_stats(sum(sent), started, hasher)
+    logger.info("Upload successful to '{}': {} bytes in ranges of {} at {:.1f} MiB/s"
+                .format(destination_url, total, chunk_size,
+                        stats["throughput"] / (1024 * 1024)))
+    return stats
+
+
+def _verify_assembled(destination_url, authorizer, headers, size, digests, session=None):
+    """Raise exc.UploadIncomplete unless the object at destination_url has the given
+    size, and every digest the server reports for it matches ``digests``."""
+    http = session or requests
+    head_res = http.head(destination_url, headers=headers)
+    if head_res.status_code == 401:
+        authorizer.handle_missing_authorization()
+        authorizer.set_authorization_header(headers)
+        head_res = http.head(destination_url, headers=headers)
+    if head_res.status_code != 200:
+        raise exc.UploadIncomplete("Could not check the uploaded BDBag at '{}' (error {}). "
+                                   "Please submit it again."
+                                   .format(destination_url, head_res.status_code))
+    length = head_res.headers.get("Content-Length")
+    if length != str(size):
+        raise exc.RangesNotSupported("The server assembled {} bytes at '{}' instead of {}. It "
+                                     "may not support ranged uploads."
+                                     .format(length, destination_url, size))
+    for name, server_digest in _reported_digests(head_res).items():
+        if name in digests and server_digest != digests[name]:
+            raise exc.UploadIncomplete("The server assembled different data at '{}' than was "
+                                       "sent ({} {} instead of {}). Please submit it again."
+                                       .format(destination_url, name, server_digest,
+                                               digests[name]))
+
+
+def upload_stream(bag_stream, destination_url, authorizer, session=None):
+    """Upload an archive that is generated while it is sent, using chunked transfer
+    encoding. Nothing is written to disk, and each file in the BDBag is read once.
+
+    Arguments:
+        bag_stream (cfde_submit.archive.BagStream): The archive to upload.
+        destination_url (str): The remote URL to use for uploading the archive
+        authorizer (globus_sdk.AccessTokenAuthorizer): A valid Globus SDK authorizer
+            with an access_token scoped for the Globus HTTPS server.
+        session (requests.Session): The session to send requests with, such as
+            CfdeClient.session. Default None, to open a new connection per request.
+
+    Returns:
+        dict: The upload results, as described in upload().
+    """
+    preflight_error = preflight(destination_url, authorizer, session=session)
+    if preflight_error:
+        return preflight_error
+    http = session or requests
+    headers = {}
+    authorizer.set_authorization_header(headers)
+    started = time.monotonic()
+    hasher = StreamHasher()
+    counter = _CountingIterator(bag_stream, hasher)
+
+    put_res = http.put(destination_url, data=counter, headers=headers)
+    # Regenerate headers on 401. The stream is regenerated, which reads the bag again.
+    if put_res.status_code == 401:
+        authorizer.handle_missing_authorization()
+        authorizer.set_authorization_header(headers)
+        hasher.reset()
+        counter = _CountingIterator(bag_stream, hasher)
+        put_res = http.put(destination_url, data=counter, headers=headers)
+    if put_res.status_code >= 300:
+        return {
+            "success": False,
+            "error": ("Could not upload BDBag to server (error {}):\n{}"
+                      .format(put_res.status_code, put_res.content))
+        }
+
+    mismatch = hasher.mismatch(put_res)
+    if mismatch:
+        return {"success": False, "error": mismatch}
+
+    stats = _upload_stats(counter.bytes, started, hasher)
+    logger.info("Upload successful to '{}': streamed {} bytes at {:.1f} MiB/s"
+                .format(destination_url, counter.bytes, stats["throughput"] / (1024 * 1024)))
+    return stats
+
+
+class _CountingIterator:
+    """Iterate over an iterable of bytes, keeping count of how many were produced and
+    hashing them."""
+
+    def __init__(self, iterable, hasher):
+        self.iterator = iter(iterable)
+        self.hasher = hasher
+        self.bytes = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self.iterator)
+        self.bytes += len(chunk)
+        self.hasher.update(chunk)
+        return chunk
+
+
+class _HashingReader:
+    """Wrap a file being uploaded, hashing each block as the HTTP client reads it.
+
+    Rewinding the file to the start, as a retry does, starts the hash over.
+    """
+
+    def __init__(self, file, hasher):
+        self.file = file
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.hasher.update(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        position = self.file.seek(offset, whence)
+        if position == 0:
+            self.hasher.reset()
+        else:
+            self.hasher.invalidate()
+        return position
+
+    def tell(self):
+        return self.file.tell()
+
+    def __len__(self):
+        return os.fstat(self.file.fileno()).st_size
+
+
+def _reported_digests(response):
+    """Return the hex digests the server reports for an object, by hashlib name, from
+    the ``Digest`` and ``Content-MD5`` headers of a response. Unparseable values are
+    ignored."""
+    reported = {}
+    for item in response.headers.get("Digest", "").split(","):
+        name, _, value = item.strip().partition("=")
+        if name.lower() in StreamHasher.DIGEST_HEADER_NAMES:
+            reported[StreamHasher.DIGEST_HEADER_NAMES[name.lower()]] = value
+    if response.headers.get("Content-MD5"):
+        reported["md5"] = response.headers["Content-MD5"]
+    digests = {}
+    for name, value in reported.items():
+        try:
+            digests[name] = base64.b64decode(value).hex()
+        except ValueError:
+            continue
+    return digests
+
+
+class StreamHasher:
+    """Hashes data as it is uploaded, with each algorithm in CONFIG["UPLOAD_DIGESTS"]."""
+
+    # Names of the algorithms in the RFC 3230 Digest header
+    DIGEST_HEADER_NAMES = {"sha-256": "sha256", "md5": "md5"}
+
+    def __init__(self, algorithms=None):
+        self.algorithms = list(algorithms or CONFIG["UPLOAD_DIGESTS"])
+        self.reset()
+
+    def reset(self):
+        self.hashes = {name: hashlib.new(name) for name in self.algorithms}
+        self.valid = True
+
+    def invalidate(self):
+        """Mark the hash as not covering the data sent, such as after a seek."""
+        self.valid = False
+
+    def update(self, data):
+        for digest in self.hashes.values():
+            digest.update(data)
+
+    def hexdigests(self):
+        """dict: The hex digest for each algorithm, or nothing if invalidated."""
+        if not self.valid:
+            return {}
+        return {name: digest.hexdigest() for name, digest in self.hashes.items()}
+
+    def mismatch(self, response):
+        """Compare the digests with any the server reports for the object it received,
+        in a ``Digest`` or ``Content-MD5`` header.
+
+        Returns:
+            str: An error message if a digest differs, otherwise None.
+        """
+        sent = self.hexdigests()
+        for name, server_digest in _reported_digests(response).items():
+            if name in sent and server_digest != sent[name]:
+                return ("The server received different data than was sent ({} {} instead of "
+                        "{}). Please submit it again.".format(name, server_digest, sent[name]))
+        return None
+
+
+def _upload_checksum(destination_url, authorizer, checksum, session):
+    headers = {}
+    authorizer.set_authorization_header(headers)
+    # Same format as sha256sum output
+    sidecar = "{}  {}\n".format(checksum, destination_url.rsplit("/", 1)[-1]).encode()
+    put_res = (session or requests).put(destination_url + ".sha256", data=sidecar,
+                                        headers=headers)
+    if put_res.status_code >= 300:
+        # The archive itself is uploaded, only skipping a later re-upload is affected
+        logger.warning("Unable to upload checksum for '{}' (error {})"
+                       .format(destination_url, put_res.status_code))
+
+
+def _put_range(destination_url, chunk, start, total, headers, session):
+    range_headers = dict(headers)
+    range_headers["Content-Range"] = "bytes {}-{}/{}".format(start, start + len(chunk) - 1,
+                                                             total)
+    return (session or requests).put(destination_url, data=chunk, headers=range_headers)
+
+
+def _upload_stats(num_bytes, started, hasher=None):
+    seconds = time.monotonic() - started
+    stats = {
+        "success": True,
+        "bytes": num_bytes,
+        "seconds": seconds,
+        "throughput": num_bytes / seconds if seconds else 0.0,
+    }
+    if hasher:
+        stats.update(hasher.hexdigests())
+    return stats
+
+
+class UploadJournal:
+    """Local record of the byte ranges of an archive that the server has confirmed.
+
+    The journal is stored next to the archive as ``<archive>.upload.json``. It is only
+    reused when the destination URL, size and a fingerprint of the first and last
+    bytes of the archive all match, so a rebuilt archive with different content always
+    starts a fresh upload. For zip archives the tail holds the central directory, with
+    the CRC and size of every member, so any change in content changes the fingerprint.
+    """
+
+    def __init__(self, data_path, destination_url):
+        self.path = "{}.upload.json".format(data_path)
+        self.destination_url = destination_url
+        self.size = os.path.getsize(data_path)
+        self.fingerprint = self._fingerprint(data_path, self.size)
+        self.confirmed = []
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        if (saved.get("url") == destination_url and saved.get("size") == self.size
+                and saved.get("fingerprint") == self.fingerprint):
+            self.confirmed = [tuple(r) for r in saved.get("confirmed", [])]
+        else:
+            logger.debug("Discarding stale upload journal '{}'".format(self.path))
+
+    @staticmethod
+    def _fingerprint(data_path, size):
+        digest = hashlib.sha256()
+        with open(data_path, 'rb') as f:
+            digest.update(f.read(JOURNAL_FINGERPRINT_BYTES))
+            if size > JOURNAL_FINGERPRINT_BYTES:
+                f.seek(max(JOURNAL_FINGERPRINT_BYTES, size - JOURNAL_FINGERPRINT_BYTES))
+                digest.update(f.read())
+        return digest.hexdigest()
+
+    def is_confirmed(self, start, end):
+        return any(c_start <= start and end <= c_end for c_start, c_end in self.confirmed)
+
+    def confirmed_bytes(self):
+        return sum(end - start for start, end in self.confirmed)
+
+    def missing_ranges(self, chunk_size):
+        """Return the (start, end) ranges of size chunk_size not yet confirmed."""
+        ranges = []
+        for start in range(0, self.size, chunk_size):
+            end = min(start + chunk_size, self.size)
+            if not self.is_confirmed(start, end):
+                ranges.append((start, end))
+        return ranges
+
+    def confirm(self, start, end):
+        """Record a range as confirmed, merging it with any adjacent ranges."""
+        with self.lock:
+            merged = []
+            for c_start, c_end in sorted(self.confirmed + [(start, end)]):
+                if merged and c_start <= merged[-1][1]:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], c_end))
+                else:
+                    merged.append((c_start, c_end))
+            self.confirmed = merged
+            self.save()
+
+    def save(self):
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                "url": self.destination_url,
+                "size": self.size,
+                "fingerprint": self.fingerprint,
+                "confirmed": self.confirmed,
+            }, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
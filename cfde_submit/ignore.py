@@ -0,0 +1,99 @@
+import fnmatch
+import logging
+import os
+
+from cfde_submit import CONFIG
+
+logger = logging.getLogger(__name__)
+
+# Patterns in this file, at the top of a directory, are excluded from its BDBag
+IGNORE_FILE = ".cfdeignore"
+
+
+class IgnoreRules:
+    """Patterns of files and directories to leave out of a BDBag, in the style of
+    ``.gitignore``:
+
+        *.swp       Matches a name anywhere in the tree.
+        scratch/    A trailing slash only matches directories.
+        out/*.tmp   A pattern with a slash matches the path from the top of the tree.
+                    A leading slash is allowed, and ``*`` also matches slashes.
+        !keep.swp   A leading ``!`` includes what an earlier pattern excluded, unless a
+                    directory containing it is excluded.
+        # comment   Blank lines and comments are ignored.
+
+    The last pattern that matches a path decides whether it is excluded.
+    """
+
+    def __init__(self, patterns=()):
+        self.rules = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+            include = pattern.startswith("!")
+            pattern = pattern.lstrip("!")
+            dir_only = pattern.endswith("/")
+            anchored = "/" in pattern.rstrip("/")
+            pattern = pattern.strip("/")
+            if pattern:
+                self.rules.append((pattern, anchored, dir_only, include))
+
+    @classmethod
+    def load(cls, path, patterns=None):
+        """The rules for a directory: CONFIG["EXCLUDE_PATTERNS"], then those in its
+        IGNORE_FILE, if it has one, then patterns."""
+        rules = list(CONFIG["EXCLUDE_PATTERNS"])
+        ignore_file = os.path.join(path, IGNORE_FILE)
+        if os.path.isfile(ignore_file):
+            logger.debug("Reading exclude patterns from '{}'".format(ignore_file))
+            with open(ignore_file) as f:
+                rules.extend(f.read().splitlines())
+        rules.extend(patterns or [])
+        return cls(rules)
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match(self, relpath, is_dir=False):
+        """Is this path excluded by its own name, whether or not a directory above it is?
+
+        Arguments:
+            relpath (str): The path from the top of the tree, with "/" or os.sep.
+            is_dir (bool): Is the path a directory?
+        """
+        relpath = relpath.replace(os.sep, "/").strip("/")
+        name = relpath.rsplit("/", 1)[-1]
+        excluded = False
+        for pattern, anchored, dir_only, include in self.rules:
+            if dir_only and not is_dir:
+                continue
+            if fnmatch.fnmatchcase(relpath if anchored else name, pattern):
+                excluded = not include
+        return excluded
+
+    def excludes(self, relpath, is_dir=False):
+        """Is this path excluded, by its own name or a directory above it?"""
+        parts = relpath.replace(os.sep, "/").strip("/").split("/")
+        return any(self.match("/".join(parts[:i]), is_dir=True) for i in range(1, len(parts))) \
+            or self.match(relpath, is_dir)
+
+    def walk(self, top):
+        """Like ``os.walk(top, followlinks=True)``, without anything excluded."""
+        for root, dirs, files in os.walk(top, followlinks=True):
+            relroot = os.path.relpath(root, top)
+            relroot = "" if relroot == os.curdir else relroot + os.sep
+            dirs[:] = [d for d in dirs if not self.match(relroot + d, is_dir=True)]
+            files = [f for f in files if not self.match(relroot + f)]
+            yield root, dirs, files
+
+    def any_excluded(self, top):
+        """Does anything in the tree at top match these rules?"""
+        for root, dirs, files in os.walk(top, followlinks=True):
+            relroot = os.path.relpath(root, top)
+            relroot = "" if relroot == os.curdir else relroot + os.sep
+            if any(self.match(relroot + f) for f in files):
+                return True
+            if any(self.match(relroot + d, is_dir=True) for d in dirs):
+                return True
+        return False
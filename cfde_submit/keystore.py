@@ -0,0 +1,91 @@
+import hashlib
+import os
+import sqlite3
+
+# Keys looked up in one query, under SQLite's limit on query parameters
+QUERY_KEYS = 500
+
+
+def key_digest(cells):
+    """A fixed-size digest of the cells of a key, for comparing keys without keeping
+    their values."""
+    return hashlib.blake2b(repr(tuple(cells)).encode(), digest_size=16).digest()
+
+
+class KeyStore:
+    """Sets of keys that may not fit in memory, kept in a SQLite database on disk, each
+    key stored as its key_digest() with the row position it was first seen at.
+    SQLite's page cache is limited to cache_bytes, so memory use does not grow with the
+    number of keys.
+    """
+
+    def __init__(self, path, cache_bytes=64 * 1024 * 1024):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA cache_size = {}".format(-(cache_bytes // 1024)))
+        # The database is thrown away after use, so it need not survive a crash
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.tables = set()
+
+    def close(self):
+        self.db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, name, keys):
+        """Add keys to the set called name.
+
+        Arguments:
+            name (str): The set, created if it does not exist.
+            keys (list): (digest, position) pairs.
+
+        Returns:
+            list: For each key, the position it was first seen at if it was already in
+                the set (or earlier in keys), else None.
+        """
+        table = self._table(name)
+        found = self._select(table, [digest for digest, _ in keys])
+        new = {}
+        previous = []
+        for digest, position in keys:
+            seen = found.get(digest) or new.get(digest)
+            if seen is None:
+                new[digest] = position
+            previous.append(seen)
+        with self.db:
+            self.db.executemany("INSERT INTO {} VALUES (?, ?)".format(table), new.items())
+        return previous
+
+    def contains(self, name, digests):
+        """Which of digests are in the set called name?
+
+        Returns:
+            list: A bool for each digest.
+        """
+        found = self._select(self._table(name), digests)
+        return [digest in found for digest in digests]
+
+    def _table(self, name):
+        table = "keys_{}".format(hashlib.sha1(name.encode()).hexdigest())
+        if table not in self.tables:
+            self.db.execute("CREATE TABLE IF NOT EXISTS {} (digest BLOB PRIMARY KEY, "
+                            "position INTEGER) WITHOUT ROWID".format(table))
+            self.tables.add(table)
+        return table
+
+    def _select(self, table, digests):
+        found = {}
+        digests = list(set(digests))
+        for start in range(0, len(digests), QUERY_KEYS):
+            chunk = digests[start:start + QUERY_KEYS]
+            found.update(self.db.execute(
+                "SELECT digest, position FROM {} WHERE digest IN ({})"
+                .format(table, ", ".join("?" * len(chunk))), chunk))
+        return found
@@ -5,7 +5,8 @@ import os
 import sys
 import traceback
 
-from cfde_submit import CfdeClient, CONFIG, exc, version
+from cfde_submit import (CfdeClient, CONFIG, archive, checksums, exc, scan, validation,
+                         version)
 
 DEFAULT_STATE_FILE = os.path.expanduser("~/.cfde_client.json")
 logger = logging.getLogger(__name__)
@@ -32,11 +33,42 @@ def cli():
               show_default=True)
 @click.option("--verbose", "-v", is_flag=True, default=False, show_default=True)
 @click.option("--server", default=None)
-@click.option("--globus", is_flag=True, default=False)
+@click.option("--globus/--https", default=None,
+              help="Transfer with Globus or HTTPS (default: chosen from the size of the data)")
+@click.option("--chunk-size", type=click.IntRange(min=0), default=None,
+              help="Upload in resumable chunks of this many MiB, or 0 for a single request")
+@click.option("--upload-workers", type=click.IntRange(min=1), default=None,
+              help="Number of chunks to upload in parallel")
+@click.option("--stream", is_flag=True, default=False,
+              help="Archive the BDBag while uploading it, without writing the archive to disk")
+@click.option("--archive-codec", type=click.Choice(["deflate", "store", "zstd"]), default=None,
+              help="How to archive the BDBag: deflate or store (zip), or zstd (tar.zst)")
+@click.option("--compression-level", type=click.IntRange(min=0, max=22), default=None,
+              help="Compression level: 0-9 for deflate, 1-22 for zstd")
+@click.option("--exclude", multiple=True, metavar="PATTERN",
+              help="Leave files matching this pattern out of the BDBag, like a line of "
+                   ".cfdeignore. May be repeated.")
+@click.option("--remote-files", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="A JSON manifest of payload files already hosted elsewhere, to list in the "
+                   "BDBag's fetch.txt instead of uploading")
+@click.option("--verify", "verify_mode", type=click.Choice(["none", "fast", "full"]),
+              default=None,
+              help="How to check a premade BDBag against its manifests before uploading it: "
+                   "file lists and sizes (fast, the default) or checksums (full)")
+@click.option("--validation-mode", type=click.Choice(["full", "streaming", "sampled"]),
+              default=None,
+              help="Validate tables in memory (full, the default), in batches with their "
+                   "keys kept on disk (streaming), for tables too large for memory, or only "
+                   "their headers and a sample of their rows (sampled), in seconds")
+@click.option("--cache-archive", is_flag=True, default=None,
+              help="Keep the BDBag archive in the local cache, to reuse it if the same data "
+                   "is submitted again, instead of writing it next to the data")
 @click.option("--bag-kwargs-file", type=click.Path(exists=True), default=None)
 @click.option("--client-state-file", type=click.Path(exists=True), default=None)
 def run(data_path, dcc_id, catalog, schema, output_dir, delete_dir, ignore_git, dry_run,
-        test_submission, verbose, server, globus, disable_validation, bag_kwargs_file,
+        test_submission, verbose, server, globus, chunk_size, upload_workers,
+        stream, archive_codec, compression_level, exclude, remote_files, verify_mode,
+        validation_mode, cache_archive, disable_validation, bag_kwargs_file,
         client_state_file):
     """Start the Globus Automate Flow to ingest CFDE data into DERIVA."""
 
@@ -112,11 +144,23 @@ def run(data_path, dcc_id, catalog, schema, output_dir, delete_dir, ignore_git,
                                                handle_git_repos=(not ignore_git), server=server,
                                                dry_run=dry_run, test_sub=test_submission,
                                                globus=globus, disable_validation=disable_validation,
+                                               upload_chunk_size=(chunk_size * 1024 * 1024
+                                                                  if chunk_size is not None
+                                                                  else None),
+                                               upload_workers=upload_workers, stream=stream,
+                                               archive_codec=archive_codec,
+                                               archive_level=compression_level,
+                                               exclude=list(exclude),
+                                               remote_files=remote_files,
+                                               verify_mode=verify_mode,
+                                               validation_mode=validation_mode,
+                                               cache_archive=cache_archive,
                                                **bag_kwargs)
         else:
             exit_on_exception("Aborted. No data submitted.")
     except (exc.SubmissionsUnavailable, exc.InvalidInput, exc.ValidationException,
-            exc.EndpointUnavailable, FileExistsError) as e:
+            exc.EndpointUnavailable, exc.ServiceUnavailable, exc.InsufficientSpace,
+            exc.CorruptBag, exc.UploadIncomplete, FileExistsError) as e:
         exit_on_exception(e)
     except Exception as e:
         exit_on_exception(repr(e), tb=True)
@@ -124,6 +168,8 @@ def run(data_path, dcc_id, catalog, schema, output_dir, delete_dir, ignore_git,
         if not start_res["success"]:
             print("Error during Flow startup: {}".format(start_res["error"]))
         else:
+            if start_res.get("plan"):
+                print(scan.format_plan(start_res["plan"]))
             print(start_res["message"])
             if not dry_run:
                 state["service_instance"] = cfde.service_instance
@@ -232,6 +278,52 @@ def reset():
             sys.exit("No cfde-submit settings exist, skipping")
 
 
+@cli.group()
+def cache():
+    """Inspect or clear the local caches that speed up repeated submissions."""
+    pass
+
+
+@cache.command()
+def verify():
+    """Re-hash every file in the checksum cache, and drop entries that are out of date."""
+    checksum_cache = checksums.ChecksumCache()
+    try:
+        res = checksum_cache.verify()
+    finally:
+        checksum_cache.close()
+    click.echo("Checked {checked} cached checksums: {valid} valid, {stale} out of date"
+               .format(**res))
+    if res["wrong"]:
+        click.secho("{} files changed without changing their size, modification time or "
+                    "inode, and will be hashed again:".format(len(res["wrong"])), fg="yellow")
+        for path in res["wrong"]:
+            click.echo("  " + path)
+
+
+@cache.command()
+@click.option("--stale-only", is_flag=True, default=False,
+              help="Only remove checksums of files that are gone or have changed, "
+                   "and keep cached archives and validation results")
+def purge(stale_only):
+    """Remove cached checksums, archives and validation results."""
+    checksum_cache = checksums.ChecksumCache()
+    try:
+        removed = checksum_cache.purge(stale_only=stale_only)
+    finally:
+        checksum_cache.close()
+    archives, results = 0, 0
+    if not stale_only:
+        archives = archive.ArchiveCache().purge()
+        validation_cache = validation.ValidationCache()
+        try:
+            results = validation_cache.purge()
+        finally:
+            validation_cache.close()
+    click.echo("Removed {} cached checksums, {} cached archives and {} cached validation "
+               "results".format(removed, archives, results))
+
+
 def set_log_level(level):
     """ Reconfigure logging to a specific log level """
     log_config = CONFIG["LOGGING"].copy()
@@ -0,0 +1,126 @@
+import glob
+import json
+import logging
+import os
+import posixpath
+from collections import OrderedDict
+
+from bdbag import bdbagit
+
+from cfde_submit import checksums, exc
+
+logger = logging.getLogger(__name__)
+
+# Checksums computed for a remote file that is also on disk, when the manifest gives none
+DEFAULT_ALGORITHMS = ["md5", "sha256"]
+
+
+def load_manifest(manifest_path):
+    """Read a remote file manifest: the payload files of a BDBag that are already
+    hosted elsewhere, to be listed in its ``fetch.txt`` instead of archived and uploaded.
+
+    The manifest is BDBag's own format, a JSON list (or one JSON object per line) of:
+
+        {"url": "https://example.org/reads.bam", "filename": "reads/reads.bam",
+         "length": 4000000000, "sha256": "..."}
+
+    where filename is the path from the top of the data directory. The length and
+    checksums may be left out when the file is also in the data directory, to be
+    computed by complete_manifest().
+
+    Returns:
+        list: The entries, as OrderedDicts.
+    """
+    try:
+        with open(manifest_path, encoding="utf-8") as f:
+            text = f.read()
+        if text.lstrip().startswith("{"):
+            entries = [json.loads(line, object_pairs_hook=OrderedDict)
+                       for line in text.splitlines() if line.strip()]
+        else:
+            entries = json.loads(text, object_pairs_hook=OrderedDict)
+    except (OSError, ValueError) as e:
+        raise exc.InvalidInput("Unable to read remote file manifest '{}': {}"
+                               .format(manifest_path, e))
+    if not isinstance(entries, list):
+        raise exc.InvalidInput("Remote file manifest '{}' must be a list of files"
+                               .format(manifest_path))
+    filenames = set()
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("url") or not entry.get("filename"):
+            raise exc.InvalidInput("Remote file manifest entries must have a 'url' and a "
+                                   "'filename': {}".format(json.dumps(entry)))
+        filename = posixpath.normpath(entry["filename"].replace(os.sep, "/"))
+        if filename.startswith(("/", "../")) or filename == "..":
+            raise exc.InvalidInput("Remote file '{}' must be inside the data directory"
+                                   .format(entry["filename"]))
+        if filename in filenames:
+            raise exc.InvalidInput("Remote file '{}' is listed more than once".format(filename))
+        filenames.add(filename)
+        entry["filename"] = filename
+    return entries
+
+
+def complete_manifest(entries, data_path, cache=None):
+    """Fill in the length and checksums an entry leaves out from the file of the same
+    name in data_path, hashing every such file on a pool of processes.
+
+    Arguments:
+        entries (list): From load_manifest(). Completed in place.
+        data_path (str): The directory the filenames are relative to.
+        cache (checksums.ChecksumCache): Passed to checksums.hash_files(). Default None.
+
+    Returns:
+        list: entries
+    """
+    incomplete = {}
+    for entry in entries:
+        if "length" in entry and any(alg in entry for alg in bdbagit.CHECKSUM_ALGOS):
+            continue
+        path = os.path.join(data_path, *entry["filename"].split("/"))
+        if not os.path.isfile(path):
+            raise exc.InvalidInput("Remote file '{}' needs a 'length' and a checksum, or a "
+                                   "copy at '{}' to compute them from"
+                                   .format(entry["filename"], path))
+        incomplete[path] = entry
+    if incomplete:
+        logger.debug("Computing the sizes and checksums of {} remote files"
+                     .format(len(incomplete)))
+        hashes = checksums.hash_files(list(incomplete), DEFAULT_ALGORITHMS, cache=cache)
+        for path, entry in incomplete.items():
+            size, digests = hashes[path]
+            if "length" in entry and int(entry["length"]) != size:
+                raise exc.InvalidInput("Remote file '{}' is {} bytes, not the {} in the manifest"
+                                       .format(entry["filename"], size, entry["length"]))
+            entry["length"] = size
+            for alg in DEFAULT_ALGORITHMS:
+                entry.setdefault(alg, digests[alg])
+    return entries
+
+
+def exclude_patterns(entries):
+    """ignore.IgnoreRules patterns matching the local copies of remote files, which must
+    not also be in the payload."""
+    return ["/" + glob.escape(entry["filename"]) for entry in entries]
+
+
+def write_manifest(entries, path):
+    """Write entries where ``bdbag_api.make_bag(remote_file_manifest=...)`` reads them."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=2)
+
+
+def read_fetch(text):
+    """Parse the contents of a BDBag's ``fetch.txt``.
+
+    Returns:
+        dict: The URL and length (None if unknown) of each file, by its path in the
+                BDBag with "/" separators.
+    """
+    fetched = {}
+    for line in text.splitlines():
+        if line.strip():
+            url, length, filename = line.strip().split(None, 2)
+            filename = posixpath.normpath(bdbagit._decode_filename(filename).replace("\\", "/"))
+            fetched[filename] = (url, None if length == "-" else int(length))
+    return fetched
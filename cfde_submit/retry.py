@@ -0,0 +1,146 @@
+import logging
+import random
+import threading
+import time
+
+import globus_sdk
+import requests
+
+from cfde_submit import exc
+
+logger = logging.getLogger(__name__)
+
+# Statuses that mean the request may succeed if it is sent again
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+# Of those, the ones where the server did not act on the request. Used for calls that
+# are unsafe to repeat, like starting a Flow.
+UNPROCESSED_STATUSES = (429, 502, 503, 504)
+
+
+class RetryPolicy:
+    """Retries transient failures of remote calls with jittered exponential backoff,
+    within an overall deadline.
+
+    Each call is made under a key, such as a host name. A circuit breaker for each key
+    opens after ``failure_threshold`` consecutive calls have failed even after retrying,
+    and then fails every call with that key immediately with ServiceUnavailable, until
+    ``reset_timeout`` seconds have passed.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0, deadline=300.0,
+                 retry_statuses=RETRY_STATUSES, retry_read_timeouts=True, failure_threshold=5,
+                 reset_timeout=60.0):
+        """
+        Arguments:
+            max_attempts (int): The most times a call is made. Default 5.
+            base_delay (float): Seconds before the first retry, doubled for each
+                    following retry. The actual delay is random, up to this. Default 1.
+            max_delay (float): The longest delay between attempts, in seconds.
+                    Default 30.
+            deadline (float): Seconds after the first attempt when no more retries are
+                    started. Default 300.
+            retry_statuses (tuple): HTTP statuses to retry. Default RETRY_STATUSES.
+            retry_read_timeouts (bool): Retry requests that timed out waiting for a
+                    response? The server may have acted on those. Default True.
+            failure_threshold (int): Consecutive failed calls that open the circuit
+                    breaker for a key. Default 5.
+            reset_timeout (float): Seconds an open circuit breaker stays open.
+                    Default 60.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retry_statuses = tuple(retry_statuses)
+        self.retry_read_timeouts = retry_read_timeouts
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def copy(self, **options):
+        """Return a policy with some options changed that shares this policy's circuit
+        breakers."""
+        settings = {name: getattr(self, name) for name in (
+            "max_attempts", "base_delay", "max_delay", "deadline", "retry_statuses",
+            "retry_read_timeouts", "failure_threshold", "reset_timeout")}
+        settings.update(options)
+        policy = RetryPolicy(**settings)
+        policy.breakers, policy.lock = self.breakers, self.lock
+        return policy
+
+    def is_transient(self, result=None, error=None):
+        """Is this response or exception worth retrying?"""
+        if error is not None:
+            read_timeout = isinstance(error, requests.ReadTimeout) or (
+                isinstance(error, globus_sdk.exc.GlobusTimeoutError)
+                and not isinstance(error, globus_sdk.exc.GlobusConnectionTimeoutError))
+            if read_timeout:
+                return self.retry_read_timeouts
+            if isinstance(error, (requests.ConnectionError, requests.Timeout,
+                                  globus_sdk.exc.NetworkError)):
+                return True
+            return getattr(error, "http_status", None) in self.retry_statuses
+        return getattr(result, "status_code", None) in self.retry_statuses
+
+    def delay(self, attempt):
+        """Seconds to wait before retry number ``attempt`` (starting at 1)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, key, func, *args, **kwargs):
+        """Call ``func(*args, **kwargs)``, retrying transient failures.
+
+        Returns the result of the last attempt. Responses with retryable statuses are
+        returned once retries are used up, and exceptions are raised.
+
+        Raises:
+            exc.ServiceUnavailable: The circuit breaker for key is open.
+        """
+        self._check_breaker(key)
+        started = time.monotonic()
+        attempt = 1
+        while True:
+            result, error = None, None
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                error = e
+            if not self.is_transient(result, error):
+                self._record(key, success=True)
+                if error is not None:
+                    raise error
+                return result
+
+            delay = self.delay(attempt)
+            if (attempt >= self.max_attempts
+                    or time.monotonic() - started + delay > self.deadline):
+                self._record(key, success=False)
+                logger.error("Giving up on '{}' after {} attempts".format(key, attempt))
+                if error is not None:
+                    raise error
+                return result
+            logger.debug("Transient failure calling '{}' ({}), retry {} in {:.1f}s".format(
+                key, error or result.status_code, attempt, delay))
+            time.sleep(delay)
+            attempt += 1
+
+    def _check_breaker(self, key):
+        with self.lock:
+            failures, opened_at = self.breakers.get(key, (0, None))
+            if opened_at is not None and time.monotonic() - opened_at < self.reset_timeout:
+                raise exc.ServiceUnavailable(
+                    "'{}' failed {} times in a row and is not being contacted for now. "
+                    "Please try again later.".format(key, failures))
+
+    def _record(self, key, success):
+        with self.lock:
+            if success:
+                self.breakers.pop(key, None)
+                return
+            failures, _ = self.breakers.get(key, (0, None))
+            failures += 1
+            opened_at = time.monotonic() if failures >= self.failure_threshold else None
+            if opened_at is not None:
+                logger.warning("Too many failures calling '{}', pausing calls for {}s"
+                               .format(key, self.reset_timeout))
+            self.breakers[key] = (failures, opened_at)
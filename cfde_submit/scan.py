@@ -0,0 +1,216 @@
+import heapq
+import logging
+import os
+import shutil
+
+from bdbag import bdbag_api
+import git
+import globus_sdk
+
+from cfde_submit import CONFIG, archive, exc, ignore, remote
+
+logger = logging.getLogger(__name__)
+
+
+def scan_tree(path, largest=None, exclude=None):
+    """Count the files and bytes in a directory tree from directory entries alone,
+    without opening any file.
+
+    Arguments:
+        path (str): The directory to scan. Symbolic links are followed.
+        largest (int): How many of the largest files to report.
+                Default None, to use CONFIG["SCAN_LARGEST_FILES"].
+        exclude (ignore.IgnoreRules): Files and directories to skip. Default None.
+
+    Returns:
+        dict: The number of "files" and "directories", their total "bytes", and the
+                "largest" files as (size, path) pairs, largest first.
+    """
+    largest = CONFIG["SCAN_LARGEST_FILES"] if largest is None else largest
+    files, directories, total = 0, 0, 0
+    heap = []
+    # Directories to scan, with their paths relative to path
+    pending = [(path, "")]
+    while pending:
+        directory, relpath = pending.pop()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir()
+                if exclude and exclude.match(relpath + entry.name, is_dir):
+                    continue
+                if is_dir:
+                    directories += 1
+                    pending.append((entry.path, relpath + entry.name + "/"))
+                    continue
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    # A broken symbolic link
+                    continue
+                files += 1
+                total += size
+                if len(heap) < largest:
+                    heapq.heappush(heap, (size, entry.path))
+                elif heap and size > heap[0][0]:
+                    heapq.heapreplace(heap, (size, entry.path))
+    return {"files": files, "directories": directories, "bytes": total,
+            "largest": sorted(heap, reverse=True)}
+
+
+def plan_submission(data_path, output_dir=None, handle_git_repos=True, stream=False,
+                    globus=None, codec=None, exclude=None, remote_files=None,
+                    cache_archive=None):
+    """Work out what submitting data_path involves before anything is written: how much
+    data there is, roughly how long bagging, archiving and uploading it will take, how
+    much disk space it needs where, and whether to transfer it over HTTPS or with Globus.
+
+    The arguments are those of the same name given to CfdeClient.start_deriva_flow(),
+    and the sizes count neither excluded files nor those in remote_files.
+    When globus is None, Globus is chosen for data of at least
+    CONFIG["GLOBUS_TRANSFER_THRESHOLD"] bytes if Globus Connect Personal is installed,
+    and HTTPS otherwise.
+
+    Returns:
+        dict: The scan_tree() results for data_path, plus the estimated seconds to
+                "bag", "archive" and "upload" in "estimates", the chosen "transport"
+                ("https" or "globus"), the bytes "needed" and "free" on each filesystem
+                written to in "space", whether there is enough of it in "space_ok", and
+                the number of "remote_files" to list in fetch.txt.
+    """
+    data_path = os.path.abspath(data_path)
+    if not os.path.exists(data_path):
+        raise exc.InvalidInput("Path '{}' does not exist".format(data_path))
+    codec, _ = archive.resolve_codec(codec)
+
+    needs = []
+    is_dir = os.path.isdir(data_path)
+    if is_dir:
+        in_repo = handle_git_repos and _in_git_repo(data_path)
+        is_bag = not in_repo and bdbag_api.is_bag(data_path)
+        remote_entries = remote.load_manifest(remote_files) if remote_files and not is_bag else []
+        # Nothing is excluded from a BDBag that was already made
+        patterns = (list(exclude or []) + remote.exclude_patterns(remote_entries)
+                    + ([".git/"] if in_repo else []))
+        rules = ignore.IgnoreRules() if is_bag else ignore.IgnoreRules.load(data_path, patterns)
+        plan = scan_tree(data_path, exclude=rules)
+        size = plan["bytes"]
+        cache_dir = None
+        if cache_archive is None:
+            cache_archive = CONFIG["ARCHIVE_CACHE"]
+        if cache_archive and not stream:
+            cache_dir = os.path.join(CONFIG["CACHE_DIR"], "archives")
+        # Where the BDBag directory, then its archive, are written
+        if in_repo:
+            bag_dir = cache_dir or os.path.dirname(data_path)
+            needs.append((bag_dir, size))
+        elif output_dir and not is_bag:
+            bag_dir = os.path.dirname(os.path.abspath(output_dir))
+            # Staged files share the originals' data, unless they must be copied
+            if (CONFIG["STAGING_MODE"] == "copy"
+                    or os.stat(data_path).st_dev != os.stat(_existing(bag_dir)).st_dev):
+                needs.append((bag_dir, size))
+        else:
+            bag_dir = os.path.dirname(data_path)
+        if not stream:
+            # At worst, the archive is no smaller than the data
+            needs.append((cache_dir or bag_dir, size))
+    else:
+        size = os.path.getsize(data_path)
+        is_bag = True
+        remote_entries = []
+        plan = {"files": 1, "directories": 0, "bytes": size, "largest": [(size, data_path)]}
+    plan["remote_files"] = len(remote_entries)
+
+    rates = CONFIG["ESTIMATED_RATES"]
+    processes = CONFIG["HASH_PROCESSES"] or os.cpu_count() or 1
+    threads = CONFIG["ARCHIVE_THREADS"] or os.cpu_count() or 1
+    plan["estimates"] = {
+        "bag": 0 if is_bag else size / (rates["hash"] * processes),
+        "archive": size / (rates[codec] * threads) if is_dir else 0,
+        "upload": size / CONFIG["UPLOAD_ESTIMATED_RATE"],
+    }
+
+    if stream:
+        plan["transport"] = "https"
+    elif globus is not None:
+        plan["transport"] = "globus" if globus else "https"
+    elif (size >= CONFIG["GLOBUS_TRANSFER_THRESHOLD"]
+          and globus_sdk.LocalGlobusConnectPersonal().endpoint_id):
+        plan["transport"] = "globus"
+    else:
+        plan["transport"] = "https"
+
+    # Add up what is needed on each filesystem
+    space = {}
+    for directory, needed in needs:
+        directory = _existing(directory)
+        device = os.stat(directory).st_dev
+        if device not in space:
+            space[device] = {"path": directory, "needed": 0,
+                             "free": shutil.disk_usage(directory).free}
+        space[device]["needed"] += needed
+    plan["space"] = list(space.values())
+    plan["space_ok"] = all(s["needed"] <= s["free"] for s in plan["space"])
+    plan["path"] = data_path
+    return plan
+
+
+def format_plan(plan):
+    """Describe a plan_submission() result for people."""
+    lines = ["Submission plan for '{}':".format(plan["path"]),
+             "  {} files in {} directories, {}".format(
+                 plan["files"], plan["directories"], format_bytes(plan["bytes"]))]
+    if plan.get("remote_files"):
+        lines.append("  {} remote files listed in fetch.txt, not uploaded".format(
+            plan["remote_files"]))
+    if plan["largest"]:
+        lines.append("  Largest files:")
+        lines.extend("    {:>10}  {}".format(format_bytes(size), path)
+                     for size, path in plan["largest"])
+    estimates = plan["estimates"]
+    lines.append("  Estimated time: bagging {}, archiving {}, uploading {}".format(
+        *(format_seconds(estimates[step]) for step in ("bag", "archive", "upload"))))
+    lines.append("  Transfer with: {}".format(
+        "Globus" if plan["transport"] == "globus" else "HTTPS"))
+    for s in plan["space"]:
+        lines.append("  Disk space: needs {} in '{}', {} free{}".format(
+            format_bytes(s["needed"]), s["path"], format_bytes(s["free"]),
+            "" if s["needed"] <= s["free"] else " - NOT ENOUGH SPACE"))
+    return "\n".join(lines)
+
+
+def format_bytes(num_bytes):
+    """Format a number of bytes in the largest binary unit it fills, like "1.5 GiB"."""
+    if num_bytes < 1024:
+        return "{} bytes".format(num_bytes)
+    for unit in ("KiB", "MiB", "GiB", "TiB"):
+        num_bytes /= 1024
+        if num_bytes < 1024 or unit == "TiB":
+            return "{:.1f} {}".format(num_bytes, unit)
+
+
+def format_seconds(seconds):
+    """Format a duration roughly, like "3m 20s"."""
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return "{}s".format(seconds)
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return "{}m {}s".format(minutes, seconds)
+    return "{}h {}m".format(*divmod(minutes, 60))
+
+
+def _in_git_repo(path):
+    try:
+        git.Repo(path, search_parent_directories=True)
+    except (git.InvalidGitRepositoryError, git.NoSuchPathError):
+        return False
+    return True
+
+
+def _existing(path):
+    """The closest directory to path that exists, path included."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
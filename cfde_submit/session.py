@@ -0,0 +1,101 @@
+import logging
+import threading
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+class PooledSession(requests.Session):
+    """A keep-alive requests Session shared by every HTTP call a CfdeClient makes, so
+    repeated calls to the same host reuse one connection instead of paying for a new
+    DNS lookup and TLS handshake each time.
+
+    Counts requests and new connections, to show how often connections are reused.
+    Requests are retried under a RetryPolicy keyed by host, when one is given.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, retry_policy=None):
+        """
+        Arguments:
+            pool_size (int): The number of connections kept open per host. Should be at
+                    least the number of threads using the session at once.
+                    Default 10.
+            timeout (float or tuple): Default (connect, read) timeout in seconds for
+                    requests that do not set their own. Default None, for no timeout.
+            retry_policy (cfde_submit.retry.RetryPolicy): Retries transient failures.
+                    Requests with a body that cannot be rewound, such as a generator,
+                    are sent once. Default None, to never retry.
+        """
+        super().__init__()
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+        self.counter_lock = threading.Lock()
+        self.request_count = 0
+        self.connection_count = 0
+        adapter = _CountingAdapter(self, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if not self.retry_policy:
+            return self._send(method, url, kwargs)
+
+        body = kwargs.get("data")
+        rewindable = hasattr(body, "seek")
+        start = body.tell() if rewindable else None
+        policy = self.retry_policy
+        if not rewindable and body is not None and not isinstance(body, (bytes, str, dict)):
+            # An iterator is used up by the first attempt
+            policy = policy.copy(max_attempts=1)
+
+        def attempt():
+            if rewindable:
+                body.seek(start)
+            return self._send(method, url, kwargs)
+        return policy.call(urlparse(url).netloc, attempt)
+
+    def _send(self, method, url, kwargs):
+        with self.counter_lock:
+            self.request_count += 1
+        return super().request(method, url, **kwargs)
+
+    def new_connection(self):
+        with self.counter_lock:
+            self.connection_count += 1
+
+    @property
+    def stats(self):
+        """dict: requests sent, connections opened and requests that reused a connection"""
+        with self.counter_lock:
+            return {
+                "requests": self.request_count,
+                "connections": self.connection_count,
+                "reused": max(self.request_count - self.connection_count, 0),
+            }
+
+
+class _CountingAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report each new connection to the session."""
+
+    def __init__(self, session, **kwargs):
+        self.session = session
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: _counting_pool(pool_cls, self.session)
+            for scheme, pool_cls in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
+
+def _counting_pool(pool_cls, session):
+    class CountingConnectionPool(pool_cls):
+        def _new_conn(self):
+            session.new_connection()
+            return super()._new_conn()
+    return CountingConnectionPool
@@ -0,0 +1,92 @@
+import logging
+import os
+import sqlite3
+
+from cfde_submit import CONFIG
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteCache:
+    """A persistent cache in a single table of a SQLite database, whose least recently
+    used entries are evicted beyond ``max_entries``. A table left with other columns by
+    another version of cfde-submit is emptied and made again.
+
+    Subclasses set:
+        TABLE (str): The name of the table, which is also used for its indexes.
+        KEY (str): The name of the primary key column.
+        COLUMNS (list): The definitions of every column but the trailing
+                ``last_used REAL``, starting with the primary key.
+        INDEXES (list): The columns to index besides ``last_used``.
+        FILENAME (str): The name of the database file in CONFIG["CACHE_DIR"].
+        ENABLED, MAX_ENTRIES (str): The CONFIG keys turning the default cache on and
+                limiting its size.
+        UNAVAILABLE (str): The warning logged when the default cache cannot be opened.
+    """
+    TABLE = None
+    KEY = None
+    COLUMNS = []
+    INDEXES = []
+    FILENAME = None
+    ENABLED = None
+    MAX_ENTRIES = None
+    UNAVAILABLE = None
+
+    def __init__(self, path=None, max_entries=None):
+        """
+        Arguments:
+            path (str): The database file. Default None, for FILENAME in
+                    CONFIG["CACHE_DIR"].
+            max_entries (int): The most entries to keep.
+                    Default None, to use CONFIG[MAX_ENTRIES].
+        """
+        self.path = path or os.path.join(CONFIG["CACHE_DIR"], self.FILENAME)
+        self.max_entries = max_entries or CONFIG[self.MAX_ENTRIES]
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        columns = [column.split()[0] for column in self.COLUMNS] + ["last_used"]
+        with self.db:
+            info = self.db.execute("PRAGMA table_info({})".format(self.TABLE)).fetchall()
+            found = [row[1] for row in info]
+            if found and found != columns:
+                self.db.execute("DROP TABLE {}".format(self.TABLE))
+            self.db.execute("CREATE TABLE IF NOT EXISTS {} ({}, last_used REAL)"
+                            .format(self.TABLE, ", ".join(self.COLUMNS)))
+            for column in ["last_used"] + self.INDEXES:
+                self.db.execute("CREATE INDEX IF NOT EXISTS {0}_{1} ON {0} ({1})"
+                                .format(self.TABLE, column))
+
+    @classmethod
+    def open_default(cls):
+        """Open the default cache, or return None if it is disabled by CONFIG[ENABLED]
+        or cannot be opened."""
+        if not CONFIG[cls.ENABLED]:
+            return None
+        try:
+            return cls()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning("{}: {}".format(cls.UNAVAILABLE, e))
+            return None
+
+    def close(self):
+        self.db.close()
+
+    def entries(self):
+        """int: The number of entries."""
+        return self.db.execute("SELECT COUNT(*) FROM {}".format(self.TABLE)).fetchone()[0]
+
+    def purge(self):
+        """Remove every entry.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        with self.db:
+            return self.db.execute("DELETE FROM {}".format(self.TABLE)).rowcount
+
+    def _evict(self):
+        """Remove the least recently used entries beyond max_entries. Called from within
+        a transaction by subclasses after they add entries."""
+        self.db.execute("DELETE FROM {0} WHERE {1} NOT IN (SELECT {1} FROM {0} "
+                        "ORDER BY last_used DESC LIMIT ?)".format(self.TABLE, self.KEY),
+                        (self.max_entries,))
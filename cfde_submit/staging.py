@@ -0,0 +1,108 @@
+import errno
+import logging
+import os
+import shutil
+
+from cfde_submit import CONFIG
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Linux ioctl that makes a file share another file's data blocks, copy-on-write
+FICLONE = 0x40049409
+# Ways to stage a file, fastest first
+METHODS = ("reflink", "hardlink", "copy")
+# Errors meaning a method is not supported between these filesystems at all, so it is
+# not tried again for the rest of the tree
+UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EPERM,
+                      errno.ENOSYS)
+
+
+def stage_tree(source, destination, mode=None, exclude=None):
+    """Stage a directory tree at destination for bagging, without copying file data
+    when possible.
+
+    Each file is staged with the first method that works:
+
+        reflink   A copy-on-write clone (btrfs, XFS and others). Instant, and the copy
+                  is independent of the original.
+        hardlink  A second name for the same file on the same filesystem. Instant.
+                  BDBag only moves payload files and never modifies them, so the
+                  originals are not changed.
+        copy      A full copy of the data.
+
+    Arguments:
+        source (str): The directory to stage. Symbolic links are followed, like
+                ``shutil.copytree`` does by default.
+        destination (str): The directory to create. It must not exist.
+        mode (str): "auto" to try every method, or one of METHODS to only use that
+                method, or fall back to copying. Default None, to use
+                CONFIG["STAGING_MODE"].
+        exclude (ignore.IgnoreRules): Files and directories to leave out. Default None.
+
+    Returns:
+        dict: The number of files staged with each method.
+
+    Raises:
+        FileExistsError: destination already exists.
+    """
+    mode = mode or CONFIG["STAGING_MODE"]
+    if mode != "auto" and mode not in METHODS:
+        raise ValueError("Unknown staging mode '{}'. Choose 'auto' or one of: {}"
+                         .format(mode, ", ".join(METHODS)))
+    # Methods other than copying, which is always the last resort
+    methods = ["reflink", "hardlink"] if mode == "auto" else [mode]
+    if fcntl is None and "reflink" in methods:
+        methods.remove("reflink")
+
+    os.makedirs(destination)
+    # Neither reflinks nor hardlinks work across filesystems
+    if os.stat(source).st_dev != os.stat(destination).st_dev:
+        methods = []
+
+    counts = dict.fromkeys(METHODS, 0)
+    walk = exclude.walk(source) if exclude else os.walk(source, followlinks=True)
+    for root, dirs, files in walk:
+        target_root = os.path.join(destination, os.path.relpath(root, source))
+        for d in dirs:
+            os.makedirs(os.path.join(target_root, d), exist_ok=True)
+        for f in files:
+            src, dst = os.path.join(root, f), os.path.join(target_root, f)
+            counts[_stage_file(src, dst, methods)] += 1
+
+    logger.debug("Staged '{}' at '{}': {}".format(
+        source, destination, ", ".join("{} {}".format(n, m) for m, n in counts.items() if n)))
+    return counts
+
+
+def _stage_file(src, dst, methods):
+    """Stage one file with the first of methods that works, or copy it. Methods that are
+    not supported at all are removed from methods. Returns the method used."""
+    for method in list(methods):
+        if method == "copy":
+            break
+        try:
+            if method == "reflink":
+                _reflink(src, dst)
+            else:
+                os.link(src, dst)
+            return method
+        except OSError as e:
+            if os.path.lexists(dst):
+                os.remove(dst)
+            if e.errno in UNSUPPORTED_ERRORS:
+                logger.debug("Staging with {} is not supported here ({}), not trying it again"
+                             .format(method, e))
+                methods.remove(method)
+    shutil.copy2(src, dst)
+    return "copy"
+
+
+def _reflink(src, dst):
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+    shutil.copystat(src, dst)
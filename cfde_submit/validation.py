@@ -1,14 +1,43 @@
+import contextlib
+import hashlib
+import itertools
+import json
 import os
 import logging
+import posixpath
+import random
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import quote, unquote, urlparse
+from urllib.request import pathname2url, url2pathname
 
+import frictionless
 from bdbag import bdbag_api
-from frictionless import FrictionlessException, Package, validate
+from frictionless import (FrictionlessException, Loader, Package, Plugin, Resource, errors,
+                          system, validate, validate_resource)
+from cfde_submit import CONFIG, archive, checksums, keystore, remote
 from cfde_submit.exc import ValidationException, InvalidInput
+from cfde_submit.sqlite_cache import SQLiteCache
 
 logger = logging.getLogger(__name__)
 
+MODES = ("full", "streaming", "sampled")
+# Streaming validation reports the errors of a row in frictionless's order: its own cell
+# errors, then primary key, unique and foreign key errors
+PK_RANK = 1000000
+# Tables listed in a BDBag's fetch.txt are read from URLs with these schemes
+READABLE_SCHEMES = ("http", "https", "ftp", "ftps")
+# Tables in a zip archive are read from URLs like "cfde-zip:///path/bag.zip!/bag/data/file.tsv"
+ZIP_SCHEME = "cfde-zip"
+# The fixed-size part of the local file header before each zip member's data
+ZIP_LOCAL_HEADER_SIZE = 30
 
-def ts_validate(data_path, schema=None):
+
+def ts_validate(data_path, schema=None, processes=None, mode=None):
     """Validate a given TableSchema using frictionless.
 
     Arguments:
@@ -17,62 +46,670 @@ def ts_validate(data_path, schema=None):
         schema (str): The schema to validate against. If not provided,
                 the data is only validated against the defined TableSchema.
                 Default None.
+        processes (int): The number of processes to validate resources on, each in
+                its own process. Default None, to use CONFIG["VALIDATION_PROCESSES"],
+                or one per CPU.
+        mode (str): One of MODES: "full" validates each table with frictionless, which
+                keeps the primary and unique keys of a table, and the keys of the tables
+                it references, in memory. "streaming" checks the same constraints in
+                batches of CONFIG["VALIDATION_BATCH_ROWS"] rows, keeping the keys in a
+                keystore.KeyStore on disk, so memory use does not grow with the tables.
+                "sampled" checks the schemas and headers, but only the types and
+                constraints of the first CONFIG["VALIDATION_SAMPLE_HEAD"] rows of each
+                table and of CONFIG["VALIDATION_SAMPLE_ROWS"] rows read from random places
+                in it, and not its primary, unique or foreign keys. It takes about as long
+                for any size of table, for checking data while it is being prepared.
+                Default None, to use CONFIG["VALIDATION_MODE"].
 
     Returns:
         dict: The validation results.
             is_valid (bool): Is the TableSchema valid?
             raw_errors (list): The raw Exceptions generated from any validation errors.
             error (str): A formatted error message about any validation errors.
+
+    The tables in a zip archive are read from it as streams, without extracting it.
+    Tar archives can only be read in order, so they are extracted to a temporary
+    directory, which is removed afterwards.
+
+    The result of validating each table in the "full" or "streaming" mode is kept in a
+    ValidationCache, unless CONFIG["VALIDATION_CACHE"] is False, and reused while the
+    table, its schema, the tables its foreign keys reference, the mode and the version of
+    frictionless are unchanged. The "sampled" mode neither reads nor adds to the cache,
+    since digesting every table would take longer than sampling it.
+
+    Tables that a BDBag lists in its ``fetch.txt`` instead of holding are validated
+    against their schemas where they are hosted, if it is over HTTP(S) or FTP.
+    Only the schemas of the others can be checked.
     """
-    if os.path.isfile(data_path):
-        archive_file = data_path
+    mode = mode or CONFIG["VALIDATION_MODE"]
+    if mode not in MODES:
+        raise ValueError("Unknown validation mode '{}', use one of: {}"
+                         .format(mode, ", ".join(MODES)))
+    processes = processes or CONFIG["VALIDATION_PROCESSES"] or os.cpu_count() or 1
+    cache = ValidationCache.open_default() if mode != "sampled" else None
+    try:
+        if os.path.isfile(data_path) and not data_path.endswith(".json"):
+            if zipfile.is_zipfile(data_path):
+                return _validate_package(_ZipBag(data_path), schema, processes, mode, cache)
+            return _validate_extracted(data_path, schema, processes, mode, cache)
+        return _validate_package(_DirectoryBag(data_path), schema, processes, mode, cache)
+    finally:
+        if cache:
+            cache.close()
+
+
+def _validate_extracted(archive_file, schema, processes, mode, cache):
+    temp_dir = None
+    try:
         try:
-            data_path = bdbag_api.extract_bag(data_path, temp=True)
+            if archive_file.endswith(".tar.zst"):
+                temp_dir = tempfile.mkdtemp(prefix="cfde_submit_")
+                data_path = archive.extract_tar_zstd(archive_file, directory=temp_dir)
+            else:
+                data_path = bdbag_api.extract_bag(archive_file, temp=True)
+                temp_dir = os.path.dirname(data_path)
         except Exception as e:
             raise InvalidInput("Error extracting %s: %s" % (archive_file, e))
         if not bdbag_api.is_bag(data_path):
             raise InvalidInput("Input %s does not appear to be a valid BDBag. This tool requires a"
                                " prepared BDBag archive when invoked on an existing archive file."
                                % archive_file)
+        return _validate_package(_DirectoryBag(data_path, temporary=True), schema, processes,
+                                 mode, cache)
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-    # If data_path is a directory, find JSON
-    if os.path.isdir(data_path):
-        if "data" in os.listdir(data_path):
-            data_path = os.path.join(data_path, "data")
-        desc_file_list = [filename for filename in os.listdir(data_path)
-                          if filename.endswith(".json") and not filename.startswith(".")]
-        if len(desc_file_list) < 1:
-            raise ValidationException("No TableSchema JSON file found")
-        elif len(desc_file_list) > 1:
-            raise ValidationException("Mutiple JSON files found in directory")
-        else:
-            data_path = os.path.join(data_path, desc_file_list[0])
 
+def _validate_package(bag, schema, processes, mode, cache=None):
     # Read into Package
     try:
-        pkg = Package(data_path)
-        report = validate(pkg, schema=schema)
+        pkg = bag.package()
+        _use_fetched_tables(pkg, bag)
+        if pkg.metadata_errors:
+            summaries = [{"errors": [error["message"] for error in pkg.metadata_errors],
+                          "tasks": []}]
+        elif mode == "full" and not cache and (processes == 1 or len(pkg.resources) < 2):
+            summaries = [_summarize(validate(pkg, schema=schema))]
+        else:
+            summaries = _validate_resources(pkg, bag, processes, mode, cache,
+                                            _cache_keys(pkg, bag, schema, mode) if cache else {})
     except FrictionlessException as e:
         raise ValidationException("Validation error\n%s" % e.error.message)
 
-    if not report.valid:
-        if report.errors:
-            msg = report.errors[0]['message']
+    for summary in summaries:
+        if summary.get("exception"):
+            raise ValidationException("Validation error\n%s" % summary["exception"])
+    for summary in summaries:
+        if summary["errors"]:
+            raise ValidationException("Validation error in %s" % summary["errors"][0])
+    for summary in summaries:
+        for path, message in summary["tasks"]:
+            raise ValidationException("Validation error in %s\n%s" % (path, message))
+
+
+def _validate_resources(pkg, bag, processes, mode, cache=None, keys=None):
+    """Validate each resource of pkg in its own task, on a pool of processes if there is
+    more than one, largest first so a large table does not start last.
+
+    Resources with a result in cache under their key in keys are not validated again,
+    and the results of the others are cached.
+
+    Returns:
+        list: The _summarize()d report of each resource, in the order of pkg.resources.
+    """
+    descriptor, basepath = pkg.to_dict(), pkg.basepath
+    names = [resource.name for resource in pkg.resources]
+    keys = keys or {}
+    summaries = {}
+    for i, name in enumerate(names):
+        if cache and keys.get(name):
+            summary = cache.get(keys[name])
+            if summary is not None:
+                summaries[i] = summary
+    if summaries:
+        logger.debug("Reusing cached validation results for {} of {} resources"
+                     .format(len(summaries), len(names)))
+    todo = [i for i in range(len(names)) if i not in summaries]
+    if processes == 1 or len(todo) < 2:
+        validated = {i: _validate_resource(descriptor, basepath, names[i], mode) for i in todo}
+    else:
+        todo.sort(key=lambda i: -bag.table_size(pkg.resources[i].path))
+        logger.debug("Validating {} resources on {} processes".format(len(todo), processes))
+        with ProcessPoolExecutor(max_workers=min(processes, len(todo))) as pool:
+            futures = {i: pool.submit(_validate_resource, descriptor, basepath, names[i], mode)
+                       for i in todo}
+            validated = {i: future.result() for i, future in futures.items()}
+    for i, summary in validated.items():
+        # Errors reading a table may not happen again, so they are not cached
+        if cache and keys.get(names[i]) and not summary.get("exception"):
+            cache.put(keys[names[i]], summary)
+    summaries.update(validated)
+    return [summaries[i] for i in range(len(names))]
+
+
+def _cache_keys(pkg, bag, schema, mode):
+    """The ValidationCache key of each resource of pkg, by name, or None for resources
+    whose tables, or the tables their foreign keys reference, cannot be digested.
+
+    A key digests the version of frictionless, the validation mode, the schema validated
+    against, and the descriptor and content digest of the resource and every resource it
+    references.
+    """
+    digests = bag.table_digests([resource.path for resource in pkg.resources
+                                 if isinstance(resource.path, str)])
+    tables = {}
+    for resource in pkg.resources:
+        if isinstance(resource.path, str):
+            digest = digests.get(resource.path)
+        else:
+            # The rows of inline data are in the descriptor
+            digest = "inline" if resource.data is not None else None
+        tables[resource.name] = (resource.to_dict(), digest)
+    keys = {}
+    for resource in pkg.resources:
+        names = [resource.name] + sorted(set(
+            fk["reference"]["resource"] or resource.name for fk in resource.schema.foreign_keys))
+        parts = [tables.get(name, (None, None)) for name in names]
+        if all(digest for _, digest in parts):
+            keys[resource.name] = hashlib.sha256(json.dumps(
+                [frictionless.__version__, mode, schema, parts], sort_keys=True, default=str)
+                .encode()).hexdigest()
         else:
-            for task in report['tasks']:
-                if not task.valid:
-                    msg = task['resource']['path'] + "\n"
-                    msg += task['errors'][0]['message']
-        raise ValidationException("Validation error in %s" % msg)
+            keys[resource.name] = None
+    return keys
+
+
+def _validate_resource(descriptor, basepath, name, mode):
+    """Validate one resource of a package, possibly in a worker process."""
+    try:
+        pkg = Package(descriptor, basepath=basepath)
+        if mode == "streaming":
+            return _stream_resource(pkg, name)
+        if mode == "sampled":
+            return _sample_resource(pkg, name)
+        return _summarize(validate_resource(pkg.get_resource(name)))
+    except FrictionlessException as e:
+        return {"exception": e.error.message, "errors": [], "tasks": []}
+
+
+def _stream_resource(pkg, name, batch_rows=None):
+    """Validate a resource of pkg row by row, like frictionless, but checking its primary
+    key, unique fields and foreign keys a batch of rows at a time against keys kept in a
+    keystore.KeyStore on disk. Stops at the first invalid row.
+
+    Returns:
+        dict: Like _summarize().
+    """
+    batch_rows = batch_rows or CONFIG["VALIDATION_BATCH_ROWS"]
+    resource = pkg.get_resource(name)
+    schema = resource.schema
+    primary_key = list(schema.primary_key)
+    unique = [field.name for field in schema.fields if field.constraints.get("unique")]
+    # Keys that reference a resource that is not in the package cannot be checked
+    foreign_keys = [(fk["fields"], fk["reference"]["resource"] or name,
+                     fk["reference"]["fields"]) for fk in schema.foreign_keys
+                    if pkg.has_resource(fk["reference"]["resource"] or name)]
+    logger.debug("Streaming validation of '{}' in batches of {} rows"
+                 .format(name, batch_rows))
+
+    with tempfile.TemporaryDirectory(prefix="cfde_submit_") as temp_dir, \
+            keystore.KeyStore(os.path.join(temp_dir, "keys.sqlite3")) as store:
+        # The keys of referenced tables, whose own errors are reported with them
+        for _, source, source_fields in foreign_keys:
+            key_set = "{}:{}".format(source, ",".join(source_fields))
+            with _stateless_resource(pkg, source) as source_resource:
+                for batch in _batches(source_resource.row_stream, batch_rows):
+                    store.add(key_set, [
+                        (keystore.key_digest(row[f] for f in source_fields), row.row_position)
+                        for row in batch])
+
+        with _stateless_resource(pkg, name) as resource:
+            if not resource.header.valid:
+                return {"errors": [], "tasks": [(resource.path,
+                                                 resource.header.errors[0]["message"])]}
+            for batch in _batches(resource.row_stream, batch_rows):
+                found = []
+                for row in batch:
+                    found.extend((row.row_position, rank, error["message"])
+                                 for rank, error in enumerate(row.errors))
+                if primary_key:
+                    keyed = [row for row in batch
+                             if set(row[f] for f in primary_key) != {None}]
+                    found.extend((row.row_position, PK_RANK, errors.PrimaryKeyError.from_row(
+                        row, note='cells composing the primary keys are all "None"').message)
+                        for row in batch if set(row[f] for f in primary_key) == {None})
+                    previous = store.add("primary key", [
+                        (keystore.key_digest(row[f] for f in primary_key), row.row_position)
+                        for row in keyed])
+                    found.extend((row.row_position, PK_RANK, errors.PrimaryKeyError.from_row(
+                        row, note="the same as in the row at position %s" % seen).message)
+                        for row, seen in zip(keyed, previous) if seen)
+                for field_name in unique:
+                    keyed = [row for row in batch if row[field_name] is not None]
+                    previous = store.add("unique:" + field_name, [
+                        (keystore.key_digest([row[field_name]]), row.row_position)
+                        for row in keyed])
+                    found.extend((row.row_position, PK_RANK + 1, errors.UniqueError.from_row(
+                        row, note="the same as in the row at position %s" % seen,
+                        field_name=field_name).message)
+                        for row, seen in zip(keyed, previous) if seen)
+                for fields, source, source_fields in foreign_keys:
+                    keyed = [row for row in batch if set(row[f] for f in fields) != {None}]
+                    exists = store.contains("{}:{}".format(source, ",".join(source_fields)), [
+                        keystore.key_digest(row[f] for f in fields) for row in keyed])
+                    found.extend((row.row_position, PK_RANK + 2, errors.ForeignKeyError.from_row(
+                        row, note="not found in the lookup table").message)
+                        for row, ok in zip(keyed, exists) if not ok)
+                # Report the first error in the order frictionless would
+                if found:
+                    return {"errors": [], "tasks": [(resource.path, min(found)[2])]}
+    return {"errors": [], "tasks": []}
+
+
+def _sample_resource(pkg, name, head_rows=None, sample_rows=None):
+    """Validate the header of a resource of pkg, and the rows in a sample of it: its
+    first head_rows rows, and sample_rows lines read at random offsets in its file, each
+    taken to be one row. Only local files and members stored without compression in a
+    zip archive can be read at random. For other tables, such as compressed files and
+    members deflated in a zip archive, which can only be read from the start, only the
+    first rows are validated. Primary key, unique and foreign key constraints need every
+    row, and are not checked.
+
+    Returns:
+        dict: Like _summarize().
+    """
+    head_rows = head_rows or CONFIG["VALIDATION_SAMPLE_HEAD"]
+    sample_rows = sample_rows or CONFIG["VALIDATION_SAMPLE_ROWS"]
+    with _stateless_resource(pkg, name) as resource:
+        if not resource.header.valid:
+            return {"errors": [], "tasks": [(resource.path, resource.header.errors[0]["message"])]}
+        read = 0
+        for row in itertools.islice(resource.row_stream, head_rows):
+            if row.errors:
+                return {"errors": [], "tasks": [(resource.path, row.errors[0]["message"])]}
+            read += 1
+        options = {"format": resource.format, "encoding": resource.encoding,
+                   "dialect": resource.dialect, "schema": resource.schema}
+    if read < head_rows:
+        return {"errors": [], "tasks": []}
+
+    with _open_table(resource) as (table, start, end):
+        if table is None:
+            logger.info("'{}' cannot be read at random, only its first {} rows are validated"
+                        .format(name, head_rows))
+            return {"errors": [], "tasks": []}
+        header, lines = _sample_lines(table, start, end, sample_rows)
+    logger.debug("Validating the first {} rows of '{}' and {} rows sampled from it"
+                 .format(head_rows, name, len(lines)))
+    with Resource(header + b"".join(line for _, line in lines), **options) as sample:
+        for row in sample.row_stream:
+            if row.errors:
+                # Number the row as it is in the table, not in the sample
+                with _open_table(resource) as (table, start, end):
+                    position = _line_number(table, start, lines[row.row_position - 2][0])
+                error = row.errors[0]
+                message = error.template.format(
+                    **dict(error, rowPosition=position, rowNumber=position - 1))
+                return {"errors": [], "tasks": [(resource.path, message)]}
+    return {"errors": [], "tasks": []}
+
+
+@contextlib.contextmanager
+def _open_table(resource):
+    """A file holding the bytes of a resource's table, open for reading at random, and
+    the offsets in it where the table starts and ends, or None if the table cannot be
+    read at random."""
+    if resource.compression:
+        yield None, 0, 0
+    elif resource.scheme == "file":
+        with open(resource.fullpath, "rb") as table:
+            yield table, 0, os.path.getsize(resource.fullpath)
+    elif resource.scheme == ZIP_SCHEME:
+        archive_file, member = _zip_member(resource.fullpath)
+        with zipfile.ZipFile(archive_file) as zip_file:
+            info = zip_file.getinfo(member)
+        # zipfile seeks in a member by reading it from the start, so a member stored
+        # without compression is read straight from the archive file instead. Deflated
+        # members can only be read from the start.
+        if info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+            yield None, 0, 0
+            return
+        with open(archive_file, "rb") as table:
+            start = _zip_data_offset(table, info)
+            yield table, start, start + info.file_size
+    else:
+        yield None, 0, 0
+
+
+def _zip_data_offset(archive_file, info):
+    """The offset of the data of a zip member in the open archive file, after its local
+    file header."""
+    archive_file.seek(info.header_offset)
+    header = archive_file.read(ZIP_LOCAL_HEADER_SIZE)
+    if len(header) != ZIP_LOCAL_HEADER_SIZE or header[:4] != b"PK\x03\x04":
+        raise FrictionlessException(errors.SchemeError(
+            note="bad local file header for '{}'".format(info.filename)))
+    # The lengths of the file name and extra field end the fixed-size header
+    name_length, extra_length = struct.unpack("<HH", header[26:30])
+    return info.header_offset + ZIP_LOCAL_HEADER_SIZE + name_length + extra_length
+
+
+def _sample_lines(table, start, end, count):
+    """The header line of a table between the offsets start and end of a file, and up
+    to count (offset, line) pairs of the lines after it that start at or after random
+    offsets, in order."""
+    table.seek(start)
+    header = table.readline(end - start)
+    lines = []
+    first = start + len(header)
+    if end <= first:
+        return header, lines
+    for offset in sorted(random.sample(range(first, end), min(count, end - first))):
+        if offset < table.tell():
+            continue
+        if offset > table.tell():
+            # Finish the line before the offset, to start at the next line
+            table.seek(offset - 1)
+            table.readline(end - offset + 1)
+        line_start = table.tell()
+        line = table.readline(max(end - line_start, 0))
+        if line.strip():
+            lines.append((line_start, line if line.endswith(b"\n") else line + b"\n"))
+    return header, lines
+
+
+def _line_number(table, start, offset):
+    """The number of the line starting at offset in a table starting at start in a
+    file, counted from 1."""
+    table.seek(start)
+    newlines = 0
+    remaining = offset - start
+    while remaining > 0:
+        chunk = table.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            break
+        newlines += chunk.count(b"\n")
+        remaining -= len(chunk)
+    return newlines + 1
+
+
+def _stateless_resource(pkg, name):
+    """A copy of a resource of pkg, open for reading, without the primary key, unique
+    and foreign key constraints, whose checks need the keys of every row."""
+    descriptor = pkg.get_resource(name).to_dict()
+    schema = pkg.get_resource(name).schema.to_dict()
+    schema.pop("primaryKey", None)
+    schema.pop("foreignKeys", None)
+    for field in schema.get("fields", []):
+        field.get("constraints", {}).pop("unique", None)
+    descriptor["schema"] = schema
+    return Resource(descriptor, basepath=pkg.basepath)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _summarize(report):
+    """The messages of a report's errors, and the path and first error message of each
+    invalid task, in a form that can be sent between processes."""
+    return {"errors": [error["message"] for error in report.errors],
+            "tasks": [(task["resource"]["path"], task["errors"][0]["message"])
+                      for task in report.tasks if not task.valid]}
+
+
+def _find_descriptor(filenames):
+    """The one TableSchema JSON file among the names of the files in a directory."""
+    desc_file_list = [filename for filename in filenames
+                      if filename.endswith(".json") and not filename.startswith(".")]
+    if len(desc_file_list) < 1:
+        raise ValidationException("No TableSchema JSON file found")
+    elif len(desc_file_list) > 1:
+        raise ValidationException("Mutiple JSON files found in directory")
+    return desc_file_list[0]
+
+
+class _DirectoryBag:
+    """A TableSchema JSON file, or the one in a directory or BDBag directory."""
+
+    def __init__(self, data_path, temporary=False):
+        """
+        Arguments:
+            data_path (str): The TableSchema JSON file, or a directory with one.
+            temporary (bool): Is data_path a temporary copy, whose digests should not
+                    be kept in the ChecksumCache? Default False.
+        """
+        self.temporary = temporary
+        self.bag_path = None
+        self.fetched = {}
+        # If data_path is a directory, find JSON
+        if os.path.isdir(data_path):
+            if bdbag_api.is_bag(data_path):
+                self.bag_path = data_path
+                fetch_file = os.path.join(data_path, "fetch.txt")
+                if os.path.isfile(fetch_file):
+                    with open(fetch_file, encoding="utf-8") as f:
+                        self.fetched = remote.read_fetch(f.read())
+            if "data" in os.listdir(data_path):
+                data_path = os.path.join(data_path, "data")
+            data_path = os.path.join(data_path, _find_descriptor(os.listdir(data_path)))
+        self.descriptor_path = data_path
+
+    def package(self):
+        return Package(self.descriptor_path)
+
+    def table_size(self, path):
+        """The size of the file at path, relative to the TableSchema JSON, or 0 if it is
+        not in the BDBag."""
+        path = os.path.join(os.path.dirname(self.descriptor_path), str(path))
+        return os.path.getsize(path) if os.path.isfile(path) else 0
+
+    def table_digests(self, paths):
+        """The SHA-256 digest of the file at each of paths, relative to the TableSchema
+        JSON, for those in the BDBag."""
+        files = {path: os.path.join(os.path.dirname(self.descriptor_path), path)
+                 for path in paths}
+        files = {path: f for path, f in files.items() if os.path.isfile(f)}
+        checksum_cache = None if self.temporary else checksums.ChecksumCache.open_default()
+        try:
+            hashed = checksums.hash_files(sorted(set(files.values())), ["sha256"],
+                                          cache=checksum_cache)
+        finally:
+            if checksum_cache:
+                checksum_cache.close()
+        return {path: hashed[f][1]["sha256"] for path, f in files.items()}
+
+    def fetched_url(self, path):
+        """The URL of a file at path, relative to the TableSchema JSON, if it is only
+        listed in fetch.txt."""
+        path = os.path.normpath(os.path.join(os.path.dirname(self.descriptor_path), path))
+        if not self.bag_path or os.path.exists(path):
+            return None
+        bag_relpath = os.path.relpath(path, self.bag_path).replace(os.sep, "/")
+        return self.fetched.get(bag_relpath, (None, None))[0]
+
+
+class _ZipBag:
+    """The TableSchema JSON file in a BDBag zip archive, whose tables are read straight
+    from the archive."""
+
+    def __init__(self, archive_file):
+        self.archive_file = os.path.abspath(archive_file)
+        with zipfile.ZipFile(archive_file) as zip_file:
+            self.sizes = {info.filename: info.file_size for info in zip_file.infolist()
+                          if not info.filename.endswith("/")}
+            self.names = set(self.sizes)
+            self.prefix = archive.bag_prefix(self.names)
+            if self.prefix + "bagit.txt" not in self.names:
+                raise InvalidInput("Input %s does not appear to be a valid BDBag. This tool "
+                                   "requires a prepared BDBag archive when invoked on an "
+                                   "existing archive file." % archive_file)
+            data_dir = self.prefix + "data/"
+            self.descriptor_name = data_dir + _find_descriptor(
+                [name[len(data_dir):] for name in self.names
+                 if name.startswith(data_dir) and "/" not in name[len(data_dir):]])
+            try:
+                self.descriptor = json.loads(zip_file.read(self.descriptor_name).decode())
+            except ValueError as e:
+                raise ValidationException("Validation error\n%s: %s" % (self.descriptor_name, e))
+            self.fetched = {}
+            if self.prefix + "fetch.txt" in self.names:
+                self.fetched = remote.read_fetch(
+                    zip_file.read(self.prefix + "fetch.txt").decode("utf-8"))
+
+    def package(self):
+        # Relative paths are joined to the base path, so they are read by _ZipMemberLoader
+        basepath = _zip_url(self.archive_file, posixpath.dirname(self.descriptor_name))
+        return Package(self.descriptor, basepath=basepath)
+
+    def table_size(self, path):
+        """Like _DirectoryBag.table_size()."""
+        return self.sizes.get(posixpath.normpath(
+            posixpath.join(posixpath.dirname(self.descriptor_name), str(path))), 0)
+
+    def table_digests(self, paths):
+        """Like _DirectoryBag.table_digests(), for the members of the archive, which are
+        read to digest them."""
+        digests = {}
+        with zipfile.ZipFile(self.archive_file) as zip_file:
+            for path in paths:
+                member = posixpath.normpath(
+                    posixpath.join(posixpath.dirname(self.descriptor_name), path))
+                if member in self.names:
+                    with zip_file.open(member) as f:
+                        digests[path] = checksums.stream_hashes(f, ["sha256"])[1]["sha256"]
+        return digests
+
+    def fetched_url(self, path):
+        """Like _DirectoryBag.fetched_url()."""
+        member = posixpath.normpath(posixpath.join(posixpath.dirname(self.descriptor_name),
+                                                   path))
+        if member in self.names:
+            return None
+        return self.fetched.get(member[len(self.prefix):], (None, None))[0]
+
+
+class _ZipMemberLoader(Loader):
+    """Reads a table from a member of a zip archive, named by a ZIP_SCHEME URL."""
+
+    remote = False
+
+    def read_byte_stream_create(self):
+        archive_file, member = _zip_member(self.resource.fullpath)
+        try:
+            # The member stays readable after the archive is closed
+            with zipfile.ZipFile(archive_file) as zip_file:
+                return zip_file.open(member)
+        except KeyError as e:
+            raise FrictionlessException(errors.SchemeError(note=str(e)))
+
+
+def _zip_url(archive_file, member):
+    """The ZIP_SCHEME URL of a member of an archive file, given by its absolute path, such as
+    ``cfde-zip:///C:/bags/bag.zip!/bag/data/file.tsv``. The archive path is always in
+    the URL path, after an empty host, so a Windows drive is not taken for a host."""
+    path = pathname2url(archive_file)
+    # "/tmp/bag.zip" on POSIX, "///C:/bag.zip" or "//server/share/bag.zip" on Windows
+    if not path.startswith("//"):
+        path = "//" + path
+    return "{}:{}!/{}".format(ZIP_SCHEME, path, quote(member))
+
+
+def _zip_member(url):
+    """The archive file and member name in a ZIP_SCHEME URL."""
+    parsed = urlparse(url)
+    archive_path, member = parsed.path.split("!/", 1)
+    # A Windows UNC path keeps its server in the host
+    if parsed.netloc:
+        archive_path = "//" + parsed.netloc + archive_path
+    return url2pathname(archive_path), unquote(member)
+
+
+class _ZipMemberPlugin(Plugin):
+    code = ZIP_SCHEME
+
+    def create_loader(self, resource):
+        if resource.scheme == ZIP_SCHEME:
+            return _ZipMemberLoader(resource)
+
+
+system.register(ZIP_SCHEME, _ZipMemberPlugin())
+
+
+def _use_fetched_tables(pkg, bag):
+    """Point the resources of pkg that are only in the BDBag's fetch.txt at their URLs,
+    or remove them after validating their schemas if their URLs cannot be read."""
+    if not bag.fetched:
+        return
+    for resource in list(pkg.resources):
+        if not isinstance(resource.path, str):
+            continue
+        url = bag.fetched_url(resource.path)
+        if not url:
+            continue
+        if urlparse(url).scheme in READABLE_SCHEMES:
+            logger.debug("Validating remote table '{}' at '{}'".format(resource.name, url))
+            resource.path = url
+            continue
+        logger.warning("Remote table '{}' at '{}' cannot be read, only its schema is validated"
+                       .format(resource.name, url))
+        report = validate(resource.schema)
+        if not report.valid:
+            raise ValidationException("Validation error in %s\n%s"
+                                      % (resource.name, report.flatten(["message"])[0][0]))
+        pkg.remove_resource(resource.name)
+
+
+class ValidationCache(SQLiteCache):
+    """A persistent record of the results of validating each table, so tables that have
+    not changed since they were validated are not validated again.
+
+    Entries are keyed by _cache_keys(), a digest of everything a result depends on, and
+    hold the _summarize()d report. The least recently used entries are evicted beyond
+    ``max_entries``.
+    """
+
+    TABLE = "results"
+    KEY = "key"
+    COLUMNS = ["key TEXT PRIMARY KEY", "summary TEXT"]
+    FILENAME = "validation.sqlite3"
+    ENABLED = "VALIDATION_CACHE"
+    MAX_ENTRIES = "VALIDATION_CACHE_MAX_ENTRIES"
+    UNAVAILABLE = "Validation cache unavailable, validating every table"
+
+    def get(self, key):
+        """The cached summary for key, or None."""
+        row = self.db.execute("SELECT summary FROM results WHERE key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        with self.db:
+            self.db.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, summary):
+        """Cache a summary, and evict the least recently used entries beyond
+        max_entries."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                            (key, json.dumps(summary), time.time()))
+            self._evict()
 
 
 def validate_user_submission(data_path, schema, output_dir=None, delete_dir=False,
-                             handle_git_repos=True, bdbag_kwargs=None):
+                             handle_git_repos=True, bdbag_kwargs=None, mode=None):
     """
     Arguments:
         data_path (str): The path to the data to ingest into DERIVA. The path can be:
                 1) A directory to be formatted into a BDBag
-                2) A Git repository to be copied into a BDBag
+                2) A Git repository, whose files committed at HEAD are bagged
                 3) A premade BDBag directory
                 4) A premade BDBag in an archive file
         schema (str): The named schema or schema file link to validate data against.
@@ -93,10 +730,12 @@ def validate_user_submission(data_path, schema, output_dir=None, delete_dir=Fals
                 instead of Git repositories.
                 Default True.
         bdbag_kwargs (dict): Extra args to pass to bdbag
+        mode (str): How to validate the tables, one of MODES. See ts_validate().
+                Default None, to use CONFIG["VALIDATION_MODE"].
     """
 
     # Validate TableSchema in BDBag
     logger.debug("Validating TableSchema in BDBag '{}'".format(data_path))
-    ts_validate(data_path, schema=schema)
+    ts_validate(data_path, schema=schema, mode=mode)
     logger.debug("Validation successful")
     return data_path
@@ -0,0 +1,271 @@
+import contextlib
+import functools
+import logging
+import os
+import posixpath
+import re
+import tarfile
+import zipfile
+
+from bdbag import bdbagit
+
+from cfde_submit import CONFIG, archive, checksums, exc, remote
+
+logger = logging.getLogger(__name__)
+
+MODES = ("none", "fast", "full")
+# How many bad files to name in a CorruptBag message
+MAX_REPORTED = 20
+
+MANIFEST = re.compile(r"^(tag)?manifest-(\w+)\.txt$")
+
+
+def verify_bag(bag_path, mode=None, processes=None):
+    """Check a premade BDBag directory or archive against its manifests.
+
+    The "fast" mode checks that every file in the manifests is in the BDBag or its
+    ``fetch.txt``, that every payload file is in the manifests, and that the payload
+    sizes add up to the ``Payload-Oxum`` in ``bag-info.txt`` and the sizes in
+    ``fetch.txt``. The "full" mode also hashes every file again, on a pool of processes
+    (except for tar archives, which can only be read in order), and compares the
+    checksums with every manifest. Files listed in ``fetch.txt`` that are not in the
+    BDBag are not checked.
+
+    Arguments:
+        bag_path (str): The BDBag directory, or a zip, tar or tar.zst archive of one.
+        mode (str): One of MODES. Default None, to use CONFIG["BAG_VERIFY"].
+        processes (int): The number of processes to hash with.
+                Default None, to use CONFIG["HASH_PROCESSES"], or one per CPU.
+
+    Returns:
+        dict: What is wrong with each bad file, by its path in the BDBag. Empty if
+                the BDBag is intact.
+    """
+    mode = mode or CONFIG["BAG_VERIFY"]
+    if mode not in MODES:
+        raise ValueError("Unknown BDBag verification mode '{}', use one of: {}"
+                         .format(mode, ", ".join(MODES)))
+    if mode == "none":
+        return {}
+    logger.debug("Verifying BDBag '{}' ({})".format(bag_path, mode))
+    if os.path.isdir(bag_path):
+        reader = _DirectoryReader(bag_path)
+    elif zipfile.is_zipfile(bag_path):
+        reader = _ZipReader(bag_path)
+    else:
+        reader = _TarReader(bag_path)
+
+    problems = {}
+    if "bagit.txt" not in reader.sizes:
+        return {"bagit.txt": "missing, this is not a BDBag"}
+    manifests, tag_manifests = {}, {}
+    for name in reader.sizes:
+        match = MANIFEST.match(name)
+        if match:
+            found = tag_manifests if match.group(1) else manifests
+            found[match.group(2)] = _read_manifest(reader.read_text(name))
+    fetched = {}
+    if "fetch.txt" in reader.sizes:
+        fetched = {path: size for path, (url, size) in
+                   remote.read_fetch(reader.read_text("fetch.txt")).items()}
+
+    payload = set(path for entries in manifests.values() for path in entries)
+    for path in sorted(payload | set(p for e in tag_manifests.values() for p in e)):
+        if path in reader.sizes:
+            if fetched.get(path) is not None and fetched[path] != reader.sizes[path]:
+                problems[path] = "is {} bytes, not the {} in fetch.txt".format(
+                    reader.sizes[path], fetched[path])
+        elif path not in fetched:
+            problems[path] = "missing"
+    for path in sorted(reader.sizes):
+        if path.startswith("data/") and path not in payload:
+            problems[path] = "not in any manifest"
+
+    oxum = _payload_oxum(reader.read_text("bag-info.txt")) if "bag-info.txt" in reader.sizes \
+        else None
+    remote_sizes = [fetched.get(path) for path in payload if path not in reader.sizes]
+    if oxum and not problems and None not in remote_sizes:
+        total = sum(reader.sizes[path] for path in payload if path in reader.sizes) \
+            + sum(remote_sizes)
+        if oxum != (total, len(payload)):
+            problems["bag-info.txt"] = ("Payload-Oxum is {}.{}, but the payload has {} bytes in "
+                                        "{} files".format(oxum[0], oxum[1], total, len(payload)))
+
+    if mode == "full":
+        expected = {}
+        for alg, entries in list(manifests.items()) + list(tag_manifests.items()):
+            for path, digest in entries.items():
+                if path in reader.sizes and path not in problems:
+                    expected.setdefault(path, {})[alg] = digest
+        algorithms = sorted(set(alg for digests in expected.values() for alg in digests))
+        hashes = reader.hash(list(expected), algorithms, processes)
+        for path, digests in sorted(expected.items()):
+            wrong = [alg for alg, digest in digests.items() if hashes[path][alg] != digest]
+            if wrong:
+                problems[path] = "{} checksum does not match".format(", ".join(sorted(wrong)))
+    return problems
+
+
+def check_bag(bag_path, mode=None, processes=None):
+    """Raise exc.CorruptBag naming the bad files if verify_bag() finds any."""
+    problems = verify_bag(bag_path, mode, processes)
+    if problems:
+        lines = ["  {}: {}".format(path, problem)
+                 for path, problem in sorted(problems.items())[:MAX_REPORTED]]
+        if len(problems) > MAX_REPORTED:
+            lines.append("  and {} more".format(len(problems) - MAX_REPORTED))
+        raise exc.CorruptBag("BDBag '{}' does not match its manifests, {} bad files:\n{}"
+                             .format(bag_path, len(problems), "\n".join(lines)))
+    logger.debug("BDBag '{}' verified".format(bag_path))
+
+
+def _read_manifest(text):
+    """The digests in a manifest, by path."""
+    entries = {}
+    for line in text.splitlines():
+        if line.strip():
+            digest, filename = line.strip().split(None, 1)
+            entries[_normalize(bdbagit._decode_filename(filename))] = digest.lower()
+    return entries
+
+
+def _normalize(path):
+    return posixpath.normpath(path.replace("\\", "/"))
+
+
+def _payload_oxum(bag_info):
+    for line in bag_info.splitlines():
+        key, _, value = line.partition(":")
+        if key.strip().lower() == "payload-oxum":
+            total, _, count = value.strip().partition(".")
+            try:
+                return int(total), int(count)
+            except ValueError:
+                return None
+    return None
+
+
+def _hash_zip_batch(archive_path, names, algorithms):
+    with zipfile.ZipFile(archive_path) as zip_file:
+        results = []
+        for name in names:
+            with zip_file.open(name) as f:
+                results.append((name, checksums.stream_hashes(f, algorithms)))
+        return results
+
+
+class _DirectoryReader:
+    """The sizes of the files in a BDBag directory, by their paths in it with "/"
+    separators."""
+
+    def __init__(self, bag_path):
+        self.bag_path = bag_path
+        self.sizes = {}
+        for root, _, files in os.walk(bag_path, followlinks=True):
+            for f in files:
+                path = os.path.join(root, f)
+                relpath = os.path.relpath(path, bag_path).replace(os.sep, "/")
+                self.sizes[relpath] = os.path.getsize(path)
+
+    def read_text(self, relpath):
+        with open(os.path.join(self.bag_path, relpath), encoding="utf-8-sig") as f:
+            return f.read()
+
+    def hash(self, relpaths, algorithms, processes):
+        paths = {os.path.join(self.bag_path, relpath): relpath for relpath in relpaths}
+        hashed = checksums.hash_in_batches(
+            {path: self.sizes[relpath] for path, relpath in paths.items()}, algorithms, processes)
+        return {paths[path]: digests for path, (size, digests) in hashed.items()}
+
+
+class _ZipReader:
+    """Like _DirectoryReader, for a zip archive of a BDBag, whose members are hashed on a
+    pool of processes that each open the archive."""
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        with zipfile.ZipFile(archive_path) as zip_file:
+            infos = [info for info in zip_file.infolist() if not info.is_dir()]
+        self.prefix = archive.bag_prefix([info.filename for info in infos])
+        self.names = {}
+        self.sizes = {}
+        for info in infos:
+            if info.filename.startswith(self.prefix):
+                relpath = info.filename[len(self.prefix):]
+                self.names[relpath] = info.filename
+                self.sizes[relpath] = info.file_size
+
+    def read_text(self, relpath):
+        with zipfile.ZipFile(self.archive_path) as zip_file:
+            return zip_file.read(self.names[relpath]).decode("utf-8-sig")
+
+    def hash(self, relpaths, algorithms, processes):
+        hashed = checksums.hash_in_batches(
+            {self.names[r]: self.sizes[r] for r in relpaths}, algorithms, processes,
+            functools.partial(_hash_zip_batch, self.archive_path))
+        relpaths = {name: relpath for relpath, name in self.names.items()}
+        return {relpaths[name]: digests for name, (size, digests) in hashed.items()}
+
+
+class _TarReader:
+    """Like _DirectoryReader, for a tar archive of a BDBag, which is read in order: once
+    for its sizes and tag files, and once more to hash it."""
+
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.texts = {}
+        self.sizes = {}
+        with self._open() as tar:
+            members = []
+            for member in tar:
+                if member.isfile():
+                    members.append(member.name)
+                    # Keep what may be tag files, which are small, until the top of the
+                    # BDBag is known
+                    if _is_tag_file(member.name):
+                        self.texts[member.name] = tar.extractfile(member).read()
+                    self.sizes[member.name] = member.size
+        self.prefix = archive.bag_prefix(members)
+        self.texts = {name: text for name, text in self.texts.items()
+                      if name.startswith(self.prefix) and _is_tag_file(name[len(self.prefix):])}
+        self.sizes = {name[len(self.prefix):]: size for name, size in self.sizes.items()
+                      if name.startswith(self.prefix)}
+
+    def read_text(self, relpath):
+        return self.texts[self.prefix + relpath].decode("utf-8-sig")
+
+    def hash(self, relpaths, algorithms, processes):
+        wanted = set(self.prefix + relpath for relpath in relpaths)
+        hashed = {}
+        with self._open() as tar:
+            for member in tar:
+                if member.isfile() and member.name in wanted:
+                    _, digests = checksums.stream_hashes(tar.extractfile(member), algorithms)
+                    hashed[member.name[len(self.prefix):]] = digests
+        return hashed
+
+    @contextlib.contextmanager
+    def _open(self):
+        try:
+            with open(self.archive_path, "rb") as f:
+                if self.archive_path.endswith(".zst"):
+                    if archive.zstandard is None:
+                        raise exc.InvalidInput("Reading '{}' requires the 'zstandard' package"
+                                               .format(self.archive_path))
+                    with archive.zstandard.ZstdDecompressor().stream_reader(f) as data, \
+                            tarfile.open(fileobj=data, mode="r|") as tar:
+                        yield tar
+                else:
+                    with tarfile.open(fileobj=f, mode="r|*") as tar:
+                        yield tar
+        except tarfile.TarError as e:
+            raise exc.InvalidInput("Unable to read archive '{}': {}"
+                                   .format(self.archive_path, e))
+
+
+def _is_tag_file(name):
+    """Could name be a tag file of a BDBag at the top of the archive, or in a directory
+    at the top, whatever that directory is called?"""
+    basename = posixpath.basename(name)
+    return name.count("/") <= 1 and (
+        basename in ("bagit.txt", "bag-info.txt", "fetch.txt") or MANIFEST.match(basename))
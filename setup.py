@@ -36,6 +36,9 @@ setup(
         "requests>=2.22.0",
         "typer[all]<0.4.0,>=0.3.0",
     ],
+    extras_require={
+        "zstd": ["zstandard>=0.15"],
+    },
     python_requires=">=3.6",
     license='Apache 2.0',
     maintainer='CFDE',
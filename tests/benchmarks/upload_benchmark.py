@@ -0,0 +1,234 @@
+"""Upload throughput benchmark for cfde_submit.globus_http.upload, run against the local
+HTTPS stand-in server in tests/unit/gcs_server.py.
+
+Each archive size is uploaded by a separate process, so its peak memory is measured on
+its own. For every size, the benchmark reports:
+
+    throughput  Bytes uploaded per second
+    latency     Seconds from calling upload() until the first upload body reached the
+                server, which covers the authorization probe and journal setup
+    peak_rss    Peak resident memory of the uploading process, in bytes, or null where
+                it cannot be measured (Windows)
+
+Results can be saved per release in tests/benchmarks/results/<version>.json, and compared
+with the results of the newest earlier release to catch regressions:
+
+    python -m tests.benchmarks.upload_benchmark --sizes 1MB,100MB,10GB --save --compare
+
+Archives are sparse files, so even the largest sizes need almost no disk space.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from packaging.version import parse as parse_version
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEFAULT_SIZES = "1MB,10MB,100MB,1GB"
+SIZE_UNITS = {
+    "KB": 10 ** 3, "MB": 10 ** 6, "GB": 10 ** 9,
+    "KIB": 2 ** 10, "MIB": 2 ** 20, "GIB": 2 ** 30,
+}
+TOKEN = "benchmark-token"
+# Differences smaller than these are noise, whatever the tolerance
+MIN_LATENCY_CHANGE = 0.05
+MIN_RSS_CHANGE = 8 * 2 ** 20
+
+
+def parse_size(size):
+    """Convert a size like '10GB' or '512MiB' to a number of bytes."""
+    number = size.upper().rstrip("BI KMG")
+    unit = size.upper()[len(number):].strip() or "B"
+    return int(float(number) * SIZE_UNITS.get(unit, 1))
+
+
+def run(sizes, chunk_size=None, workers=None):
+    """Upload an archive of each size, each in a separate process.
+
+    Returns:
+        dict: Results by size label.
+    """
+    from tests.unit.gcs_server import GCSServer
+
+    results = {}
+    server = GCSServer(tls=True, token=TOKEN, store=False).start()
+    try:
+        with tempfile.TemporaryDirectory(prefix="cfde_benchmark_") as tmp:
+            for label in sizes:
+                size = parse_size(label)
+                path = os.path.join(tmp, "bag_{}.zip".format(label))
+                with open(path, "wb") as f:
+                    f.truncate(size)
+                server.first_put = None
+                url = "{}/benchmark/{}".format(server.url, os.path.basename(path))
+                results[label] = _run_case(server, path, url, chunk_size, workers)
+                os.remove(path)
+                received = server.received.pop("/benchmark/" + os.path.basename(path), 0)
+                if received < size:
+                    raise RuntimeError("Server received {} of {} bytes for {}"
+                                       .format(received, size, label))
+    finally:
+        server.stop()
+    return results
+
+
+def _run_case(server, path, url, chunk_size, workers):
+    command = [sys.executable, "-m", "tests.benchmarks.upload_benchmark", "--case", path, url]
+    if chunk_size:
+        command += ["--chunk-size", str(chunk_size)]
+    if workers:
+        command += ["--workers", str(workers)]
+    env = dict(os.environ, REQUESTS_CA_BUNDLE=server.cert_path)
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=env, cwd=REPO_ROOT)
+    output, _ = process.communicate()
+    if process.returncode:
+        raise RuntimeError("Benchmark of {} failed".format(path))
+    result = json.loads(output.decode())
+    if not result.pop("success"):
+        raise RuntimeError("Upload of {} failed: {}".format(path, result.get("error")))
+    result["latency"] = (server.first_put or result["started"]) - result.pop("started")
+    return result
+
+
+def upload_case(path, url, chunk_size=None, workers=None):
+    """Upload one archive with a pooled session, as CfdeClient does, and report on it."""
+    import globus_sdk
+    from cfde_submit import globus_http, session
+
+    started = time.time()
+    res = globus_http.upload(path, url, globus_sdk.AccessTokenAuthorizer(TOKEN),
+                             chunk_size=chunk_size, workers=workers,
+                             session=session.PooledSession())
+    result = {"success": res["success"], "started": started, "peak_rss": _peak_rss()}
+    if res["success"]:
+        result.update(bytes=res["bytes"], seconds=res["seconds"],
+                      throughput=res["throughput"])
+    else:
+        result["error"] = res.get("error")
+    return result
+
+
+def _peak_rss():
+    """The peak resident memory of this process in bytes, or None on platforms without
+    the resource module, such as Windows."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux, and bytes on macOS
+    return peak if platform.system() == "Darwin" else peak * 1024
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Find regressions against baseline results.
+
+    Throughput may not drop, and latency and peak memory may not grow, by more than
+    tolerance (a fraction of the baseline). Peak memory is only compared when both
+    results measured it.
+
+    Returns:
+        list: A message for each regression.
+    """
+    regressions = []
+    for label, result in results.items():
+        base = baseline.get(label)
+        if not base:
+            continue
+        if result["throughput"] < base["throughput"] * (1 - tolerance):
+            regressions.append("{}: throughput fell from {:.1f} to {:.1f} MB/s".format(
+                label, base["throughput"] / 1e6, result["throughput"] / 1e6))
+        if result["latency"] > max(base["latency"] * (1 + tolerance),
+                                   base["latency"] + MIN_LATENCY_CHANGE):
+            regressions.append("{}: latency rose from {:.3f}s to {:.3f}s".format(
+                label, base["latency"], result["latency"]))
+        if result["peak_rss"] is None or base.get("peak_rss") is None:
+            continue
+        if result["peak_rss"] > max(base["peak_rss"] * (1 + tolerance),
+                                    base["peak_rss"] + MIN_RSS_CHANGE):
+            regressions.append("{}: peak memory rose from {:.0f} to {:.0f} MiB".format(
+                label, base["peak_rss"] / 2 ** 20, result["peak_rss"] / 2 ** 20))
+    return regressions
+
+
+def latest_baseline(version):
+    """Load the saved results of the newest release before version, if any.
+
+    Returns:
+        tuple: The baseline version and its results, or (None, None).
+    """
+    versions = []
+    for filename in os.listdir(RESULTS_DIR) if os.path.isdir(RESULTS_DIR) else []:
+        name, ext = os.path.splitext(filename)
+        if ext == ".json" and parse_version(name) < parse_version(version):
+            versions.append(name)
+    if not versions:
+        return None, None
+    newest = max(versions, key=parse_version)
+    with open(os.path.join(RESULTS_DIR, newest + ".json")) as f:
+        return newest, json.load(f)["results"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default=DEFAULT_SIZES,
+                        help="Comma-separated archive sizes (default %(default)s)")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Upload part size, bytes")
+    parser.add_argument("--workers", type=int, default=None, help="Parallel upload parts")
+    parser.add_argument("--save", action="store_true",
+                        help="Save results for the current version in " + RESULTS_DIR)
+    parser.add_argument("--compare", action="store_true",
+                        help="Fail on regressions against the newest earlier release")
+    parser.add_argument("--baseline", help="Fail on regressions against this results file")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed fraction of change before it is a regression")
+    parser.add_argument("--case", nargs=2, metavar=("PATH", "URL"), help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(upload_case(*args.case, chunk_size=args.chunk_size,
+                                     workers=args.workers)))
+        return 0
+
+    from cfde_submit.version import __version__
+    results = run(args.sizes.split(","), args.chunk_size, args.workers)
+    print("{:>8} {:>12} {:>10} {:>10}".format("size", "MB/s", "latency", "peak MiB"))
+    for label, result in results.items():
+        peak = result["peak_rss"]
+        print("{:>8} {:>12.1f} {:>9.3f}s {:>10}".format(
+            label, result["throughput"] / 1e6, result["latency"],
+            "-" if peak is None else "{:.0f}".format(peak / 2 ** 20)))
+
+    if args.save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        with open(os.path.join(RESULTS_DIR, __version__ + ".json"), "w") as f:
+            json.dump({"version": __version__, "python": platform.python_version(),
+                       "platform": platform.platform(), "results": results},
+                      f, indent=4, sort_keys=True)
+
+    baseline_version, baseline = None, None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline_version, baseline = args.baseline, json.load(f)["results"]
+    elif args.compare:
+        baseline_version, baseline = latest_baseline(__version__)
+        if not baseline:
+            print("No results from an earlier release to compare with")
+    if baseline:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION since {}: {}".format(baseline_version, regression))
+        if regressions:
+            return 1
+        print("No regressions since {}".format(baseline_version))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
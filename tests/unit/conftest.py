@@ -1,15 +1,24 @@
 import cfde_submit
 import fair_research_login
+import os
 import globus_sdk
 import pytest
-from cfde_submit import CONFIG, version, validation, globus_http, bdbag_utils
+from cfde_submit import CONFIG, version, validation, globus_http, bdbag_utils, scan
 from unittest.mock import Mock, PropertyMock
+from .gcs_server import GCSServer
 
 # Maximum output logging!
 CONFIG['LOGGING']['handlers']['console']['class'] = 'logging.StreamHandler'
 CONFIG['LOGGING']['handlers']['console']['level'] = 'DEBUG'
 
 
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    """Keep local caches out of the home directory"""
+    monkeypatch.setitem(CONFIG, "CACHE_DIR", str(tmp_path / "cache"))
+    return tmp_path / "cache"
+
+
 @pytest.fixture(autouse=True)
 def mock_login(monkeypatch):
     """Unit tests should never need to call login() or logout(), as doing so
@@ -83,19 +92,43 @@ def mock_gcp_installed(mock_gcp_uninstalled):
 
 @pytest.fixture
 def mock_upload(monkeypatch):
-    monkeypatch.setattr(globus_http, 'upload', Mock())
+    monkeypatch.setattr(globus_http, 'upload', Mock(return_value={"success": True}))
     return globus_http.upload
 
 
+# Contents of the archives created by mock_get_bag
+MOCK_BAG_CONTENTS = b"mock bdbag archive"
+
+
 @pytest.fixture
-def mock_get_bag(monkeypatch):
-    """Simply returns the path passed in, and does no error checking on any local bags"""
+def mock_get_bag(monkeypatch, tmp_path):
+    """Simply returns the path passed in, and does no error checking on any local bags.
+    Relative paths are created in a temporary working directory, with MOCK_BAG_CONTENTS."""
+    monkeypatch.chdir(tmp_path)
+
     def mock_get_bag(bag_path, *args, **kwargs):
+        if not os.path.exists(bag_path):
+            with open(bag_path, "wb") as f:
+                f.write(MOCK_BAG_CONTENTS)
         return bag_path
     monkeypatch.setattr(bdbag_utils, 'get_bag', mock_get_bag)
+
+    # The data is scanned before it is bagged, so it must exist by then
+    plan_submission = scan.plan_submission
+
+    def mock_plan_submission(data_path, *args, **kwargs):
+        return plan_submission(mock_get_bag(data_path), *args, **kwargs)
+    monkeypatch.setattr(scan, 'plan_submission', mock_plan_submission)
     return bdbag_utils.get_bag
 
 
+@pytest.fixture(autouse=True)
+def mock_is_uploaded(monkeypatch):
+    """Never check the real HTTPS server for previously uploaded archives"""
+    monkeypatch.setattr(globus_http, 'is_uploaded', Mock(return_value=False))
+    return globus_http.is_uploaded
+
+
 @pytest.fixture
 def mock_validation(monkeypatch):
     monkeypatch.setattr(validation, 'validate_user_submission', Mock())
@@ -144,3 +177,20 @@ def mock_globus_api_error(monkeypatch):
 def mock_globus_sdk(monkeypatch):
     setattr(globus_sdk.TransferClient, "operation_ls", PropertyMock())
     return globus_sdk
+
+
+@pytest.fixture
+def gcs_server():
+    """A local stand-in for the Globus HTTPS server"""
+    server = GCSServer().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def mock_authorizer():
+    def set_authorization_header(headers):
+        headers["Authorization"] = "Bearer mock_https_token"
+    authorizer = Mock()
+    authorizer.set_authorization_header.side_effect = set_authorization_header
+    return authorizer
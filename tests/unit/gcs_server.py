@@ -0,0 +1,220 @@
+"""A minimal local stand-in for the Globus HTTPS server, for exercising uploads
+without the production endpoint. Supports whole-object and ``Content-Range`` PUTs,
+HEAD and GET, optional TLS and bearer tokens, and can be told to fail specific requests."""
+import datetime
+import ipaddress
+import os
+import re
+import shutil
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+)")
+READ_SIZE = 1024 * 1024
+
+
+class GCSHandler(BaseHTTPRequestHandler):
+    # Keep connections alive between requests
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _injected_failure(self):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+            failure = server.fail_requests.pop(server.request_count, None)
+        if failure:
+            return failure
+        if server.token and self.headers.get("Authorization") != "Bearer " + server.token:
+            return 401
+
+    def _read_body(self, sink):
+        """Pass the request body to sink piece by piece, and return its length."""
+        if self.headers.get("Transfer-Encoding") != "chunked":
+            remaining = int(self.headers.get("Content-Length", 0))
+            while remaining:
+                data = self.rfile.read(min(remaining, READ_SIZE))
+                if not data:
+                    break
+                sink(data)
+                remaining -= len(data)
+            return int(self.headers.get("Content-Length", 0)) - remaining
+        length = 0
+        while True:
+            size = int(self.rfile.readline().split(b";")[0], 16)
+            if not size:
+                self.rfile.readline()
+                return length
+            sink(self.rfile.read(size))
+            length += size
+            self.rfile.readline()
+
+    def do_PUT(self):
+        started = time.time()
+        body = bytearray()
+        length = self._read_body(body.extend if self.server.store else _discard)
+        content_range = self.headers.get("Content-Range")
+        self.server.requests.append(("PUT", self.path, content_range, length))
+        failure = self._injected_failure()
+        if failure:
+            return self._respond(failure)
+        with self.server.lock:
+            if self.server.first_put is None:
+                self.server.first_put = started
+            self.server.received[self.path] = self.server.received.get(self.path, 0) + length
+            if self.server.store and content_range and self.server.ranges:
+                start, end, total = (int(g) for g in CONTENT_RANGE.match(content_range).groups())
+                obj = self.server.objects.setdefault(self.path, bytearray(total))
+                if len(obj) != total:
+                    obj.extend(bytes(total - len(obj)))
+                obj[start:end + 1] = body
+            elif self.server.store:
+                self.server.objects[self.path] = body
+        self._respond(200)
+
+    def do_HEAD(self):
+        self.server.requests.append(("HEAD", self.path, None, 0))
+        failure = self._injected_failure()
+        if failure:
+            return self._respond(failure)
+        obj = self.server.objects.get(self.path)
+        if obj is None:
+            return self._respond(404)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(obj)))
+        self.end_headers()
+
+    def do_GET(self):
+        self.server.requests.append(("GET", self.path, None, 0))
+        failure = self._injected_failure()
+        if failure:
+            return self._respond(failure)
+        obj = self.server.objects.get(self.path)
+        if obj is None:
+            return self._respond(404)
+        self._respond(200, bytes(obj))
+
+
+def _discard(data):
+    pass
+
+
+class GCSServer(socketserver.ThreadingMixIn, HTTPServer):
+    """Serves objects from memory.
+
+    ``fail_requests`` maps the 1-based number of a request to the HTTP status it should
+    receive instead of being handled. When ``token`` is set, requests without it as a
+    bearer token are refused with 401, and it can be changed at any time to simulate an
+    expired token.
+    """
+    daemon_threads = True
+
+    def __init__(self, tls=False, token=None, store=True, ranges=True):
+        """
+        Arguments:
+            tls (bool): Serve HTTPS with a self-signed certificate, written to
+                    ``cert_path``. Default False.
+            token (str): The bearer token every request must carry. Default None.
+            store (bool): Keep uploaded objects in memory? When False, PUT bodies are
+                    only counted in ``received``, so huge uploads can be served.
+                    Default True.
+            ranges (bool): Honor ``Content-Range``? When False, each PUT replaces the
+                    whole object, like a server without ranged upload support.
+                    Default True.
+        """
+        super().__init__(("127.0.0.1", 0), GCSHandler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.received = {}
+        self.requests = []
+        self.request_count = 0
+        self.fail_requests = {}
+        self.token = token
+        self.store = store
+        self.ranges = ranges
+        self.first_put = None
+        self.cert_dir = None
+        if tls:
+            self.cert_dir = tempfile.mkdtemp(prefix="gcs_server_")
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*self_signed_certificate(self.cert_dir))
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def puts(self, path=None):
+        """The Content-Range (or None) of each PUT received so far, to path if given"""
+        return [r[2] for r in self.requests if r[0] == "PUT" and path in (None, r[1])]
+
+    @property
+    def url(self):
+        scheme = "https" if self.cert_dir else "http"
+        return "{}://{}:{}".format(scheme, *self.server_address)
+
+    @property
+    def cert_path(self):
+        """The certificate clients must trust to reach a TLS server"""
+        return os.path.join(self.cert_dir, "cert.pem") if self.cert_dir else None
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.cert_dir:
+            shutil.rmtree(self.cert_dir, ignore_errors=True)
+
+
+def self_signed_certificate(directory):
+    """Write a key and self-signed certificate for 127.0.0.1 into directory.
+
+    Returns:
+        tuple: The paths of the certificate and the key.
+    """
+    from cryptography import x509
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.IPAddress(ipaddress.ip_address("127.0.0.1")), x509.DNSName("localhost")]),
+            critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256(), default_backend())
+    )
+    cert_path, key_path = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
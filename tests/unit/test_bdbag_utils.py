@@ -0,0 +1,335 @@
+import io
+import os
+import shutil
+import tarfile
+import time
+import zipfile
+import zlib
+
+import pytest
+from bdbag import bdbag_api
+from cfde_submit import CONFIG, archive, bdbag_utils, checksums, exc
+
+
+def make_dataset(tmp_path, name="dataset"):
+    dataset = tmp_path / name
+    dataset.mkdir()
+    (dataset / "file.tsv").write_text("id\tname\n1\tone\n")
+    (dataset / "datapackage.json").write_text("{}")
+    return dataset
+
+
+def test_get_bag_archives_directory(tmp_path):
+    dataset = make_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False)
+    assert bag_archive == str(tmp_path / "dataset.zip")
+    assert bdbag_api.is_bag(str(dataset))
+    assert not (tmp_path / "cache" / "archives").exists()
+
+
+def test_get_bag_archives_directory_in_cache(tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG, "ARCHIVE_CACHE", True)
+    dataset = make_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False)
+    assert bag_archive.startswith(str(tmp_path / "cache" / "archives"))
+    assert os.path.basename(bag_archive) == "dataset.zip"
+    assert not (tmp_path / "dataset.zip").exists()
+
+
+def test_get_bag_reuses_unchanged_directory(tmp_path, monkeypatch):
+    dataset = make_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), output_dir=str(tmp_path / "bag"),
+                                      delete_dir=True, handle_git_repos=False,
+                                      cache_archive=True)
+    assert os.path.basename(bag_archive) == "bag.zip"
+
+    def make_bag(*args, **kwargs):
+        raise AssertionError("Unchanged data was bagged again")
+    monkeypatch.setattr(bdbag_api, "make_bag", make_bag)
+    assert bdbag_utils.get_bag(str(dataset), output_dir=str(tmp_path / "bag"),
+                               delete_dir=True, handle_git_repos=False,
+                               cache_archive=True) == bag_archive
+    assert not (tmp_path / "bag").exists()
+    # Any change to the data, or the options, is a new archive
+    with pytest.raises(AssertionError):
+        bdbag_utils.get_bag(str(dataset), output_dir=str(tmp_path / "bag"),
+                            handle_git_repos=False, bdbag_kwargs={"metadata": {"a": "b"}},
+                            cache_archive=True)
+    shutil.rmtree(str(tmp_path / "bag"))
+    (dataset / "file.tsv").write_text("id\tname\n1\ttwo\n")
+    with pytest.raises(AssertionError):
+        bdbag_utils.get_bag(str(dataset), output_dir=str(tmp_path / "bag"),
+                            handle_git_repos=False, cache_archive=True)
+
+
+def test_get_bag_reuses_directory_bagged_in_place(tmp_path, monkeypatch):
+    dataset = make_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False, cache_archive=True)
+    assert bdbag_api.is_bag(str(dataset))
+
+    def archive_again(*args, **kwargs):
+        raise AssertionError("The BDBag was archived again")
+    monkeypatch.setattr(archive, "write_archive", archive_again)
+    # The payload is unchanged by bagging, so the BDBag finds its own archive
+    assert bdbag_utils.get_bag(str(dataset), handle_git_repos=False,
+                               cache_archive=True) == bag_archive
+    # But not once its metadata has changed
+    os.utime(str(dataset / "bag-info.txt"), (os.path.getmtime(bag_archive) + 10,) * 2)
+    with pytest.raises(AssertionError):
+        bdbag_utils.get_bag(str(dataset), handle_git_repos=False, cache_archive=True)
+
+
+def test_get_bag_reads_payload_once(tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG, "HASH_PROCESSES", 1)
+    dataset = make_dataset(tmp_path)
+    # Files modified in the last few seconds are never cached
+    for path in dataset.iterdir():
+        os.utime(str(path), (time.time() - 60,) * 2)
+    reads = []
+    file_hashes = checksums.file_hashes
+
+    def counting_file_hashes(path, algorithms):
+        reads.append(os.path.basename(path))
+        return file_hashes(path, algorithms)
+    monkeypatch.setattr(checksums, "file_hashes", counting_file_hashes)
+    # The archive cache key and the manifests share one read of each file
+    bdbag_utils.get_bag(str(dataset), handle_git_repos=False, cache_archive=True)
+    assert sorted(reads) == ["datapackage.json", "file.tsv"]
+
+
+def test_archive_cache_evicts_least_recently_used(tmp_path):
+    cache = archive.ArchiveCache(str(tmp_path / "archives"), max_bytes=250)
+    for i, key in enumerate(["old", "used", "new"]):
+        entry = cache.new_entry(key)
+        with open(os.path.join(entry, "bag.zip"), "wb") as f:
+            f.write(b"\0" * 100)
+        with open(os.path.join(entry, "bag.zip.sha256"), "w") as f:
+            f.write("0  bag.zip\n")
+        os.utime(entry, (i, i))
+    assert cache.get("used", "bag", "deflate") == os.path.join(cache.path, "used", "bag.zip")
+    assert cache.evict(keep="new") == 1
+    assert sorted(os.listdir(cache.path)) == ["new", "used"]
+    assert cache.get("old", "bag", "deflate") is None
+    assert cache.purge() == 2
+
+
+def test_get_bag_stream(tmp_path):
+    dataset = make_dataset(tmp_path)
+    bag_stream = bdbag_utils.get_bag(str(dataset), handle_git_repos=False, stream=True)
+    assert isinstance(bag_stream, archive.BagStream)
+    assert bag_stream.name == "dataset.zip"
+    assert not (tmp_path / "dataset.zip").exists()
+
+    streamed = b"".join(bag_stream)
+    archived = bdbag_api.archive_bag(str(dataset), "zip")
+    with zipfile.ZipFile(io.BytesIO(streamed)) as streamed_zip, \
+            zipfile.ZipFile(archived) as archived_zip:
+        assert streamed_zip.namelist() == archived_zip.namelist()
+        for name in archived_zip.namelist():
+            assert streamed_zip.read(name) == archived_zip.read(name)
+
+
+def test_get_bag_store_codec(tmp_path):
+    dataset = make_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False, codec="store")
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert {i.compress_type for i in zip_file.infolist()} == {zipfile.ZIP_STORED}
+        assert zip_file.read("dataset/data/file.tsv") == b"id\tname\n1\tone\n"
+
+
+def test_get_bag_stores_precompressed_files(tmp_path):
+    dataset = make_dataset(tmp_path)
+    (dataset / "reads.bam").write_bytes(b"\0" * 4096)
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False, level=9)
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert zip_file.getinfo("dataset/data/reads.bam").compress_type == zipfile.ZIP_STORED
+        assert zip_file.getinfo("dataset/data/file.tsv").compress_type == zipfile.ZIP_DEFLATED
+    assert bdbag_api.is_bag(bdbag_api.extract_bag(bag_archive, temp=True))
+
+
+def test_get_bag_zstd_codec(tmp_path):
+    pytest.importorskip("zstandard")
+    dataset = make_dataset(tmp_path)
+    # Linked files are archived as files
+    os.link(str(dataset / "file.tsv"), str(dataset / "hardlink.tsv"))
+    os.symlink("file.tsv", str(dataset / "symlink.tsv"))
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False, codec="zstd")
+    assert os.path.basename(bag_archive) == "dataset.tar.zst"
+    extracted = archive.extract_tar_zstd(bag_archive)
+    assert os.path.basename(extracted) == "dataset"
+    assert bdbag_api.is_bag(extracted)
+    for name in ("file.tsv", "hardlink.tsv", "symlink.tsv"):
+        with open(os.path.join(extracted, "data", name)) as f:
+            assert f.read() == "id\tname\n1\tone\n"
+
+
+@pytest.mark.parametrize("link_type", [tarfile.SYMTYPE, tarfile.LNKTYPE])
+def test_extract_tar_zstd_rejects_links(tmp_path, link_type):
+    zstandard = pytest.importorskip("zstandard")
+    archive_file = str(tmp_path / "bag.tar.zst")
+    with open(archive_file, "wb") as f, zstandard.ZstdCompressor().stream_writer(f) as out, \
+            tarfile.open(fileobj=out, mode="w|") as tar:
+        link = tarfile.TarInfo("bag/data/passwd")
+        link.type = link_type
+        link.linkname = "/etc/passwd"
+        tar.addfile(link)
+    output = tmp_path / "out"
+    output.mkdir()
+    with pytest.raises(exc.InvalidInput, match="link"):
+        archive.extract_tar_zstd(archive_file, str(output))
+    assert not (output / "bag" / "data" / "passwd").exists()
+
+
+def test_get_bag_rejects_bad_level(tmp_path):
+    dataset = make_dataset(tmp_path)
+    with pytest.raises(exc.InvalidInput):
+        bdbag_utils.get_bag(str(dataset), handle_git_repos=False, level=12)
+
+
+def make_git_dataset(tmp_path):
+    git = pytest.importorskip("git")
+    dataset = make_dataset(tmp_path)
+    repo = git.Repo.init(str(dataset))
+    repo.index.add(["file.tsv", "datapackage.json"])
+    actor = git.Actor("Test", "test@example.com")
+    repo.index.commit("Add dataset", author=actor, committer=actor)
+    # Neither uncommitted changes nor untracked files are bagged
+    (dataset / "file.tsv").write_text("id\tname\n1\tchanged\n")
+    (dataset / "untracked.tsv").write_text("junk")
+    return dataset, str(repo.head.commit)
+
+
+def test_get_bag_git_repo_bags_head(tmp_path):
+    dataset, commit = make_git_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset))
+    # Like other directories, Git repositories are only cached if asked to
+    assert bag_archive == str(tmp_path / "dataset_{}.zip".format(commit))
+    assert not (tmp_path / "cache" / "archives").exists()
+    # The exported tree is removed, and the repository is untouched
+    assert not os.path.exists(bag_archive[:-len(".zip")])
+    assert not bdbag_api.is_bag(str(dataset))
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        payload = sorted(n for n in zip_file.namelist() if "/data/" in n and n[-1] != "/")
+        assert payload == ["dataset_{}/data/datapackage.json".format(commit),
+                           "dataset_{}/data/file.tsv".format(commit)]
+        assert (zip_file.read("dataset_{}/data/file.tsv".format(commit))
+                == b"id\tname\n1\tone\n")
+
+
+def test_get_bag_git_repo_reuses_commit(tmp_path, monkeypatch):
+    dataset, commit = make_git_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), cache_archive=True)
+    assert bag_archive.startswith(str(tmp_path / "cache" / "archives"))
+    assert os.path.basename(bag_archive) == "dataset_{}.zip".format(commit)
+
+    def make_bag(*args, **kwargs):
+        raise AssertionError("An unchanged commit was bagged again")
+    monkeypatch.setattr(bdbag_api, "make_bag", make_bag)
+    assert bdbag_utils.get_bag(str(dataset), cache_archive=True) == bag_archive
+    # Archiving differently is a different bag
+    with pytest.raises(AssertionError):
+        bdbag_utils.get_bag(str(dataset), codec="store", cache_archive=True)
+
+
+def test_get_bag_git_subdirectory(tmp_path):
+    dataset, commit = make_git_dataset(tmp_path)
+    subdir = dataset / "sub"
+    subdir.mkdir()
+    (subdir / "nested.tsv").write_text("id\n2\n")
+    repo = pytest.importorskip("git").Repo(str(dataset))
+    repo.index.add(["sub/nested.tsv"])
+    repo.index.commit("Add subdirectory")
+    bag_archive = bdbag_utils.get_bag(str(subdir))
+    commit = str(repo.head.commit)
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert (zip_file.read("sub_{}/data/nested.tsv".format(commit)) == b"id\n2\n")
+        assert not [n for n in zip_file.namelist() if n.endswith("file.tsv")]
+
+
+@pytest.mark.parametrize("ignored", [False, True])
+def test_get_bag_git_untracked_directory(tmp_path, caplog, ignored):
+    dataset, commit = make_git_dataset(tmp_path)
+    (dataset / "untracked").mkdir()
+    (dataset / "untracked" / "file.tsv").write_text("id\n")
+    if ignored:
+        (dataset / ".gitignore").write_text("untracked/\n")
+    # The working tree is bagged, as it is not in HEAD
+    bag_archive = bdbag_utils.get_bag(str(dataset / "untracked"))
+    assert "is not committed" in caplog.text
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert zip_file.read("untracked_{}/data/file.tsv".format(commit)) == b"id\n"
+    assert not (dataset / "untracked_{}".format(commit)).exists()
+    assert not bdbag_api.is_bag(str(dataset / "untracked"))
+
+
+def test_get_bag_git_warns_about_ignored_files(tmp_path, caplog):
+    dataset, commit = make_git_dataset(tmp_path)
+    repo = pytest.importorskip("git").Repo(str(dataset))
+    (dataset / ".gitignore").write_text("*.csv\n")
+    repo.index.add([".gitignore"])
+    repo.index.commit("Ignore CSV files")
+    (dataset / "ignored.csv").write_text("id\n")
+    (dataset / "swap.swp").write_text("junk")
+    bag_archive = bdbag_utils.get_bag(str(dataset))
+    commit = str(repo.head.commit)
+    warning = [r.message for r in caplog.records if "untracked or ignored" in r.message]
+    # Files excluded from the BDBag anyway are not mentioned
+    assert len(warning) == 1 and "ignored.csv" in warning[0] and "swap" not in warning[0]
+    assert "untracked.tsv" in warning[0]
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert "dataset_{}/data/ignored.csv".format(commit) not in zip_file.namelist()
+
+
+def test_submitted_tree_is_head(tmp_path):
+    dataset, commit = make_git_dataset(tmp_path)
+    with bdbag_utils.submitted_tree(str(dataset)) as tree:
+        assert sorted(os.listdir(tree)) == ["datapackage.json", "file.tsv"]
+        assert open(os.path.join(tree, "file.tsv")).read() == "id\tname\n1\tone\n"
+    assert not os.path.exists(tree)
+    with bdbag_utils.submitted_tree(str(dataset), handle_git_repos=False) as tree:
+        assert tree == str(dataset)
+
+
+@pytest.mark.parametrize("threads", [1, 4])
+def test_parallel_deflate(tmp_path, monkeypatch, threads):
+    # Small blocks, so files span many blocks deflated on different threads
+    monkeypatch.setattr(archive, "DEFLATE_BLOCK_SIZE", 4096)
+    monkeypatch.setitem(CONFIG, "ARCHIVE_THREADS", threads)
+    dataset = make_dataset(tmp_path)
+    contents = {
+        "empty.tsv": b"",
+        "repetitive.tsv": b"id\tname\n" * 20000,
+        "random.bin": os.urandom(50000),
+        "reads.bam": os.urandom(10000),
+    }
+    for name, data in contents.items():
+        (dataset / name).write_bytes(data)
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False)
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert zip_file.testzip() is None
+        for name, data in contents.items():
+            assert zip_file.read("dataset/data/" + name) == data
+        info = zip_file.getinfo("dataset/data/repetitive.tsv")
+        assert info.compress_type == zipfile.ZIP_DEFLATED
+        assert info.compress_size < info.file_size / 20
+    assert bdbag_api.is_bag(bdbag_api.extract_bag(bag_archive, temp=True))
+
+
+@pytest.mark.parametrize("parallel", [True, False])
+def test_deflate_round_trip(tmp_path, monkeypatch, parallel):
+    # Without parallel deflate, ZipFile compresses each member itself
+    monkeypatch.setattr(archive, "_can_precompress", lambda: parallel)
+    monkeypatch.setattr(archive, "DEFLATE_BLOCK_SIZE", 4096)
+    dataset = make_dataset(tmp_path)
+    (dataset / "repetitive.tsv").write_bytes(b"id\tname\n" * 20000)
+    (dataset / "random.bin").write_bytes(os.urandom(50000))
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False)
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        assert zip_file.testzip() is None
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            data = zip_file.read(info)
+            assert info.CRC == zlib.crc32(data)
+            assert data == (tmp_path / info.filename).read_bytes()
+        assert zip_file.getinfo("dataset/data/repetitive.tsv").compress_type == zipfile.ZIP_DEFLATED
@@ -0,0 +1,223 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import types
+
+from bdbag import bdbag_api, bdbagit
+from click.testing import CliRunner
+from cfde_submit import bdbag_utils, checksums
+from cfde_submit.main import cli
+
+
+def make_files(directory, sizes):
+    paths = []
+    for i, size in enumerate(sizes):
+        path = os.path.join(str(directory), "file_{}.bin".format(i))
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        paths.append(path)
+    return paths
+
+
+def test_file_hashes(tmp_path):
+    path, = make_files(tmp_path, [3 * checksums.HASH_BLOCK_SIZE + 5])
+    data = open(path, "rb").read()
+    size, digests = checksums.file_hashes(path, ["md5", "sha256"])
+    assert size == len(data)
+    assert digests == {"md5": hashlib.md5(data).hexdigest(),
+                       "sha256": hashlib.sha256(data).hexdigest()}
+
+
+def test_hash_files_in_parallel(tmp_path, monkeypatch):
+    monkeypatch.setattr(checksums, "BATCH_FILES", 2)
+    paths = make_files(tmp_path, [0, 10, 1000, 5, 70000])
+    results = checksums.hash_files(paths, ["sha256"], processes=2)
+    assert results == {path: checksums.file_hashes(path, ["sha256"]) for path in paths}
+
+
+def test_get_bag_manifests_match_bdbag(tmp_path):
+    dataset = tmp_path / "dataset"
+    (dataset / "sub").mkdir(parents=True)
+    make_files(dataset, [100, 2000])
+    make_files(dataset / "sub", [0, 30000])
+    (dataset / "datapackage.json").write_text("{}")
+    reference = tmp_path / "reference"
+    shutil.copytree(str(dataset), str(reference / "dataset"))
+
+    bdbag_utils.get_bag(str(dataset), handle_git_repos=False)
+    assert bdbagit.make_manifests is checksums._bdbag_make_manifests
+    bdbag_api.make_bag(str(reference / "dataset"))
+    for manifest in ("manifest-md5.txt", "manifest-sha256.txt"):
+        assert ((dataset / manifest).read_text()
+                == (reference / "dataset" / manifest).read_text())
+    bdbag_api.validate_bag(str(dataset), fast=False)
+
+
+def test_parallel_manifests_outlives_other_threads(tmp_path, monkeypatch):
+    dataset = tmp_path / "dataset"
+    dataset.mkdir()
+    make_files(dataset, [100, 2000])
+    hashed = []
+    hash_files = checksums.hash_files
+
+    def counting_hash_files(paths, *args, **kwargs):
+        hashed.extend(paths)
+        return hash_files(paths, *args, **kwargs)
+    monkeypatch.setattr(checksums, "hash_files", counting_hash_files)
+    entered, left = threading.Event(), threading.Event()
+
+    def other_thread():
+        with checksums.parallel_manifests():
+            entered.set()
+            left.wait(10)
+    thread = threading.Thread(target=other_thread)
+    thread.start()
+    entered.wait(10)
+    with checksums.parallel_manifests():
+        # The other thread leaving its block does not restore bdbag here
+        left.set()
+        thread.join()
+        bdbag_api.make_bag(str(dataset))
+    assert len(hashed) == 2
+    assert bdbagit.make_manifests is checksums._bdbag_make_manifests
+    assert bdbagit.generate_manifest_lines is checksums._bdbag_generate_manifest_lines
+    bdbag_api.validate_bag(str(dataset), fast=False)
+
+
+def age(path, seconds=60):
+    """Make a file old enough to be cached"""
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+
+def test_cache_inode_lookup_checks_device(tmp_path):
+    path, = make_files(tmp_path, [100])
+    age(path)
+    cache = checksums.ChecksumCache(str(tmp_path / "cache.sqlite3"))
+    try:
+        checksums.hash_files([path], ["sha256"], processes=1, cache=cache)
+        st = os.stat(path)
+        moved = str(tmp_path / "moved.bin")
+        # The same inode number on another file system is another file
+        other_device = types.SimpleNamespace(st_size=st.st_size, st_mtime_ns=st.st_mtime_ns,
+                                             st_ino=st.st_ino, st_dev=st.st_dev + 1)
+        assert cache.lookup({moved: other_device}, ["sha256"]) == {}
+        assert moved in cache.lookup({moved: st}, ["sha256"])
+    finally:
+        cache.close()
+
+
+def test_cache_replaces_old_table(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    db = sqlite3.connect(path)
+    with db:
+        db.execute("CREATE TABLE checksums (path TEXT PRIMARY KEY, size INTEGER, "
+                   "mtime_ns INTEGER, inode INTEGER, digests TEXT, last_used REAL)")
+        db.execute("INSERT INTO checksums VALUES ('/old', 1, 1, 1, '{}', 1)")
+    db.close()
+    file_path, = make_files(tmp_path, [100])
+    age(file_path)
+    cache = checksums.ChecksumCache(path)
+    try:
+        assert cache.entries() == 0
+        checksums.hash_files([file_path], ["sha256"], processes=1, cache=cache)
+        assert cache.entries() == 1
+    finally:
+        cache.close()
+
+
+def test_cache_reuses_unchanged_files(tmp_path, monkeypatch):
+    paths = make_files(tmp_path, [100, 200])
+    for path in paths:
+        age(path)
+    cache = checksums.ChecksumCache(str(tmp_path / "cache.sqlite3"))
+    first = checksums.hash_files(paths, ["md5", "sha256"], processes=1, cache=cache)
+    assert cache.entries() == 2
+
+    with open(paths[1], "wb") as f:
+        f.write(b"changed")
+    age(paths[1], 30)
+    hashed = []
+    hash_batch = checksums._hash_batch
+    monkeypatch.setattr(checksums, "_hash_batch",
+                        lambda batch, algs: hashed.extend(batch) or hash_batch(batch, algs))
+    second = checksums.hash_files(paths, ["sha256"], processes=1, cache=cache)
+    assert hashed == [paths[1]]
+    assert second[paths[0]] == (100, {"sha256": first[paths[0]][1]["sha256"]})
+    assert second[paths[1]] == checksums.file_hashes(paths[1], ["sha256"])
+
+
+def test_cache_finds_moved_files(tmp_path):
+    path, = make_files(tmp_path, [100])
+    age(path)
+    cache = checksums.ChecksumCache(str(tmp_path / "cache.sqlite3"))
+    first = checksums.hash_files([path], ["sha256"], processes=1, cache=cache)
+    moved = os.path.join(str(tmp_path), "moved.bin")
+    os.rename(path, moved)
+    assert cache.lookup({moved: os.stat(moved)}, ["sha256"]) == {moved: first[path]}
+    # The new name is remembered, so the stale entry can go
+    assert cache.purge(stale_only=True) == 1
+    assert cache.lookup({moved: os.stat(moved)}, ["sha256"]) == {moved: first[path]}
+
+
+def test_tree_digest(tmp_path):
+    (tmp_path / "tree" / "sub").mkdir(parents=True)
+    (tmp_path / "tree" / "a.tsv").write_text("a")
+    (tmp_path / "tree" / "sub" / "b.tsv").write_text("b")
+    digest = checksums.tree_digest(str(tmp_path / "tree"))
+    shutil.copytree(str(tmp_path / "tree"), str(tmp_path / "copy"))
+    assert checksums.tree_digest(str(tmp_path / "copy")) == digest
+    os.rename(str(tmp_path / "copy" / "sub" / "b.tsv"), str(tmp_path / "copy" / "sub" / "c.tsv"))
+    assert checksums.tree_digest(str(tmp_path / "copy")) != digest
+
+
+def test_cache_skips_recently_modified_files(tmp_path):
+    paths = make_files(tmp_path, [100])
+    cache = checksums.ChecksumCache(str(tmp_path / "cache.sqlite3"))
+    checksums.hash_files(paths, ["sha256"], processes=1, cache=cache)
+    assert cache.entries() == 0
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    paths = make_files(tmp_path, [1, 2, 3])
+    for path in paths:
+        age(path)
+    cache = checksums.ChecksumCache(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    for path in paths:
+        checksums.hash_files([path], ["sha256"], processes=1, cache=cache)
+        time.sleep(0.01)
+    assert cache.entries() == 2
+    assert not cache.lookup({paths[0]: os.stat(paths[0])}, ["sha256"])
+
+
+def test_cache_verify_and_purge(tmp_path):
+    paths = make_files(tmp_path, [10, 20, 30])
+    for path in paths:
+        age(path)
+    cache = checksums.ChecksumCache(str(tmp_path / "cache.sqlite3"))
+    checksums.hash_files(paths, ["sha256"], processes=1, cache=cache)
+    os.remove(paths[0])
+    # Same size and times, different content
+    st = os.stat(paths[1])
+    with open(paths[1], "r+b") as f:
+        f.write(b"x")
+    os.utime(paths[1], ns=(st.st_atime_ns, st.st_mtime_ns))
+
+    res = cache.verify(processes=1)
+    assert res == {"checked": 3, "stale": 1, "wrong": [paths[1]], "valid": 1}
+    assert cache.entries() == 1
+    assert cache.purge(stale_only=True) == 0
+    assert cache.purge() == 1
+
+
+def test_cache_command(cache_dir):
+    result = CliRunner().invoke(cli, ["cache", "purge"])
+    assert result.exit_code == 0
+    assert ("Removed 0 cached checksums, 0 cached archives and 0 cached validation results"
+            in result.output)
+    result = CliRunner().invoke(cli, ["cache", "verify"])
+    assert result.exit_code == 0
+    assert (cache_dir / "checksums.sqlite3").exists()
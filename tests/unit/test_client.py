@@ -1,6 +1,16 @@
+import hashlib
+import json
+import os
+from unittest.mock import Mock
+
 import pytest
 from globus_automate_client.flows_client import ALL_FLOW_SCOPES
-from cfde_submit import client, exc
+from bdbag import bdbag_api
+from cfde_submit import CONFIG, archive, client, exc, scan
+from .conftest import MOCK_BAG_CONTENTS
+
+MOCK_BAG_SHA256 = hashlib.sha256(MOCK_BAG_CONTENTS).hexdigest()
+MOCK_BAG_NAME = "bagged_path_{}.zip".format(MOCK_BAG_SHA256[:16])
 
 
 def test_logged_out(logged_out):
@@ -22,6 +32,13 @@ def test_scopes(mock_remote_config):
                                    f'{service}_flow_id/flow_{service}_flow_id_user')
 
 
+def test_get_flow_retry_500s_without_retries(mock_flows_client):
+    get_flow = mock_flows_client.get_flow
+    get_flow.return_value = Mock(status_code=500)
+    assert client.CfdeClient().get_flow_retry_500s("flow", retries=0, delay=0).status_code == 500
+    assert get_flow.call_count == 1
+
+
 @pytest.mark.parametrize("config_setting", ["cfde_ep_id", "flow_id"])
 def test_submissions_disabled(mock_remote_config, config_setting):
     """Test that a 'None' Value for either "cfde_ep_id" or "flow_id" disables
@@ -55,7 +72,8 @@ def test_start_deriva_flow_http(logged_in, mock_validation, mock_remote_config,
     assert flow_input == {
         'cfde_ep_id': 'prod_cfde_ep_id',
         'cfde_ep_token': 'https://auth.globus.org/scopes/prod_cfde_ep_id/https_access_token',
-        'data_url': 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/bagged_path.zip',
+        'data_sha256': MOCK_BAG_SHA256,
+        'data_url': 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/' + MOCK_BAG_NAME,
         'dcc_id': 'cfde_registry_dcc:my_dcc',
         'deriva_server': 'app.nih-cfde.org',
         'funcx_endpoint': 'prod_funcx_endpoint',
@@ -81,8 +99,9 @@ def test_start_deriva_flow_gcp(logged_in, mock_validation, mock_remote_config, m
     assert flow_scope == 'https://auth.globus.org/scopes/prod_flow_id/flow_prod_flow_id_user'
     assert flow_input == {
         'cfde_ep_id': 'prod_cfde_ep_id',
-        'cfde_ep_path': '/CFDE/data/prod/bagged_path.zip',
+        'cfde_ep_path': '/CFDE/data/prod/' + MOCK_BAG_NAME,
         'cfde_ep_token': 'https://auth.globus.org/scopes/prod_cfde_ep_id/https_access_token',
+        'data_sha256': MOCK_BAG_SHA256,
         'cfde_ep_url': 'https://prod-gcs-inst.data.globus.org',
         'dcc_id': 'cfde_registry_dcc:my_dcc',
         'deriva_server': 'app.nih-cfde.org',
@@ -202,7 +221,8 @@ def test_start_deriva_flow_valid_long_dcc(logged_in, mock_validation, mock_remot
     assert flow_input == {
         'cfde_ep_id': 'prod_cfde_ep_id',
         'cfde_ep_token': 'https://auth.globus.org/scopes/prod_cfde_ep_id/https_access_token',
-        'data_url': 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/bagged_path.zip',
+        'data_sha256': MOCK_BAG_SHA256,
+        'data_url': 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/' + MOCK_BAG_NAME,
         'deriva_server': 'app.nih-cfde.org',
         'dcc_id': 'cfde_registry_dcc:gtex',
         'funcx_endpoint': 'prod_funcx_endpoint',
@@ -223,7 +243,8 @@ def test_start_deriva_flow_valid_short_dcc(logged_in, mock_validation, mock_remo
     assert flow_input == {
         'cfde_ep_id': 'prod_cfde_ep_id',
         'cfde_ep_token': 'https://auth.globus.org/scopes/prod_cfde_ep_id/https_access_token',
-        'data_url': 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/bagged_path.zip',
+        'data_sha256': MOCK_BAG_SHA256,
+        'data_url': 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/' + MOCK_BAG_NAME,
         'dcc_id': 'cfde_registry_dcc:gtex',
         'deriva_server': 'app.nih-cfde.org',
         'funcx_endpoint': 'prod_funcx_endpoint',
@@ -231,3 +252,126 @@ def test_start_deriva_flow_valid_short_dcc(logged_in, mock_validation, mock_remo
         'source_endpoint_id': False,
         'test_sub': False,
     }
+
+
+def test_start_deriva_flow_skips_uploaded_archive(logged_in, mock_validation, mock_flows_client,
+                                                  mock_upload, mock_get_bag, mock_dcc_check,
+                                                  mock_is_uploaded):
+    mock_is_uploaded.return_value = True
+    res = client.CfdeClient().start_deriva_flow("bagged_path.zip", "my_dcc")
+    assert res["success"]
+    assert not mock_upload.called
+    _, args, kwargs = mock_is_uploaded.mock_calls[0]
+    data_url, _, size, checksum = args
+    assert data_url == 'https://prod-gcs-inst.data.globus.org/CFDE/data/prod/' + MOCK_BAG_NAME
+    assert size == len(MOCK_BAG_CONTENTS)
+    assert checksum == MOCK_BAG_SHA256
+    _, args, kwargs = mock_flows_client.run_flow.mock_calls[0]
+    assert args[2]["data_url"] == data_url
+    assert args[2]["data_sha256"] == MOCK_BAG_SHA256
+    assert args[2]["source_endpoint_id"] is False
+
+
+def test_start_deriva_flow_dry_run_writes_nothing(logged_in, mock_remote_config, mock_flows_client,
+                                                  mock_upload, mock_validation, tmp_path):
+    dataset = tmp_path / "dataset"
+    dataset.mkdir()
+    (dataset / "file.tsv").write_text("id\n1\n")
+    res = client.CfdeClient().start_deriva_flow(str(dataset), "my_dcc", dry_run=True,
+                                                handle_git_repos=False)
+    assert res["success"]
+    assert res["plan"]["files"] == 1
+    assert os.listdir(str(dataset)) == ["file.tsv"]
+    assert sorted(os.listdir(str(tmp_path))) == ["dataset"]
+    # The directory is validated in place
+    mock_validation.assert_called_once_with(str(dataset), None, mode=None)
+    assert not mock_upload.called
+
+
+def test_start_deriva_flow_chooses_globus(logged_in, mock_validation, mock_remote_config,
+                                          mock_flows_client, mock_upload, mock_gcp_installed,
+                                          mock_get_bag, mock_globus_sdk, mock_dcc_check,
+                                          monkeypatch):
+    monkeypatch.setitem(CONFIG, "GLOBUS_TRANSFER_THRESHOLD", 1)
+    client.CfdeClient().start_deriva_flow("bagged_path.zip", "my_dcc")
+    assert not mock_upload.called
+    _, args, kwargs = mock_flows_client.run_flow.mock_calls[0]
+    assert args[2]["source_endpoint_id"] == "local_gcp_endpoint_id"
+
+
+def test_start_deriva_flow_unknown_codec(logged_in, mock_remote_config, mock_flows_client,
+                                         monkeypatch, tmp_path):
+    monkeypatch.setitem(CONFIG, "ARCHIVE_CODEC", "rar")
+    cfde = client.CfdeClient()
+    with pytest.raises(exc.InvalidInput, match="rar"):
+        cfde.archive_format
+    with pytest.raises(exc.InvalidInput, match="rar"):
+        cfde.start_deriva_flow(str(tmp_path), "my_dcc")
+
+
+def test_start_deriva_flow_insufficient_space(logged_in, mock_remote_config, mock_flows_client,
+                                              mock_dcc_check, monkeypatch, tmp_path):
+    monkeypatch.setattr(scan, "plan_submission", Mock(return_value={
+        "path": str(tmp_path), "estimates": {}, "transport": "https", "space_ok": False,
+        "space": [{"path": str(tmp_path), "needed": 2048, "free": 1024}]}))
+    monkeypatch.setattr(scan, "format_plan", Mock(return_value=""))
+    with pytest.raises(exc.InsufficientSpace, match="2.0 KiB needed"):
+        client.CfdeClient().start_deriva_flow(str(tmp_path), "my_dcc")
+
+
+def test_start_deriva_flow_samples_directory_before_bagging(
+        logged_in, mock_remote_config, mock_flows_client, mock_upload, mock_validation,
+        mock_dcc_check, monkeypatch, tmp_path):
+    dataset = tmp_path / "dataset"
+    dataset.mkdir()
+    (dataset / "file.tsv").write_text("id\n1\n")
+    bag_archive = tmp_path / "bagged_path.zip"
+
+    def get_bag(data_path, **kwargs):
+        assert mock_validation.called
+        bag_archive.write_bytes(MOCK_BAG_CONTENTS)
+        return str(bag_archive)
+
+    monkeypatch.setattr(client.bdbag_utils, "get_bag", get_bag)
+    client.CfdeClient().start_deriva_flow(str(dataset), "my_dcc", handle_git_repos=False,
+                                          validation_mode="sampled")
+    # The deflated archive is not sampled again
+    mock_validation.assert_called_once_with(str(dataset), None, mode="sampled")
+    assert mock_upload.called
+
+
+def test_start_deriva_flow_dry_run_validates(logged_in, mock_remote_config, mock_flows_client,
+                                             mock_upload, tmp_path):
+    dataset = tmp_path / "dataset"
+    dataset.mkdir()
+    (dataset / "file.tsv").write_text("id\nx\n")
+    (dataset / "package.json").write_text(json.dumps({"resources": [{
+        "name": "file", "path": "file.tsv", "format": "tsv", "dialect": {"delimiter": "\t"},
+        "schema": {"fields": [{"name": "id", "type": "integer"}]}}]}))
+    with pytest.raises(exc.ValidationException, match="Type error"):
+        client.CfdeClient().start_deriva_flow(str(dataset), "my_dcc", dry_run=True,
+                                              handle_git_repos=False)
+    assert sorted(os.listdir(str(dataset))) == ["file.tsv", "package.json"]
+    assert not mock_upload.called
+
+
+def test_start_deriva_flow_removes_staged_bag_on_error(logged_in, mock_remote_config,
+                                                       mock_flows_client, mock_upload,
+                                                       mock_validation, mock_dcc_check,
+                                                       monkeypatch, tmp_path):
+    dataset = tmp_path / "dataset"
+    dataset.mkdir()
+    (dataset / "file.tsv").write_text("id\n1\n")
+    staging_root = tmp_path / ".cfde-submit-staged"
+    bag = staging_root / "dataset"
+    bag.mkdir(parents=True)
+    (bag / "file.tsv").write_text("id\n1\n")
+    bdbag_api.make_bag(str(bag))
+    monkeypatch.setattr(client.bdbag_utils, "get_bag", Mock(return_value=archive.BagStream(
+        str(bag), delete_dir=True, delete_path=str(staging_root))))
+    mock_validation.side_effect = exc.ValidationException("Validation error")
+    with pytest.raises(exc.ValidationException):
+        client.CfdeClient().start_deriva_flow(str(dataset), "my_dcc", handle_git_repos=False,
+                                              stream=True)
+    assert not staging_root.exists()
+    assert not mock_upload.called
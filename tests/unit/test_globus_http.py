@@ -0,0 +1,300 @@
+import base64
+import hashlib
+import io
+import os
+import time
+import zipfile
+from unittest.mock import Mock
+
+import pytest
+from cfde_submit import CONFIG, archive, exc, globus_http
+from tests.benchmarks import upload_benchmark
+from .gcs_server import GCSServer
+
+# Mocked out for every test by conftest.mock_is_uploaded
+is_uploaded = globus_http.is_uploaded
+
+
+def make_archive(tmp_path, size):
+    archive = tmp_path / "bagged_path.zip"
+    archive.write_bytes(os.urandom(size))
+    return str(archive)
+
+
+def test_upload(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    assert globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer)["success"]
+    assert gcs_server.objects["/bag.zip"] == open(archive, "rb").read()
+
+
+def test_upload_error(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    gcs_server.fail_requests = {2: 500}
+    res = globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer)
+    assert res["success"] is False
+    assert "error 500" in res["error"]
+
+
+def test_upload_chunked(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    assert globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                              chunk_size=300)["success"]
+    assert gcs_server.objects["/bag.zip"] == open(archive, "rb").read()
+    assert sorted(gcs_server.puts("/bag.zip")) == [
+        "bytes 0-299/1000", "bytes 300-599/1000", "bytes 600-899/1000", "bytes 900-999/1000",
+    ]
+    assert not os.path.exists(archive + ".upload.json")
+
+
+def test_upload_chunked_resumes(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    url = gcs_server.url + "/bag.zip"
+    gcs_server.fail_requests = {4: 503}
+    res = globus_http.upload(archive, url, mock_authorizer, chunk_size=300, workers=1)
+    assert res["success"] is False
+    assert os.path.exists(archive + ".upload.json")
+
+    gcs_server.requests.clear()
+    assert globus_http.upload(archive, url, mock_authorizer, chunk_size=300)["success"]
+    # Only the ranges the server did not confirm are sent again
+    ranges = sorted(gcs_server.puts("/bag.zip"))
+    assert ranges == ["bytes 600-899/1000", "bytes 900-999/1000"]
+    assert gcs_server.objects["/bag.zip"] == open(archive, "rb").read()
+
+
+def test_upload_chunked_ignores_stale_journal(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    url = gcs_server.url + "/bag.zip"
+    gcs_server.fail_requests = {3: 503}
+    globus_http.upload(archive, url, mock_authorizer, chunk_size=300, workers=1)
+    # Rebuilt archive with different content must be uploaded from the start
+    make_archive(tmp_path, 1000)
+    gcs_server.requests.clear()
+    assert globus_http.upload(archive, url, mock_authorizer, chunk_size=300)["success"]
+    assert len(gcs_server.puts("/bag.zip")) == 4
+    assert gcs_server.objects["/bag.zip"] == open(archive, "rb").read()
+
+
+def test_upload_chunked_401_resends_one_range(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    gcs_server.fail_requests = {3: 401}
+    assert globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                              chunk_size=500, workers=1)["success"]
+    assert mock_authorizer.handle_missing_authorization.called
+    assert gcs_server.puts("/bag.zip") == [
+        "bytes 0-499/1000", "bytes 500-999/1000", "bytes 500-999/1000",
+    ]
+
+
+def test_upload_parallel(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 10000)
+    res = globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                             chunk_size=1000, workers=4)
+    assert res["success"]
+    assert res["bytes"] == 10000
+    assert res["throughput"] > 0
+    assert len(gcs_server.puts("/bag.zip")) == 10
+    assert gcs_server.objects["/bag.zip"] == open(archive, "rb").read()
+
+
+def test_upload_parallel_above_threshold(gcs_server, mock_authorizer, tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG, "PARALLEL_UPLOAD_THRESHOLD", 5000)
+    monkeypatch.setitem(CONFIG, "UPLOAD_PART_SIZE", 2000)
+    archive = make_archive(tmp_path, 10000)
+    assert globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer)["success"]
+    assert len(gcs_server.puts("/bag.zip")) == 5
+    assert all(gcs_server.puts("/bag.zip"))
+    assert gcs_server.objects["/bag.zip"] == open(archive, "rb").read()
+
+
+def test_upload_parallel_failure_stops_early(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 10000)
+    gcs_server.fail_requests = {2: 500}
+    res = globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                             chunk_size=100, workers=2)
+    assert res["success"] is False
+    assert len(gcs_server.puts("/bag.zip")) < 100
+
+
+def test_upload_stream(gcs_server, mock_authorizer, tmp_path):
+    bag_dir = tmp_path / "my_bag"
+    (bag_dir / "data").mkdir(parents=True)
+    (bag_dir / "bagit.txt").write_text("BagIt-Version: 0.97\n")
+    (bag_dir / "data" / "file.tsv").write_bytes(os.urandom(50000))
+    bag_stream = archive.BagStream(str(bag_dir), chunk_size=1000)
+    res = globus_http.upload_stream(bag_stream, gcs_server.url + "/my_bag.zip", mock_authorizer)
+    assert res["success"]
+    uploaded = gcs_server.objects["/my_bag.zip"]
+    assert res["bytes"] == len(uploaded)
+    with zipfile.ZipFile(io.BytesIO(bytes(uploaded))) as zf:
+        assert zf.namelist() == ["my_bag/bagit.txt", "my_bag/data/", "my_bag/data/file.tsv"]
+        assert zf.read("my_bag/data/file.tsv") == (bag_dir / "data" / "file.tsv").read_bytes()
+        assert zf.testzip() is None
+    assert list(tmp_path.iterdir()) == [bag_dir]
+
+
+def test_preflight_renews_rejected_token(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    gcs_server.fail_requests = {1: 401}
+    assert globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer)["success"]
+    assert mock_authorizer.handle_missing_authorization.called
+    # The body was only sent once
+    assert [r[0] for r in gcs_server.requests if r[1] == "/bag.zip"] == ["HEAD", "HEAD", "PUT"]
+
+
+def test_upload_chunked_falls_back_if_server_ignores_ranges(mock_authorizer, tmp_path):
+    server = GCSServer(ranges=False).start()
+    try:
+        archive = make_archive(tmp_path, 1000)
+        with pytest.raises(exc.RangesNotSupported, match="100 bytes"):
+            globus_http.upload_resumable(archive, server.url + "/bag.zip", mock_authorizer,
+                                         chunk_size=300)
+        # The next attempt sends the whole file again
+        assert not os.path.exists(archive + ".upload.json")
+        server.requests.clear()
+        res = globus_http.upload(archive, server.url + "/bag.zip", mock_authorizer,
+                                 chunk_size=300, workers=1)
+        assert res["success"]
+        assert server.objects["/bag.zip"] == open(archive, "rb").read()
+        assert server.puts("/bag.zip")[-1] is None
+        assert "/bag.zip.sha256" in server.objects
+    finally:
+        server.stop()
+
+
+def test_upload_chunk_size_zero_sends_single_put(gcs_server, mock_authorizer, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.setitem(CONFIG, "PARALLEL_UPLOAD_THRESHOLD", 500)
+    archive = make_archive(tmp_path, 1000)
+    assert globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                              chunk_size=0)["success"]
+    assert gcs_server.puts("/bag.zip") == [None]
+
+
+def test_upload_chunked_checks_server_digest(gcs_server, mock_authorizer, tmp_path,
+                                             monkeypatch):
+    archive = make_archive(tmp_path, 1000)
+    wrong = base64.b64encode(hashlib.sha256(b"other").digest()).decode()
+    head = globus_http.requests.head
+
+    def head_with_digest(*args, **kwargs):
+        res = head(*args, **kwargs)
+        res.headers["Digest"] = "SHA-256=" + wrong
+        return res
+    monkeypatch.setattr(globus_http.requests, "head", head_with_digest)
+    with pytest.raises(exc.UploadIncomplete, match="different data"):
+        globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                           chunk_size=300)
+
+
+def test_preflight_rejected_token_sends_no_body(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    gcs_server.fail_requests = {1: 401, 2: 401}
+    res = globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer)
+    assert res["success"] is False
+    assert "error 401" in res["error"]
+    assert gcs_server.puts("/bag.zip") == []
+
+
+def test_preflight_renews_expiring_token(gcs_server, mock_authorizer, monkeypatch):
+    monkeypatch.setitem(CONFIG, "UPLOAD_ESTIMATED_RATE", 1000)
+    url = gcs_server.url + "/bag.zip"
+    # A 10 minute token is enough for a 1 second upload, but not for a 1 hour upload
+    mock_authorizer.expires_at = time.time() + 600
+    assert globus_http.preflight(url, mock_authorizer, size=1000) is None
+    assert not mock_authorizer.handle_missing_authorization.called
+    assert globus_http.preflight(url, mock_authorizer, size=3600 * 1000) is None
+    assert mock_authorizer.handle_missing_authorization.called
+
+
+def test_content_addressed_name():
+    checksum = "0123456789abcdef" * 4
+    assert (globus_http.content_addressed_name("my.bag.zip", checksum)
+            == "my.bag_0123456789abcdef.zip")
+    assert (globus_http.content_addressed_name("bag.tar.gz", checksum)
+            == "bag_0123456789abcdef.tar.gz")
+
+
+def test_is_uploaded(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    url = gcs_server.url + "/bag.zip"
+    checksum = globus_http.file_digest(archive)
+    assert not is_uploaded(url, mock_authorizer, 1000, checksum)
+    assert globus_http.upload(archive, url, mock_authorizer, checksum=checksum)["success"]
+    assert gcs_server.objects["/bag.zip.sha256"] == "{}  bag.zip\n".format(checksum).encode()
+    assert is_uploaded(url, mock_authorizer, 1000, checksum)
+    assert not is_uploaded(url, mock_authorizer, 1001, checksum)
+    assert not is_uploaded(url, mock_authorizer, 1000, "0" * 64)
+
+
+def test_upload_over_https(tmp_path, monkeypatch, mock_authorizer):
+    server = GCSServer(tls=True, token="mock_https_token").start()
+    try:
+        monkeypatch.setenv("REQUESTS_CA_BUNDLE", server.cert_path)
+        archive = make_archive(tmp_path, 1000)
+        res = globus_http.upload(archive, server.url + "/bag.zip", mock_authorizer)
+        assert res["success"]
+        assert server.objects["/bag.zip"] == open(archive, "rb").read()
+        # The token has expired
+        server.token = "renewed_token"
+        res = globus_http.upload(archive, server.url + "/bag.zip", mock_authorizer)
+        assert not res["success"]
+        assert server.puts("/bag.zip") == [None]
+    finally:
+        server.stop()
+
+
+def test_upload_benchmark_smoke():
+    results = upload_benchmark.run(["256KiB"])
+    assert results["256KiB"]["bytes"] == 256 * 1024
+    assert not upload_benchmark.compare(results, results)
+    slower = {"256KiB": dict(results["256KiB"], throughput=results["256KiB"]["throughput"] * 2)}
+    assert upload_benchmark.compare(results, slower)
+    # Peak memory is not measured on Windows, and then not compared
+    unmeasured = {"256KiB": dict(results["256KiB"], peak_rss=None)}
+    assert not upload_benchmark.compare(unmeasured, results)
+    assert not upload_benchmark.compare(results, unmeasured)
+
+
+def test_upload_hashes_bytes_sent(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    checksum = globus_http.file_digest(archive)
+    for chunk_size in (None, 300):
+        res = globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                                 chunk_size=chunk_size)
+        assert res["sha256"] == checksum
+    assert gcs_server.objects["/bag.zip.sha256"] == "{}  bag.zip\n".format(checksum).encode()
+
+
+def test_upload_fails_on_checksum_mismatch(gcs_server, mock_authorizer, tmp_path):
+    archive = make_archive(tmp_path, 1000)
+    res = globus_http.upload(archive, gcs_server.url + "/bag.zip", mock_authorizer,
+                             checksum="0" * 64)
+    assert not res["success"]
+    assert "changed while it was uploaded" in res["error"]
+    assert "/bag.zip.sha256" not in gcs_server.objects
+
+
+def test_stream_hasher_compares_server_digest():
+    hasher = globus_http.StreamHasher(["sha256", "md5"])
+    hasher.update(b"payload")
+    digest = base64.b64encode(hashlib.sha256(b"payload").digest()).decode()
+    assert not hasher.mismatch(Mock(headers={"Digest": "sha-256=" + digest}))
+    wrong_md5 = base64.b64encode(hashlib.md5(b"other").digest()).decode()
+    assert "different data" in hasher.mismatch(Mock(headers={"Content-MD5": wrong_md5}))
+
+
+def test_file_digest_uses_archive_checksum(tmp_path):
+    dataset = tmp_path / "dataset"
+    dataset.mkdir()
+    (dataset / "file.tsv").write_text("id\n1\n")
+    path = archive.write_archive(str(dataset), "store")
+    with open(path, "rb") as f:
+        checksum = hashlib.sha256(f.read()).hexdigest()
+    assert open(path + ".sha256").read() == "{}  dataset.zip\n".format(checksum)
+    with open(path + ".sha256", "w") as f:
+        f.write("{}  dataset.zip\n".format("a" * 64))
+    assert globus_http.file_digest(path) == "a" * 64
+    # A modified archive is read again
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert globus_http.file_digest(path) == checksum
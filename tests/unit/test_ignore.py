@@ -0,0 +1,115 @@
+import os
+import zipfile
+
+import pytest
+from cfde_submit import CONFIG, bdbag_utils, checksums, ignore
+
+
+def make_dataset(tmp_path):
+    dataset = tmp_path / "dataset"
+    (dataset / "scratch").mkdir(parents=True)
+    (dataset / "env" / "lib").mkdir(parents=True)
+    (dataset / "file.tsv").write_text("id\n1\n")
+    (dataset / "datapackage.json").write_text("{}")
+    (dataset / ".DS_Store").write_text("junk")
+    (dataset / ".file.tsv.swp").write_text("junk")
+    (dataset / "scratch" / "big.tmp").write_text("junk")
+    (dataset / "env" / "lib" / "site.py").write_text("junk")
+    (dataset / ".cfdeignore").write_text("# Scratch outputs\nscratch/\n/env\n")
+    return dataset
+
+
+def archive_members(bag_archive):
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        return sorted(n.split("/data/", 1)[1] for n in zip_file.namelist()
+                      if "/data/" in n and not n.endswith("/"))
+
+
+@pytest.mark.parametrize("path, is_dir, excluded", [
+    ("notes.swp", False, True),
+    ("sub/notes.swp", False, True),
+    ("sub/keep.swp", False, False),
+    ("build", True, True),
+    ("build", False, False),
+    ("out/run.tmp", False, True),
+    ("sub/out/run.tmp", False, False),
+    ("data.tsv", False, False),
+    ("top.tsv", False, True),
+    ("sub/top.tsv", False, False),
+])
+def test_ignore_rules(path, is_dir, excluded):
+    rules = ignore.IgnoreRules(["# comment", "", "*.swp", "!keep.swp", "build/", "/out/*.tmp",
+                                "/top.tsv"])
+    assert rules.match(path, is_dir) is excluded
+
+
+def test_ignore_rules_exclude_directory_contents():
+    rules = ignore.IgnoreRules(["build/", "!*.tsv"])
+    assert rules.excludes("build/data.tsv")
+    assert not rules.match("build/data.tsv")
+    assert not rules.excludes("data.tsv")
+
+
+def test_ignore_rules_walk(tmp_path):
+    dataset = make_dataset(tmp_path)
+    rules = ignore.IgnoreRules.load(str(dataset), ["*.json"])
+    walked = sorted(os.path.relpath(os.path.join(root, f), str(dataset))
+                    for root, _, files in rules.walk(str(dataset)) for f in files)
+    assert walked == ["file.tsv"]
+    assert rules.any_excluded(str(dataset))
+    assert not ignore.IgnoreRules([]).any_excluded(str(dataset))
+
+
+def test_excluded_files_are_not_hashed(tmp_path, monkeypatch):
+    dataset = make_dataset(tmp_path)
+    rules = ignore.IgnoreRules.load(str(dataset))
+    hashed = []
+    file_hashes = checksums.file_hashes
+    monkeypatch.setattr(checksums, "file_hashes",
+                        lambda path, algs: hashed.append(path) or file_hashes(path, algs))
+    digest = checksums.tree_digest(str(dataset), exclude=rules)
+    assert sorted(os.path.basename(path) for path in hashed) == ["datapackage.json", "file.tsv"]
+    (dataset / "scratch" / "big.tmp").write_text("changed")
+    assert checksums.tree_digest(str(dataset), exclude=rules) == digest
+
+
+def test_get_bag_in_place_with_excluded_files(tmp_path, monkeypatch):
+    monkeypatch.setitem(CONFIG, "ARCHIVE_CACHE", False)
+    dataset = make_dataset(tmp_path)
+    before = sorted(os.listdir(str(dataset)))
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False)
+    assert bag_archive == str(tmp_path / "dataset.zip")
+    assert archive_members(bag_archive) == ["datapackage.json", "file.tsv"]
+    # The data was staged for bagging, and the staged copy removed
+    assert sorted(os.listdir(str(dataset))) == before
+    assert sorted(os.listdir(str(tmp_path))) == ["cache", "dataset", "dataset.zip",
+                                                 "dataset.zip.sha256"]
+
+
+def test_get_bag_output_dir_with_exclude_option(tmp_path):
+    dataset = make_dataset(tmp_path)
+    bag_archive = bdbag_utils.get_bag(str(dataset), output_dir=str(tmp_path / "bag"),
+                                      handle_git_repos=False, exclude=["*.json"])
+    assert archive_members(bag_archive) == ["file.tsv"]
+    assert not (tmp_path / "bag" / "data" / "scratch").exists()
+
+
+def test_get_bag_git_repo_with_excluded_files(tmp_path):
+    git = pytest.importorskip("git")
+    dataset = make_dataset(tmp_path)
+    repo = git.Repo.init(str(dataset))
+    repo.git.add("--all", "--force")
+    actor = git.Actor("Test", "test@example.com")
+    repo.index.commit("Add dataset", author=actor, committer=actor)
+    bag_archive = bdbag_utils.get_bag(str(dataset))
+    assert archive_members(bag_archive) == ["datapackage.json", "file.tsv"]
+
+
+def test_get_bag_stream_with_excluded_files(tmp_path):
+    dataset = make_dataset(tmp_path)
+    bag_stream = bdbag_utils.get_bag(str(dataset), handle_git_repos=False, stream=True)
+    assert bag_stream.name == "dataset.zip"
+    (tmp_path / "streamed.zip").write_bytes(b"".join(bag_stream))
+    assert archive_members(str(tmp_path / "streamed.zip")) == ["datapackage.json", "file.tsv"]
+    bag_stream.cleanup()
+    assert sorted(os.listdir(str(tmp_path))) == ["cache", "dataset", "streamed.zip"]
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import zipfile
+
+import pytest
+from cfde_submit import bdbag_utils, exc, remote, validation
+
+TABLE = "id\tname\n1\ta\n2\tb\n"
+PACKAGE = {"resources": [{
+    "name": "reads", "path": "reads/reads.tsv", "format": "tsv",
+    "dialect": {"delimiter": "\t"},
+    "schema": {"fields": [{"name": "id", "type": "integer"}, {"name": "name", "type": "string"}]},
+}]}
+
+
+def make_dataset(tmp_path, url, with_copy=True):
+    dataset = tmp_path / "dataset"
+    (dataset / "reads").mkdir(parents=True)
+    (dataset / "datapackage.json").write_text(json.dumps(PACKAGE))
+    if with_copy:
+        (dataset / "reads" / "reads.tsv").write_text(TABLE)
+    manifest = tmp_path / "remote.json"
+    manifest.write_text(json.dumps([{"url": url, "filename": "reads/reads.tsv"}]))
+    return dataset, manifest
+
+
+def test_load_manifest(tmp_path):
+    manifest = tmp_path / "remote.json"
+    manifest.write_text('{"url": "https://example.org/a", "filename": "./a/b.bam"}\n'
+                        '{"url": "https://example.org/c", "filename": "c.bam", "length": 1}\n')
+    entries = remote.load_manifest(str(manifest))
+    assert [e["filename"] for e in entries] == ["a/b.bam", "c.bam"]
+    assert remote.exclude_patterns(entries) == ["/a/b.bam", "/c.bam"]
+
+
+@pytest.mark.parametrize("entries", [
+    "files",
+    [{"filename": "a"}],
+    [{"url": "https://example.org/a", "filename": "../a"}],
+    [{"url": "https://example.org/a", "filename": "a"}, {"url": "https://example.org/b",
+                                                         "filename": "a"}],
+])
+def test_load_manifest_rejects_bad_entries(tmp_path, entries):
+    manifest = tmp_path / "remote.json"
+    manifest.write_text(json.dumps(entries))
+    with pytest.raises(exc.InvalidInput):
+        remote.load_manifest(str(manifest))
+
+
+def test_complete_manifest(tmp_path):
+    dataset, manifest = make_dataset(tmp_path, "https://example.org/reads.tsv")
+    entries = remote.complete_manifest(remote.load_manifest(str(manifest)), str(dataset))
+    assert entries[0]["length"] == len(TABLE)
+    assert entries[0]["sha256"] == hashlib.sha256(TABLE.encode()).hexdigest()
+    assert entries[0]["md5"] == hashlib.md5(TABLE.encode()).hexdigest()
+
+
+def test_complete_manifest_needs_a_copy(tmp_path):
+    dataset, manifest = make_dataset(tmp_path, "https://example.org/reads.tsv", with_copy=False)
+    with pytest.raises(exc.InvalidInput):
+        remote.complete_manifest(remote.load_manifest(str(manifest)), str(dataset))
+
+
+def test_get_bag_lists_remote_files_in_fetch(tmp_path):
+    dataset, manifest = make_dataset(tmp_path, "https://example.org/reads.tsv")
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False,
+                                      remote_files=str(manifest))
+    with zipfile.ZipFile(bag_archive) as zip_file:
+        names = zip_file.namelist()
+        fetch = zip_file.read("dataset/fetch.txt").decode()
+    assert "dataset/data/datapackage.json" in names
+    assert "dataset/data/reads/reads.tsv" not in names
+    assert fetch.split() == ["https://example.org/reads.tsv", str(len(TABLE)),
+                             "data/reads/reads.tsv"]
+    # The local copy is left alone
+    assert (dataset / "reads" / "reads.tsv").read_text() == TABLE
+    assert not os.path.exists(str(dataset / "fetch.txt"))
+
+
+def test_validate_fetched_table(tmp_path, gcs_server):
+    gcs_server.objects["/reads.tsv"] = TABLE.encode()
+    dataset, manifest = make_dataset(tmp_path, gcs_server.url + "/reads.tsv")
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False,
+                                      remote_files=str(manifest))
+    validation.ts_validate(bag_archive)
+    assert ("GET", "/reads.tsv") in [r[:2] for r in gcs_server.requests]
+
+    gcs_server.objects["/reads.tsv"] = b"id\tname\nnot a number\ta\n"
+    for processes in (1, 2):
+        with pytest.raises(exc.ValidationException):
+            validation.ts_validate(bag_archive, processes=processes)
+
+
+def test_validate_unreadable_fetched_table_schema(tmp_path, caplog):
+    dataset, manifest = make_dataset(tmp_path, "globus://endpoint/reads.tsv")
+    bag_archive = bdbag_utils.get_bag(str(dataset), handle_git_repos=False,
+                                      remote_files=str(manifest))
+    validation.ts_validate(bag_archive)
+    assert "only its schema is validated" in caplog.text
@@ -0,0 +1,66 @@
+import io
+
+import pytest
+import requests
+from unittest.mock import Mock
+
+from cfde_submit import exc, retry, session
+
+
+def policy(**options):
+    options.setdefault("base_delay", 0)
+    return retry.RetryPolicy(**options)
+
+
+def test_retries_transient_errors():
+    func = Mock(side_effect=[requests.ConnectionError(), requests.Timeout(), "done"])
+    assert policy().call("host", func) == "done"
+    assert func.call_count == 3
+
+
+def test_returns_last_retryable_response():
+    func = Mock(return_value=Mock(status_code=503))
+    assert policy(max_attempts=3).call("host", func).status_code == 503
+    assert func.call_count == 3
+
+
+def test_does_not_retry_other_errors():
+    func = Mock(side_effect=ValueError())
+    with pytest.raises(ValueError):
+        policy().call("host", func)
+    assert func.call_count == 1
+
+
+def test_read_timeouts_can_be_excluded():
+    func = Mock(side_effect=requests.ReadTimeout())
+    with pytest.raises(requests.ReadTimeout):
+        policy(retry_read_timeouts=False).call("host", func)
+    assert func.call_count == 1
+
+
+def test_deadline_stops_retries():
+    func = Mock(side_effect=requests.ConnectionError())
+    with pytest.raises(requests.ConnectionError):
+        policy(base_delay=10, deadline=0).call("host", func)
+    assert func.call_count == 1
+
+
+def test_circuit_breaker_opens_per_key():
+    retry_policy = policy(max_attempts=1, failure_threshold=2)
+    failing = Mock(side_effect=requests.ConnectionError())
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            retry_policy.call("down", failing)
+    with pytest.raises(exc.ServiceUnavailable):
+        retry_policy.copy().call("down", failing)
+    assert failing.call_count == 2
+    assert retry_policy.call("up", Mock(return_value="ok")) == "ok"
+
+
+def test_session_retries_and_rewinds_body(gcs_server):
+    gcs_server.fail_requests = {1: 503}
+    http = session.PooledSession(retry_policy=policy())
+    res = http.put(gcs_server.url + "/data.zip", data=io.BytesIO(b"payload"))
+    assert res.status_code == 200
+    assert bytes(gcs_server.objects["/data.zip"]) == b"payload"
+    assert http.stats["requests"] == 2
@@ -0,0 +1,97 @@
+import collections
+import os
+
+import pytest
+from cfde_submit import CONFIG, exc, ignore, scan
+
+DiskUsage = collections.namedtuple("DiskUsage", "total used free")
+
+
+def make_tree(tmp_path):
+    dataset = tmp_path / "dataset"
+    (dataset / "sub" / "deeper").mkdir(parents=True)
+    (dataset / ".git").mkdir()
+    sizes = {"a.tsv": 10, "sub/b.tsv": 3000, "sub/deeper/c.bin": 200, ".git/HEAD": 5}
+    for name, size in sizes.items():
+        (dataset / name).write_bytes(b"x" * size)
+    return dataset
+
+
+def test_scan_tree(tmp_path):
+    dataset = make_tree(tmp_path)
+    res = scan.scan_tree(str(dataset), largest=2)
+    assert res == {"files": 4, "directories": 3, "bytes": 3215,
+                   "largest": [(3000, str(dataset / "sub" / "b.tsv")),
+                               (200, str(dataset / "sub" / "deeper" / "c.bin"))]}
+    res = scan.scan_tree(str(dataset), exclude=ignore.IgnoreRules([".git/"]))
+    assert (res["files"], res["directories"], res["bytes"]) == (3, 2, 3210)
+
+
+def test_plan_submission(tmp_path):
+    dataset = make_tree(tmp_path)
+    plan = scan.plan_submission(str(dataset), handle_git_repos=False)
+    assert plan["path"] == str(dataset)
+    assert plan["bytes"] == 3215
+    assert plan["transport"] == "https"
+    assert plan["space_ok"]
+    # The archive is written in the cache, on the same filesystem here
+    assert [s["needed"] for s in plan["space"]] == [3215]
+    assert set(plan["estimates"]) == {"bag", "archive", "upload"}
+    assert plan["estimates"]["bag"] > 0
+    # Streaming writes no archive
+    assert scan.plan_submission(str(dataset), handle_git_repos=False, stream=True)["space"] == []
+    assert "3 directories" in scan.format_plan(plan)
+
+
+def test_plan_submission_archive(tmp_path):
+    bag = tmp_path / "bag.zip"
+    bag.write_bytes(b"x" * 2048)
+    plan = scan.plan_submission(str(bag))
+    assert (plan["files"], plan["bytes"], plan["space"]) == (1, 2048, [])
+    assert plan["estimates"]["bag"] == plan["estimates"]["archive"] == 0
+    with pytest.raises(exc.InvalidInput):
+        scan.plan_submission(str(tmp_path / "missing.zip"))
+
+
+def test_plan_submission_chooses_globus(tmp_path, monkeypatch, mock_gcp_uninstalled):
+    monkeypatch.setitem(CONFIG, "GLOBUS_TRANSFER_THRESHOLD", 1000)
+    dataset = make_tree(tmp_path)
+    assert scan.plan_submission(str(dataset))["transport"] == "https"
+    mock_gcp_uninstalled.endpoint_id = "local_gcp_endpoint_id"
+    assert scan.plan_submission(str(dataset))["transport"] == "globus"
+    assert scan.plan_submission(str(dataset), globus=False)["transport"] == "https"
+    assert scan.plan_submission(str(dataset), stream=True)["transport"] == "https"
+    monkeypatch.setitem(CONFIG, "GLOBUS_TRANSFER_THRESHOLD", 10000)
+    assert scan.plan_submission(str(dataset))["transport"] == "https"
+
+
+def test_plan_submission_space(tmp_path, monkeypatch):
+    dataset = make_tree(tmp_path)
+    monkeypatch.setattr(scan.shutil, "disk_usage", lambda path: DiskUsage(4000, 3000, 1000))
+    plan = scan.plan_submission(str(dataset), handle_git_repos=False)
+    assert not plan["space_ok"]
+    assert "NOT ENOUGH SPACE" in scan.format_plan(plan)
+    # Copies made to stage the data need room too
+    monkeypatch.setitem(CONFIG, "STAGING_MODE", "copy")
+    monkeypatch.setitem(CONFIG, "ARCHIVE_CACHE", False)
+    plan = scan.plan_submission(str(dataset), output_dir=str(tmp_path / "out"),
+                                handle_git_repos=False)
+    assert plan["space"] == [{"path": str(tmp_path), "needed": 2 * 3215, "free": 1000}]
+
+
+@pytest.mark.parametrize("num_bytes, text", [
+    (0, "0 bytes"), (1023, "1023 bytes"), (1536, "1.5 KiB"), (5 * 1024 ** 3, "5.0 GiB")])
+def test_format_bytes(num_bytes, text):
+    assert scan.format_bytes(num_bytes) == text
+
+
+def test_format_seconds():
+    assert scan.format_seconds(4.6) == "5s"
+    assert scan.format_seconds(200) == "3m 20s"
+    assert scan.format_seconds(3 * 3600 + 125) == "3h 2m"
+
+
+def test_scan_skips_broken_links(tmp_path):
+    dataset = make_tree(tmp_path)
+    os.symlink(str(tmp_path / "missing"), str(dataset / "broken"))
+    assert scan.scan_tree(str(dataset))["files"] == 4
@@ -0,0 +1,24 @@
+from cfde_submit import globus_http
+from cfde_submit.session import PooledSession
+
+
+def test_session_reuses_connections(gcs_server):
+    session = PooledSession(pool_size=2, timeout=5)
+    for _ in range(5):
+        assert session.get(gcs_server.url + "/missing").status_code == 404
+    assert session.stats == {"requests": 5, "connections": 1, "reused": 4}
+
+
+def test_upload_with_session(gcs_server, mock_authorizer, tmp_path):
+    archive = tmp_path / "bag.zip"
+    archive.write_bytes(b"x" * 10000)
+    session = PooledSession(pool_size=4)
+    res = globus_http.upload(str(archive), gcs_server.url + "/bag.zip", mock_authorizer,
+                             chunk_size=1000, workers=4, session=session)
+    assert res["success"]
+    stats = session.stats
+    # One preflight HEAD, ten range PUTs, the HEAD checking the assembled object and the
+    # checksum, over no more connections than workers
+    assert stats["requests"] == 13
+    assert stats["connections"] <= 4
+    assert gcs_server.objects["/bag.zip"] == archive.read_bytes()
@@ -0,0 +1,64 @@
+import errno
+import os
+
+import pytest
+from bdbag import bdbag_api
+from cfde_submit import bdbag_utils, staging
+
+
+def make_tree(tmp_path):
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "file.tsv").write_text("id\n1\n")
+    (source / "sub" / "other.tsv").write_text("id\n2\n")
+    return source
+
+
+def read_tree(path):
+    return {os.path.relpath(os.path.join(root, f), str(path)): open(os.path.join(root, f)).read()
+            for root, _, files in os.walk(str(path)) for f in files}
+
+
+def test_stage_tree_hardlinks(tmp_path):
+    source = make_tree(tmp_path)
+    counts = staging.stage_tree(str(source), str(tmp_path / "staged"), mode="hardlink")
+    assert counts == {"reflink": 0, "hardlink": 2, "copy": 0}
+    assert read_tree(tmp_path / "staged") == read_tree(source)
+    assert (os.stat(str(tmp_path / "staged" / "sub" / "other.tsv")).st_ino
+            == os.stat(str(source / "sub" / "other.tsv")).st_ino)
+
+
+def test_stage_tree_copies(tmp_path):
+    source = make_tree(tmp_path)
+    counts = staging.stage_tree(str(source), str(tmp_path / "staged"), mode="copy")
+    assert counts["copy"] == 2
+    assert read_tree(tmp_path / "staged") == read_tree(source)
+    assert (os.stat(str(tmp_path / "staged" / "file.tsv")).st_ino
+            != os.stat(str(source / "file.tsv")).st_ino)
+
+
+def test_stage_tree_falls_back_to_copying(tmp_path, monkeypatch):
+    def unsupported(*args, **kwargs):
+        raise OSError(errno.EXDEV, "Invalid cross-device link")
+    monkeypatch.setattr(staging, "_reflink", unsupported)
+    monkeypatch.setattr(os, "link", unsupported)
+    source = make_tree(tmp_path)
+    counts = staging.stage_tree(str(source), str(tmp_path / "staged"))
+    assert counts["copy"] == 2
+    assert read_tree(tmp_path / "staged") == read_tree(source)
+
+
+def test_stage_tree_destination_exists(tmp_path):
+    source = make_tree(tmp_path)
+    with pytest.raises(FileExistsError):
+        staging.stage_tree(str(source), str(tmp_path))
+
+
+def test_get_bag_output_dir_leaves_source_unchanged(tmp_path):
+    source = make_tree(tmp_path)
+    before = read_tree(source)
+    bag_archive = bdbag_utils.get_bag(str(source), output_dir=str(tmp_path / "bag"),
+                                      handle_git_repos=False)
+    assert os.path.basename(bag_archive) == "bag.zip"
+    assert bdbag_api.is_bag(str(tmp_path / "bag"))
+    assert read_tree(source) == before
@@ -0,0 +1,278 @@
+import json
+import nturl2path
+import os
+import tempfile
+import tracemalloc
+import zipfile
+
+import pytest
+from bdbag import bdbag_api
+from cfde_submit import archive, exc, validation
+
+PACKAGE = {"resources": [
+    {"name": "file", "path": "file.tsv", "format": "tsv", "dialect": {"delimiter": "\t"},
+     "schema": {"fields": [{"name": "id", "type": "integer"},
+                           {"name": "project", "type": "string"}],
+                "primaryKey": ["id"],
+                "foreignKeys": [{"fields": ["project"],
+                                 "reference": {"resource": "project", "fields": ["id"]}}]}},
+    {"name": "project", "path": "project.tsv", "format": "tsv", "dialect": {"delimiter": "\t"},
+     "schema": {"fields": [{"name": "id", "type": "string"}], "primaryKey": ["id"]}},
+]}
+
+
+def make_bag(tmp_path, files="id\tproject\n1\tp1\n2\tp2\n"):
+    bag = tmp_path / "bag"
+    bag.mkdir()
+    (bag / "package.json").write_text(json.dumps(PACKAGE))
+    (bag / "file.tsv").write_text(files)
+    (bag / "project.tsv").write_text("id\np1\np2\n")
+    bdbag_api.make_bag(str(bag))
+    return bag
+
+
+@pytest.fixture(autouse=True)
+def no_validation_cache(monkeypatch):
+    """Validate every table, unless a test turns the cache on"""
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_CACHE", False)
+
+
+@pytest.fixture
+def temp_dir(tmp_path, monkeypatch):
+    """Where temporary files are written, to check none are left behind"""
+    temp = tmp_path / "temp"
+    temp.mkdir()
+    monkeypatch.setattr(tempfile, "tempdir", str(temp))
+    return temp
+
+
+def test_validate_zip_without_extracting(tmp_path, temp_dir, monkeypatch):
+    bag_archive = archive.write_archive(str(make_bag(tmp_path)), "deflate")
+    monkeypatch.setattr(bdbag_api, "extract_bag", None)
+    validation.ts_validate(bag_archive)
+    assert os.listdir(str(temp_dir)) == []
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+@pytest.mark.parametrize("files, error", [
+    ("id\tproject\n1\tp1\nx\tp2\n", "type error"),
+    ("id\tproject\n1\tp1\n2\tp3\n", "foreign key"),
+])
+def test_validate_zip_finds_errors(tmp_path, files, error, processes):
+    bag_archive = archive.write_archive(str(make_bag(tmp_path, files)), "deflate")
+    with pytest.raises(exc.ValidationException) as e:
+        validation.ts_validate(bag_archive, processes=processes)
+    assert str(e.value).startswith("Validation error in file.tsv\n")
+    assert error in str(e.value).lower()
+
+
+def test_validate_resources_in_parallel(tmp_path):
+    bag = make_bag(tmp_path, "id\tproject\n1\tp1\n2\tp3\n")
+    (bag / "data" / "project.tsv").write_text("id\np1\np1\n")
+    bdbag_api.make_bag(str(bag), update=True)
+    messages = []
+    for processes in (1, 2):
+        with pytest.raises(exc.ValidationException) as e:
+            validation.ts_validate(str(bag), processes=processes)
+        messages.append(str(e.value))
+    # Every resource is validated, and the first error in package order is reported
+    assert messages[0] == messages[1]
+    assert "file.tsv" in messages[1]
+
+
+def test_validate_directory(tmp_path, temp_dir):
+    validation.ts_validate(str(make_bag(tmp_path)))
+    assert os.listdir(str(temp_dir)) == []
+
+
+def test_validate_zstd_removes_extracted_copy(tmp_path, temp_dir):
+    pytest.importorskip("zstandard")
+    bag_archive = archive.write_archive(str(make_bag(tmp_path)), "zstd")
+    validation.ts_validate(bag_archive)
+    assert os.listdir(str(temp_dir)) == []
+
+
+def test_validate_zip_that_is_not_a_bag(tmp_path):
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "package.json").write_text(json.dumps(PACKAGE))
+    with pytest.raises(exc.InvalidInput):
+        validation.ts_validate(archive.write_archive(str(tmp_path / "data"), "deflate"))
+
+
+@pytest.mark.parametrize("files", [
+    "id\tproject\n1\tp1\n2\tp2\n",
+    "id\tproject\n1\tp1\nx\tp2\n",
+    "id\tproject\n1\tp1\n2\tp2\n3\tp1\n1\tp2\n",
+    "id\tproject\n1\tp1\n2\tp2\n3\tp3\n",
+    "id\tproject\n1\tp1\n\tp2\n",
+    "id\tname\n1\tp1\n",
+])
+def test_streaming_matches_full(tmp_path, temp_dir, monkeypatch, files):
+    # Small batches, so keys are compared across batches
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_BATCH_ROWS", 2)
+    bag = str(make_bag(tmp_path, files))
+    messages = []
+    for mode in validation.MODES:
+        try:
+            validation.ts_validate(bag, processes=1, mode=mode)
+            messages.append(None)
+        except exc.ValidationException as e:
+            messages.append(str(e))
+    assert messages[0] == messages[1]
+    assert os.listdir(str(temp_dir)) == []
+
+
+def test_validate_unknown_mode(tmp_path):
+    with pytest.raises(ValueError):
+        validation.ts_validate(str(make_bag(tmp_path)), mode="quick")
+
+
+def test_streaming_memory_does_not_grow(tmp_path, monkeypatch):
+    """The peak memory of streaming validation is the same for a table five times larger,
+    where full validation keeps every key in memory"""
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_BATCH_ROWS", 500)
+
+    def peak_memory(rows, mode):
+        bag = tmp_path / "{}-{}".format(mode, rows)
+        bag.mkdir()
+        rows = "".join("{}\tp{}\n".format(i, i % 2 + 1) for i in range(rows))
+        make_bag(bag, "id\tproject\n" + rows)
+        tracemalloc.start()
+        try:
+            validation.ts_validate(str(bag / "bag"), processes=1, mode=mode)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    # The first validation imports and caches what frictionless needs
+    peak_memory(100, "streaming")
+    small, large = peak_memory(2000, "streaming"), peak_memory(10000, "streaming")
+    assert large < small * 1.2
+    assert peak_memory(10000, "full") > peak_memory(2000, "full") * 1.5
+
+
+@pytest.mark.parametrize("codec", [None, "store"])
+def test_sampled_finds_errors_past_first_rows(tmp_path, monkeypatch, codec):
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_SAMPLE_HEAD", 10)
+    rows = ["{}\tp1\n".format(i) for i in range(1000)]
+    rows[500] = "x\tp1\n"
+    bag = str(make_bag(tmp_path, "id\tproject\n" + "".join(rows)))
+    if codec:
+        bag = archive.write_archive(bag, codec)
+    # Sample every line, and number the bad row as it is in the table
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_SAMPLE_ROWS", 100000)
+    with pytest.raises(exc.ValidationException) as e:
+        validation.ts_validate(bag, processes=1, mode="sampled")
+    assert 'Type error in the cell "x" in row "502"' in str(e.value)
+
+
+def test_sampled_reads_only_start_of_deflated_member(tmp_path, monkeypatch):
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_SAMPLE_HEAD", 10)
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_SAMPLE_ROWS", 100000)
+    rows = ["{}\tp1\n".format(i) for i in range(200000)]
+    rows[150000] = "x\tp1\n"
+    table = "id\tproject\n" + "".join(rows)
+    bag_archive = archive.write_archive(str(make_bag(tmp_path, table)), "deflate")
+    decompressed = []
+    get_decompressor = zipfile._get_decompressor
+
+    class Counting:
+        def __init__(self, decompressor):
+            self.decompressor = decompressor
+
+        def decompress(self, *args):
+            data = self.decompressor.decompress(*args)
+            decompressed.append(len(data))
+            return data
+
+        def __getattr__(self, name):
+            return getattr(self.decompressor, name)
+
+    monkeypatch.setattr(zipfile, "_get_decompressor",
+                        lambda compress_type: Counting(get_decompressor(compress_type)))
+    # Only the first rows of the deflated table are read, so the bad row is not found
+    validation.ts_validate(bag_archive, processes=1, mode="sampled")
+    assert 0 < sum(decompressed) < len(table) / 10
+
+
+def test_sampled_skips_keys(tmp_path):
+    bag = str(make_bag(tmp_path, "id\tproject\n1\tp1\n1\tp3\n"))
+    validation.ts_validate(bag, processes=1, mode="sampled")
+    with pytest.raises(exc.ValidationException) as e:
+        (tmp_path / "sub").mkdir()
+        validation.ts_validate(str(make_bag(tmp_path / "sub", "id\tname\n1\tp1\n")),
+                               processes=1, mode="sampled")
+    assert "name" in str(e.value)
+
+
+def test_validation_cache_reuses_unchanged_tables(tmp_path, monkeypatch):
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_CACHE", True)
+    validated = []
+    validate_resource = validation._validate_resource
+
+    def counting(descriptor, basepath, name, mode):
+        validated.append(name)
+        return validate_resource(descriptor, basepath, name, mode)
+
+    monkeypatch.setattr(validation, "_validate_resource", counting)
+    bag = make_bag(tmp_path)
+    validation.ts_validate(str(bag), processes=1)
+    assert sorted(validated) == ["file", "project"]
+    # The same tables in an archive
+    del validated[:]
+    validation.ts_validate(archive.write_archive(str(bag), "deflate"), processes=1)
+    assert validated == []
+    # Each mode has its own results
+    validation.ts_validate(str(bag), processes=1, mode="streaming")
+    assert sorted(validated) == ["file", "project"]
+    del validated[:]
+    # A referenced table changed, so the tables that reference it are validated again
+    (bag / "data" / "project.tsv").write_text("id\np1\n")
+    with pytest.raises(exc.ValidationException) as e:
+        validation.ts_validate(str(bag), processes=1)
+    assert sorted(validated) == ["file", "project"]
+    # Errors are cached too
+    del validated[:]
+    with pytest.raises(exc.ValidationException) as cached:
+        validation.ts_validate(str(bag), processes=1)
+    assert validated == [] and str(cached.value) == str(e.value)
+    # A schema changed, which no other table references
+    file_resource = json.loads(json.dumps(PACKAGE["resources"][0]))
+    file_resource["schema"]["fields"][1]["constraints"] = {"required": True}
+    package = dict(PACKAGE, resources=[file_resource, PACKAGE["resources"][1]])
+    (bag / "data" / "package.json").write_text(json.dumps(package))
+    with pytest.raises(exc.ValidationException):
+        validation.ts_validate(str(bag), processes=1)
+    assert validated == ["file"]
+
+
+@pytest.mark.parametrize("codec", [None, "deflate"])
+def test_validation_cache_skips_sampled_mode(tmp_path, monkeypatch, codec):
+    monkeypatch.setitem(validation.CONFIG, "VALIDATION_CACHE", True)
+    bag = str(make_bag(tmp_path))
+    data_path = archive.write_archive(bag, codec) if codec else bag
+    # Sampling must not digest whole tables
+    with monkeypatch.context() as m:
+        m.setattr(validation.checksums, "hash_files", None)
+        m.setattr(validation.checksums, "stream_hashes", None)
+        validation.ts_validate(data_path, processes=1, mode="sampled")
+    cache = validation.ValidationCache()
+    try:
+        assert cache.entries() == 0
+        validation.ts_validate(bag, processes=1)
+        assert cache.entries() == 2
+        assert cache.purge() == 2
+    finally:
+        cache.close()
+
+
+@pytest.mark.parametrize("archive_file", ["/data/my bag.zip", "C:\\data\\my bag.zip",
+                                          "\\\\server\\share\\bag.zip"])
+def test_zip_url_round_trip(monkeypatch, archive_file):
+    if "\\" in archive_file:
+        # Windows paths, whatever the platform the tests run on
+        monkeypatch.setattr(validation, "pathname2url", nturl2path.pathname2url)
+        monkeypatch.setattr(validation, "url2pathname", nturl2path.url2pathname)
+    url = validation._zip_url(archive_file, "bag/data/my file.tsv")
+    assert url.startswith("cfde-zip://")
+    assert validation._zip_member(url) == (archive_file, "bag/data/my file.tsv")
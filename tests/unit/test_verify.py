@@ -0,0 +1,93 @@
+import os
+import tarfile
+
+import pytest
+from bdbag import bdbag_api
+from cfde_submit import archive, bdbag_utils, exc, verify
+
+
+def make_bag(tmp_path, name="bag"):
+    bag = tmp_path / name
+    (bag / "sub").mkdir(parents=True)
+    (bag / "file.tsv").write_text("id\n1\n")
+    (bag / "sub" / "other.tsv").write_text("id\n2\n")
+    bdbag_api.make_bag(str(bag))
+    return bag
+
+
+def make_tar(bag, path):
+    with tarfile.open(str(path), "w") as tar:
+        tar.add(str(bag), arcname=bag.name)
+    return str(path)
+
+
+@pytest.mark.parametrize("mode", ["fast", "full"])
+def test_verify_intact_bag(tmp_path, mode):
+    bag = make_bag(tmp_path)
+    assert verify.verify_bag(str(bag), mode) == {}
+    assert verify.verify_bag(archive.write_archive(str(bag), "deflate"), mode) == {}
+    assert verify.verify_bag(make_tar(bag, tmp_path / "bag.tar"), mode) == {}
+
+
+@pytest.mark.parametrize("mode", ["fast", "full"])
+def test_verify_bag_named_data(tmp_path, mode):
+    # The top directory of the archive looks like a payload directory
+    bag = make_bag(tmp_path, "data")
+    assert verify.verify_bag(make_tar(bag, tmp_path / "data.tar"), mode) == {}
+    assert verify.verify_bag(archive.write_archive(str(bag), "deflate"), mode) == {}
+    (bag / "data" / "file.tsv").write_text("id\n1\n2\n")
+    assert verify.verify_bag(make_tar(bag, tmp_path / "changed.tar"), mode)
+
+
+def test_verify_fast_finds_missing_and_extra_files(tmp_path):
+    bag = make_bag(tmp_path)
+    (bag / "data" / "sub" / "other.tsv").unlink()
+    (bag / "data" / "new.tsv").write_text("id\n3\n")
+    assert verify.verify_bag(str(bag), "fast") == {
+        "data/sub/other.tsv": "missing",
+        "data/new.tsv": "not in any manifest",
+    }
+
+
+def test_verify_fast_checks_payload_oxum(tmp_path):
+    bag = make_bag(tmp_path)
+    (bag / "data" / "file.tsv").write_text("id\n100\n")
+    problems = verify.verify_bag(str(bag), "fast")
+    assert list(problems) == ["bag-info.txt"]
+    assert "Payload-Oxum" in problems["bag-info.txt"]
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_verify_full_finds_changed_files(tmp_path, processes):
+    bag = make_bag(tmp_path)
+    # Same size, different content
+    (bag / "data" / "file.tsv").write_text("id\n9\n")
+    expected = {"data/file.tsv": "md5, sha256 checksum does not match"}
+    assert verify.verify_bag(str(bag), "fast", processes) == {}
+    assert verify.verify_bag(str(bag), "full", processes) == expected
+    zip_path = archive.write_archive(str(bag), "deflate")
+    assert verify.verify_bag(zip_path, "full", processes) == expected
+    assert verify.verify_bag(make_tar(bag, tmp_path / "bag.tar"), "full", processes) == expected
+
+
+def test_verify_skips_remote_files(tmp_path):
+    bag = make_bag(tmp_path)
+    remote = tmp_path / "remote.json"
+    remote.write_text('[{"url": "https://example.org/big.bam", "filename": "big.bam", '
+                      '"length": 1000, "sha256": "%s"}]' % ("0" * 64))
+    bdbag_api.make_bag(str(bag), update=True, remote_file_manifest=str(remote))
+    assert verify.verify_bag(str(bag), "full") == {}
+
+
+def test_get_bag_rejects_corrupt_premade_bag(tmp_path):
+    bag = make_bag(tmp_path)
+    zip_path = archive.write_archive(str(bag), "deflate")
+    (bag / "data" / "file.tsv").write_text("id\n9\n")
+    assert bdbag_utils.get_bag(zip_path, verify_mode="full") == zip_path
+    with pytest.raises(exc.CorruptBag) as e:
+        bdbag_utils.get_bag(str(bag), handle_git_repos=False, verify_mode="full")
+    assert "data/file.tsv: md5, sha256 checksum does not match" in str(e.value)
+    assert bdbag_utils.get_bag(str(bag), handle_git_repos=False, verify_mode="none")
+    os.remove(str(bag / "data" / "file.tsv"))
+    with pytest.raises(exc.CorruptBag):
+        bdbag_utils.get_bag(str(bag), handle_git_repos=False)